@@ -1,24 +1,50 @@
-from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from fastapi import Body
-import whisper
-from gtts import gTTS
+from fastapi.responses import StreamingResponse
 import sqlite3
 import os
 from openai import AsyncOpenAI
-import numpy as np
-import soundfile as sf
-import io
 import asyncio
+import hashlib
 import ssl
 import time
 import json
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 from dotenv import load_dotenv
+from stt_worker import STTBusyError, create_pool_from_env
+from stt_batcher import create_batcher_from_env
+from vad import NoSpeechError, create_vad_from_env
+from audio_ingest import TARGET_RATE, AudioFormat, AudioFormatError, load_audio
+from streaming_stt import create_transcriber_from_env, receive_utterance
+from tts_stream import split_sentences, split_text, synthesize_sentences
+from tts_engines import create_engine_from_env, synthesize_async
+from tts_cache import create_cache_from_env
+from system_phrases import create_phrases_from_env
+from conversation_log import ConversationLog
+from profile_cache import create_profile_cache_from_env
+from last_seen import create_tracker_from_env
+from deadlines import create_deadlines_from_env, run_stage
+from llm_stream import create_llm_from_env
+from history_window import create_summaries_from_env, create_window_from_env
+from response_cache import create_response_cache_from_env, normalize_transcript
+from single_flight import SingleFlight, idempotency_ttl_from_env
+from prompt_templates import InvalidTemplateError, render_system_prompt, validate_template
+import model_registry
+import metrics
+import logging
+from structured_log import RequestContextMiddleware, bind_session, request_id_var, setup_logging_from_env
+from tracing import create_tracer_from_env, span, trace_id_from_headers, traced
 
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+# Logs JSON por una cola en segundo plano: escribir en stdout no bloquea el event loop
+logs = setup_logging_from_env()
+log = logging.getLogger(__name__)
+# Trazas por turno (STT → caché → LLM → TTS → persistencia) en /debug/traces
+tracer = create_tracer_from_env()
+
 # Deshabilitar verificación SSL para desarrollo (no recomendado para producción)
 ssl._create_default_https_context = ssl._create_unverified_context
 
@@ -64,13 +90,40 @@ class AIAliasUpdate(BaseModel):
     ai_alias: str
 
 app = FastAPI()
+# request_id por petición (cabecera X-Request-ID) para los logs
+app.add_middleware(RequestContextMiddleware)
 
 # Configurar modelos
-model_stt = whisper.load_model("tiny")
-# TTS con gTTS (Google Text-to-Speech)
+# Whisper corre en un pool de workers propio para no bloquear el event loop
+# El tamaño del modelo se elige con WHISPER_MODEL (por defecto "tiny")
+stt_pool = create_pool_from_env()
+# Las transcripciones concurrentes se agrupan en micro-lotes
+stt_batcher = create_batcher_from_env(stt_pool, language="es")
+# Recorte de silencios antes de Whisper; los clips sin voz no llegan al STT ni al LLM
+vad = create_vad_from_env()
+# TTS: Piper local si está disponible (TTS_ENGINE), gTTS como respaldo
+tts_engine = create_engine_from_env()
+# Audio TTS compartido entre dispositivos, en disco y con límite de tamaño
+tts_cache = create_cache_from_env()
+# Frases fijas (timeout, error...) renderizadas al arrancar y servidas desde memoria
+system_phrases = create_phrases_from_env(tts_engine.format)
+# Caché de respuestas por transcripción normalizada, por usuario
+response_cache = create_response_cache_from_env()
+# Peticiones duplicadas en curso comparten el mismo resultado
+inflight = SingleFlight()
+IDEMPOTENCY_TTL_S = idempotency_ttl_from_env()
+# Perfiles de dispositivo/usuario en memoria; los endpoints de escritura los invalidan
+profile_cache = create_profile_cache_from_env()
+# Colas y aciertos de caché en /metrics, leídos de sus .stats() en cada scrape
+metrics.register_pipeline_collectors(stt_pool, stt_batcher, inflight, response_cache,
+                                     tts_cache, profile_cache)
 
 # Configurar base de datos
-conn = sqlite3.connect("cache.db")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "cache.db")
+conn = sqlite3.connect(SQLITE_PATH)
+# WAL: las lecturas del event loop no esperan a la compactación, que escribe
+# desde su propio hilo y conexión
+conn.execute("PRAGMA journal_mode=WAL")
 
 # Función para migrar tabla de conversaciones
 def migrate_conversations_table():
@@ -82,7 +135,7 @@ def migrate_conversations_table():
     column_names = [col[1] for col in columns]
 
     if 'device_id' not in column_names or 'user_id' not in column_names:
-        print("Migrando tabla conversations...")
+        log.info("Migrando tabla conversations...")
 
         # Crear tabla temporal con estructura nueva
         cursor.execute("""
@@ -105,7 +158,7 @@ def migrate_conversations_table():
         cursor.execute("DROP TABLE conversations")
         cursor.execute("ALTER TABLE conversations_new RENAME TO conversations")
 
-        print("Tabla conversations migrada exitosamente")
+        log.info("Tabla conversations migrada exitosamente")
 
     conn.commit()
 
@@ -125,7 +178,7 @@ def migrate_users_table():
         needs_migration = True
 
     if needs_migration:
-        print("Migrando tabla users...")
+        log.info("Migrando tabla users...")
 
         # Crear tabla temporal con estructura nueva
         cursor.execute("""
@@ -180,7 +233,7 @@ def migrate_users_table():
         cursor.execute("DROP TABLE users")
         cursor.execute("ALTER TABLE users_new RENAME TO users")
 
-        print("Tabla users migrada exitosamente")
+        log.info("Tabla users migrada exitosamente")
 
     conn.commit()
 
@@ -228,7 +281,20 @@ CREATE TABLE IF NOT EXISTS conversations (
 migrate_conversations_table()
 migrate_users_table()
 
-# Tabla de caché
+# Historial como registro de mensajes de solo-añadir (conversations = cabecera)
+conversation_log = ConversationLog(conn)
+conversation_log.init_schema()
+conversation_log.migrate_json_history()
+
+# Historial que se envía al LLM: lo más reciente que cabe en HISTORY_TOKEN_BUDGET
+history_window = create_window_from_env()
+# Mensajes que se conservan por sesión; los anteriores se archivan en segundo plano
+CONVERSATION_KEEP = max(history_window.max_messages, int(os.getenv("CONVERSATION_KEEP", "40")))
+CONVERSATION_COMPACT_S = float(os.getenv("CONVERSATION_COMPACT_S", "300"))
+CONVERSATION_COMPACT_BATCH = int(os.getenv("CONVERSATION_COMPACT_BATCH", "10"))
+
+# Tabla de caché: transcripción por sesión -> texto de la respuesta
+# (filas antiguas pueden contener el MP3 completo)
 conn.execute("""
 CREATE TABLE IF NOT EXISTS cache (input TEXT PRIMARY KEY, output BLOB)
 """)
@@ -238,6 +304,11 @@ conn.commit()
 # Configurar OpenAI
 client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 assistant_id = os.getenv("ASSISTANT_ID")
+# Resumen acumulado de los turnos que salen de la ventana (HISTORY_SUMMARY=1)
+history_summaries = create_summaries_from_env(client)
+# Plazos por etapa (STT, primer token, LLM, TTS) y LLM en streaming con métricas
+deadlines = create_deadlines_from_env()
+llm = create_llm_from_env(client, deadlines.llm_first_token, deadlines.llm)
 
 # Funciones helper para usuarios y dispositivos
 def create_user(name: str, email: Optional[str] = None, phone: Optional[str] = None, preferences: Optional[Dict[str, Any]] = None, custom_prompt: Optional[str] = None, ai_alias: Optional[str] = None):
@@ -279,9 +350,15 @@ def register_device(device_id: str, device_name: str, device_type: str = "ESP32"
         VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
     """, (device_id, user_id, device_name, device_type, location, mac_address))
     conn.commit()
+    profile_cache.invalidate_device(device_id)
 
 def get_device_info(device_id: str):
-    """Obtener información de un dispositivo y su usuario"""
+    """Obtener información de un dispositivo y su usuario (vía caché de perfiles)"""
+    return profile_cache.get_or_load(device_id, _load_device_info)
+
+@traced("db.load_device_info")
+def _load_device_info(device_id: str):
+    """Consultar en la base de datos el dispositivo y su usuario"""
     cursor = conn.cursor()
     cursor.execute("""
         SELECT d.*, u.name as user_name, u.email, u.phone, u.preferences, u.custom_prompt, u.ai_alias
@@ -311,175 +388,308 @@ def get_device_info(device_id: str):
         }
     return None
 
+def _write_last_seen(rows):
+    """Volcar un lote de (last_seen, device_id) en una sola transacción"""
+    with conn:
+        conn.executemany("UPDATE devices SET last_seen = ? WHERE device_id = ?", rows)
+
+# last_seen se acumula en memoria y se vuelca por lotes en segundo plano
+last_seen = create_tracker_from_env(_write_last_seen)
+
 def update_device_last_seen(device_id: str):
-    """Actualizar último visto del dispositivo"""
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE devices SET last_seen = CURRENT_TIMESTAMP WHERE device_id = ?
-    """, (device_id,))
-    conn.commit()
+    """Actualizar último visto del dispositivo (se guarda en el próximo volcado)"""
+    last_seen.touch(device_id)
 
-async def process_audio(audio_data: bytes, session_id: str = "default_session"):
+async def process_audio(audio_data: bytes, session_id: str = "default_session",
+                        audio_format: Optional[AudioFormat] = None) -> Tuple[bytes, bool]:
+    """Audio de respuesta y si el turno se completó (False: frase de disculpa)"""
     start_time = time.time()
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Iniciando procesamiento...")
+    bind_session(session_id)
+    log.info("Iniciando procesamiento")
+    device_type = _device_type(session_id)
 
     try:
-        # Timeout general de 15 segundos
-        result = await asyncio.wait_for(_process_audio_internal(audio_data, start_time, session_id), timeout=15.0)
-        return result
-    except asyncio.TimeoutError:
-        print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - ERROR: Timeout de 15 segundos excedido")
-        # Retornar respuesta de error
-        error_response = "Lo siento, la respuesta está tardando demasiado. Inténtalo de nuevo."
-        tts = gTTS(text=error_response, lang='es')
-        audio_io = io.BytesIO()
-        tts.write_to_fp(audio_io)
-        return audio_io.getvalue()
-
-async def _process_audio_internal(audio_data: bytes, start_time: float, session_id: str):
+        # Cada etapa tiene su propio plazo (ver deadlines.py)
+        texto = await run_stage("stt", transcribe_audio(audio_data, session_id, audio_format), deadlines.stt)
+        audio_out = await _respond_once(texto, start_time, session_id)
+        metrics.REQUESTS.inc(device_type=device_type, outcome="ok")
+        return audio_out, True
+    except NoSpeechError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="no_speech")
+        return await _no_speech_response(session_id), False
+    except asyncio.TimeoutError as e:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="timeout")
+        return await _timeout_response(session_id, e), False
+    except STTBusyError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="busy")
+        raise
+    except AudioFormatError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="bad_audio")
+        raise
+    except Exception:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="error")
+        metrics.record_error("pipeline")
+        raise
+
+async def process_audio_once(audio_data: bytes, session_id: str, idempotency_key: Optional[str] = None,
+                             audio_format: Optional[AudioFormat] = None):
+    """process_audio deduplicando audios idénticos en curso y reintentos con Idempotency-Key"""
+    audio_hash = hashlib.sha256(audio_data).hexdigest()
+
+    def run():
+        return inflight.do(("audio", session_id, audio_hash, audio_format),
+                           lambda: process_audio(audio_data, session_id, audio_format))
+
+    # Solo se recuerdan turnos completos: tras una disculpa el reintento vuelve a ejecutarse
+    if idempotency_key:
+        audio_out, _ = await inflight.do(("idempotency", session_id, idempotency_key), run,
+                                         remember_seconds=IDEMPOTENCY_TTL_S,
+                                         remember_if=lambda result: result[1])
+        return audio_out
+    audio_out, _ = await run()
+    return audio_out
+
+async def _no_speech_response(session_id: str):
+    log.info("Sin voz, no se llama a Whisper ni al LLM")
+    return await system_phrases.audio("no_speech", synthesize_audio)
+
+async def _timeout_response(session_id: str, error: asyncio.TimeoutError):
+    log.warning("Timeout: %s", error, extra={"stage": getattr(error, "stage", None)})
+    metrics.record_timeout(error)
+    # Retornar respuesta de error precalculada
+    return await system_phrases.audio("timeout", synthesize_audio)
+
+async def transcribe_audio(audio_data: bytes, session_id: str,
+                           audio_format: Optional[AudioFormat] = None) -> str:
     # STT
     stt_start = time.time()
-    audio_io = io.BytesIO(audio_data)
-    audio, sr = sf.read(audio_io)
-    audio = np.array(audio, dtype=np.float32)
-    result = model_stt.transcribe(audio, language="es")
+    # float32 mono a 16 kHz, que es lo que espera Whisper (ver audio_ingest.py)
+    with span("audio.decode", bytes=len(audio_data)) as current:
+        ingested = load_audio(audio_data, audio_format)
+        if current:
+            current.set(path=ingested.path, source_rate=ingested.source_rate)
+    if ingested.path != "pcm16":
+        log.info("Audio normalizado a 16 kHz mono", extra={
+            "audio_path": ingested.path, "source_rate": ingested.source_rate, "channels": ingested.channels
+        })
+
+    # Recortar silencios y descartar clips sin voz antes de Whisper
+    with span("vad"):
+        speech = vad.trim(ingested.audio, TARGET_RATE)
+    log.debug("VAD", extra={
+        "speech_ratio": round(speech.speech_ratio, 3),
+        "duration_s": round(speech.duration, 3),
+        "trimmed_s": round(speech.trimmed_duration, 3)
+    })
+    if not speech.has_speech:
+        raise NoSpeechError()
+
+    with span("stt.whisper", audio_s=round(speech.trimmed_duration, 3)):
+        result = await stt_batcher.transcribe(speech.audio)
     texto = result["text"]
     stt_time = time.time() - stt_start
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - STT: '{texto}' ({stt_time:.2f}s)")
+    metrics.observe_stage("stt", stt_time, _device_type(session_id))
+    log.info("STT", extra={"transcript": texto, "stt_s": round(stt_time, 3)})
+    if not texto.strip():
+        raise NoSpeechError()
+    return texto
+
+def _respond_once(texto: str, start_time: float, session_id: str):
+    """_respond_to_text compartido entre peticiones concurrentes con la misma transcripción"""
+    return inflight.do(("text", session_id, normalize_transcript(texto)),
+                       lambda: _respond_to_text(texto, start_time, session_id))
+
+def _device_type(session_id: str) -> str:
+    """Etiqueta de tipo de dispositivo para las métricas"""
+    return metrics.device_type_of(get_device_info(session_id))
+
+def _cache_scope(session_id: str) -> str:
+    """Ámbito de la caché de respuestas: usuario del dispositivo + system prompt"""
+    device_info = get_device_info(session_id)
+    return response_cache.scope(device_info, session_id, render_system_prompt(device_info, session_id).text)
+
+async def _respond_to_text(texto: str, start_time: float, session_id: str):
+    device_type = _device_type(session_id)
 
-    # Caché por sesión
+    # Caché por transcripción normalizada en el ámbito del usuario
     cache_start = time.time()
-    cursor = conn.cursor()
-    cache_key = f"{session_id}:{texto}"
-    cursor.execute("SELECT output FROM cache WHERE input = ?", (cache_key,))
-    cached = cursor.fetchone()
+    cache_scope = _cache_scope(session_id)
+    with span("cache.lookup") as current:
+        cached = response_cache.lookup(cache_scope, texto, _get_cached_response)
+        if current:
+            current.set(hit=bool(cached))
     cache_time = time.time() - cache_start
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Caché: {cache_time:.4f}s")
+    metrics.observe_stage("cache", cache_time, device_type)
+    log.debug("Caché consultada", extra={"cache_s": round(cache_time, 4)})
 
     if cached:
-        print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Respuesta desde caché")
-        return cached[0]
+        log.info("Respuesta desde caché")
+        # Filas antiguas guardan el MP3; las nuevas, el texto (audio en la caché TTS)
+        if isinstance(cached, str):
+            return await run_stage("tts", synthesize_audio(cached), deadlines.tts)
+        return cached
 
-    # LLM con OpenAI Chat Completions (con historial por sesión)
+    # LLM con OpenAI Chat Completions en streaming (con historial por sesión)
     llm_start = time.time()
 
-    # Obtener información del dispositivo y usuario
-    device_info = get_device_info(session_id)
-    print(f"[{time.strftime('%H:%M:%S')}] device_info: {device_info} - Respuesta desde caché")
+    device_info, conversation_history = _build_conversation(texto, session_id)
 
-    # Obtener historial de conversación de la sesión
-    cursor.execute("SELECT messages FROM conversations WHERE session_id = ?", (session_id,))
-    result = cursor.fetchone()
-
-    # Crear system prompt personalizado con información del usuario (SIEMPRE actualizar)
-    user_name = device_info["user_name"] if device_info and device_info["user_name"] else "usuario"
-    location = device_info["location"] if device_info and device_info["location"] else "esta ubicación"
-    device_name = device_info["device_name"] if device_info and device_info["device_name"] else session_id
-    ai_alias = device_info["user_ai_alias"] if device_info and device_info["user_ai_alias"] else "Asistente"
-
-    # Usar custom_prompt del usuario si existe, sino usar el predeterminado
-    if device_info and device_info["user_custom_prompt"]:
-        # Reemplazar placeholders en el custom_prompt
-        custom_prompt = device_info["user_custom_prompt"]
-        custom_prompt = custom_prompt.replace("{user_name}", user_name)
-        custom_prompt = custom_prompt.replace("{location}", location)
-        custom_prompt = custom_prompt.replace("{device_name}", device_name)
-        custom_prompt = custom_prompt.replace("{ai_alias}", ai_alias)
-        system_prompt = custom_prompt
-    else:
-        # System prompt predeterminado con alias personalizado
-        system_prompt = f"""Eres {ai_alias}, un asistente virtual personal para {user_name}.
-        Estás ubicado en {location} y eres el dispositivo llamado {device_name}.
-        Responde de manera clara, directa y útil en español.
-        Dirígete a {user_name} de manera personal y natural.
-        Evita explicaciones largas y ve al grano.
-        Si conoces información personal de {user_name}, úsala para hacer respuestas más relevantes."""
+    # Plazos de primer token y de respuesta completa dentro de llm
+    with span("llm", model=llm.model, messages=len(conversation_history)):
+        respuesta = await llm.complete(conversation_history, session_id)
 
-    if result:
-        conversation_history = json.loads(result[0])
-        # SIEMPRE actualizar el system prompt con la información más reciente
-        if conversation_history and conversation_history[0]["role"] == "system":
-            conversation_history[0] = {"role": "system", "content": system_prompt}
-        else:
-            # Si no hay system prompt, agregarlo al inicio
-            conversation_history.insert(0, {"role": "system", "content": system_prompt})
-    else:
-        conversation_history = [{"role": "system", "content": system_prompt}]
-
-    # Agregar mensaje del usuario
-    conversation_history.append({"role": "user", "content": texto})
-
-    # Mantener solo los últimos 20 mensajes para no exceder límites
-    if len(conversation_history) > 21:  # 1 system + 20 mensajes
-        conversation_history = [conversation_history[0]] + conversation_history[-20:]
-
-    # Llamar a Chat Completions con parámetros optimizados
-    response = await client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=conversation_history,
-        max_tokens=100,  # Reducido para respuestas más concisas
-        temperature=0.3,  # Más consistente y directo
-        timeout=10.0  # Timeout de 10 segundos para la API
-    )
-
-    respuesta = response.choices[0].message.content
-
-    # Agregar respuesta al historial
+    # Agregar respuesta al historial y guardarlo
     conversation_history.append({"role": "assistant", "content": respuesta})
-
-    # Guardar historial actualizado de la sesión
-    user_id = device_info["user_id"] if device_info else None
-    device_id = session_id  # El session_id es el device_id
-
-    # Verificar si la tabla tiene las columnas nuevas
-    cursor.execute("PRAGMA table_info(conversations)")
-    columns = cursor.fetchall()
-    column_names = [col[1] for col in columns]
-
-    if 'device_id' in column_names and 'user_id' in column_names:
-        # Usar estructura nueva
-        cursor.execute("""
-            INSERT OR REPLACE INTO conversations (session_id, device_id, user_id, messages, updated_at)
-            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-        """, (session_id, device_id, user_id, json.dumps(conversation_history)))
-    else:
-        # Usar estructura antigua
-        cursor.execute("""
-            INSERT OR REPLACE INTO conversations (session_id, messages, updated_at)
-            VALUES (?, ?, CURRENT_TIMESTAMP)
-        """, (session_id, json.dumps(conversation_history)))
-
-    conn.commit()
+    _save_turn(session_id, device_info, texto, respuesta)
 
     llm_time = time.time() - llm_start
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - LLM: '{respuesta}' ({llm_time:.2f}s)")
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Mensajes: {len(conversation_history)}")
+    metrics.observe_stage("llm", llm_time, device_type)
+    log.info("LLM", extra={"reply": respuesta, "llm_s": round(llm_time, 3),
+                           "messages": len(conversation_history)})
 
-    # TTS con gTTS
+    # TTS
     tts_start = time.time()
-    tts = gTTS(text=respuesta, lang='es')
-    audio_io = io.BytesIO()
-    tts.write_to_fp(audio_io)
-    audio_out = audio_io.getvalue()
+    audio_out = await run_stage("tts", synthesize_audio(respuesta), deadlines.tts)
     tts_time = time.time() - tts_start
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - TTS: {len(audio_out)} bytes ({tts_time:.2f}s)")
+    metrics.observe_stage("tts", tts_time, device_type)
+    log.info("TTS", extra={"audio_bytes": len(audio_out), "tts_s": round(tts_time, 3)})
 
     # Guardar en caché con session_id
     cache_save_start = time.time()
-    cursor.execute("INSERT OR REPLACE INTO cache (input, output) VALUES (?, ?)", (cache_key, audio_out))
-    conn.commit()
+    _save_cached_response(response_cache.key(cache_scope, texto), respuesta)
+    response_cache.remember(cache_scope, texto)
     cache_save_time = time.time() - cache_save_start
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Caché guardado: {cache_save_time:.4f}s")
+    metrics.observe_stage("cache_save", cache_save_time, device_type)
+    log.debug("Caché guardada", extra={"cache_save_s": round(cache_save_time, 4)})
 
     total_time = time.time() - start_time
-    print(f"[{time.strftime('%H:%M:%S')}] Sesión: {session_id} - Total: {total_time:.2f}s")
+    metrics.observe_stage("total", total_time, device_type)
+    log.info("Turno completado", extra={"total_s": round(total_time, 3)})
 
     return audio_out
 
+async def stream_reply(texto: str, session_id: str):
+    """Generar la respuesta de audio frase a frase mientras el LLM escribe"""
+    start_time = time.time()
+    cache_scope = _cache_scope(session_id)
+    cached = response_cache.lookup(cache_scope, texto, _get_cached_response)
+    if cached:
+        log.info("Respuesta desde caché (streaming)")
+        if isinstance(cached, str):
+            for sentence in split_text(cached):
+                yield await synthesize_audio(sentence)
+        else:
+            yield cached
+        return
+
+    device_info, conversation_history = _build_conversation(texto, session_id)
+    reply_parts = []
+    audio_parts = []
+
+    async def deltas():
+        async for delta in llm.deltas(conversation_history, session_id):
+            reply_parts.append(delta)
+            yield delta
+
+    def synthesize_sentence(sentence: str):
+        return run_stage("tts", synthesize_audio(sentence), deadlines.tts)
+
+    try:
+        async for audio_chunk in synthesize_sentences(split_sentences(deltas()), synthesize_sentence):
+            if not audio_parts:
+                first_audio_time = time.time() - start_time
+                metrics.observe_stage("first_audio", first_audio_time, _device_type(session_id))
+                log.info("Primer audio", extra={"first_audio_s": round(first_audio_time, 3)})
+            audio_parts.append(audio_chunk)
+            yield audio_chunk
+    except asyncio.TimeoutError as e:
+        yield await _timeout_response(session_id, e)
+        return
+    except Exception as e:
+        log.exception("Error en streaming")
+        metrics.record_error("stream")
+        yield await system_phrases.audio("error", synthesize_audio)
+        return
+
+    respuesta = "".join(reply_parts)
+    _save_turn(session_id, device_info, texto, respuesta)
+    _save_cached_response(response_cache.key(cache_scope, texto), respuesta)
+    response_cache.remember(cache_scope, texto)
+
+    total_time = time.time() - start_time
+    metrics.observe_stage("total_stream", total_time, _device_type(session_id))
+    log.info("Turno completado (streaming)", extra={"reply": respuesta, "total_s": round(total_time, 3)})
+
+@traced("db.get_cached_response")
+def _get_cached_response(cache_key: str):
+    cursor = conn.cursor()
+    cursor.execute("SELECT output FROM cache WHERE input = ?", (cache_key,))
+    cached = cursor.fetchone()
+    return cached[0] if cached else None
+
+@traced("db.save_cached_response")
+def _save_cached_response(cache_key: str, respuesta: str):
+    # Solo se guarda el texto; el audio vive en la caché TTS compartida
+    cursor = conn.cursor()
+    cursor.execute("INSERT OR REPLACE INTO cache (input, output) VALUES (?, ?)", (cache_key, respuesta))
+    conn.commit()
+
+@traced("history.load")
+def _build_conversation(texto: str, session_id: str):
+    """Cargar el historial de la sesión con el system prompt actualizado y el nuevo mensaje"""
+    # Obtener información del dispositivo y usuario
+    device_info = get_device_info(session_id)
+    log.debug("Perfil del dispositivo", extra={
+        "user_id": device_info.get("user_id") if device_info else None,
+        "device_type": device_info.get("device_type") if device_info else None
+    })
+
+    # System prompt personalizado con información del usuario (memorizado por perfil)
+    system_prompt = render_system_prompt(device_info, session_id)
+
+    # El system prompt SIEMPRE se reconstruye con la información más reciente;
+    # del registro solo se leen los últimos mensajes, en una consulta, y se
+    # envían los que caben en el presupuesto de tokens
+    history = conversation_log.recent(session_id, history_window.max_messages)
+    summary = history_summaries.get(session_id) if history_summaries else None
+    window = history_window.fit(
+        system_prompt,
+        history,
+        {"role": "user", "content": texto},
+        summary
+    )
+    if history_summaries and window.dropped:
+        history_summaries.maybe_refresh(session_id, window.dropped)
+    log.debug("Contexto", extra={"messages": len(window.messages), "context_tokens": window.tokens})
+
+    return device_info, window.messages
+
+@traced("db.save_turn")
+def _save_turn(session_id: str, device_info, texto: str, respuesta: str):
+    """Añadir el turno (usuario + asistente) al historial de la sesión"""
+    user_id = device_info["user_id"] if device_info else None
+    # El session_id es el device_id
+    conversation_log.append(session_id, [("user", texto), ("assistant", respuesta)],
+                            device_id=session_id, user_id=user_id)
+
+@traced("tts")
+async def synthesize_audio(text: str) -> bytes:
+    """TTS fuera del event loop, reutilizando la caché de audio de toda la flota"""
+    return await tts_cache.get_or_synthesize(
+        text, tts_engine.voice, tts_engine.language, tts_engine.format,
+        lambda t: synthesize_async(tts_engine, t)
+    )
+
 # Endpoints de registro de usuarios y dispositivos
 @app.post("/users", response_model=UserResponse)
 async def create_user_endpoint(user: UserCreate):
     """Crear un nuevo usuario"""
+    if user.custom_prompt:
+        try:
+            validate_template(user.custom_prompt)
+        except InvalidTemplateError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
     try:
         user_id = create_user(
             name=user.name,
@@ -549,6 +759,11 @@ async def get_device_endpoint(device_id: str):
 @app.put("/users/{user_id}/custom-prompt")
 async def update_user_custom_prompt(user_id: int, custom_prompt: str):
     """Actualizar el prompt personalizado de un usuario"""
+    try:
+        validate_template(custom_prompt)
+    except InvalidTemplateError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     try:
         # Verificar que el usuario existe
         user = get_user(user_id)
@@ -562,6 +777,7 @@ async def update_user_custom_prompt(user_id: int, custom_prompt: str):
             WHERE id = ?
         """, (custom_prompt, user_id))
         conn.commit()
+        profile_cache.invalidate_user(user_id)
 
         return {
             "message": f"Prompt personalizado actualizado para usuario {user_id}",
@@ -596,6 +812,7 @@ async def update_user_ai_alias(user_id: int, request: Request):
             WHERE id = ?
         """, (ai_alias, user_id))
         conn.commit()
+        profile_cache.invalidate_user(user_id)
 
         return {
             "message": f"Alias de IA actualizado para usuario {user_id}",
@@ -622,6 +839,41 @@ async def get_user_endpoint(user_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener usuario: {str(e)}")
 
+def stt_busy_response(session_id: str):
+    """Respuesta rápida cuando el pool de STT está saturado"""
+    bind_session(session_id)
+    log.warning("STT ocupado", extra={"stt_pending": stt_pool.pending, "stt_max_pending": stt_pool.max_pending})
+    # Si la frase "busy" ya está renderizada, el dispositivo puede reproducirla
+    busy_audio = system_phrases.get("busy")
+    if busy_audio:
+        return Response(content=busy_audio, status_code=503, media_type=tts_engine.media_type,
+                        headers={"Retry-After": "1"})
+
+    return Response(
+        content=json.dumps({"error": "Servidor ocupado, inténtalo de nuevo"}),
+        status_code=503,
+        media_type="application/json",
+        headers={"Retry-After": "1"}
+    )
+
+def _trace_request(name: str, request: Request, session_id: str):
+    """Traza de la petición con el X-Trace-Id del dispositivo, si lo envía"""
+    return tracer.trace(name, trace_id_from_headers(request.headers),
+                        session_id=session_id, request_id=request_id_var.get())
+
+async def _traced_stream(trace, chunks):
+    """Mantener la traza activa mientras se genera el streaming y cerrarla al terminar"""
+    error = None
+    try:
+        with tracer.activate(trace):
+            async for chunk in chunks:
+                yield chunk
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        tracer.finish(trace, error)
+
 @app.post("/process/{session_id}")
 async def process_with_session(session_id: str, request: Request):
     """Endpoint con soporte de sesiones independientes"""
@@ -629,57 +881,178 @@ async def process_with_session(session_id: str, request: Request):
     update_device_last_seen(session_id)
 
     audio = await request.body()
-    return Response(content=await process_audio(audio, session_id), media_type="audio/mp3")
+    with _trace_request("POST /process/{session_id}", request, session_id):
+        try:
+            content = await process_audio_once(audio, session_id, request.headers.get("Idempotency-Key"),
+                                               AudioFormat.from_headers(request.headers))
+            return Response(content=content, media_type=tts_engine.media_type)
+        except STTBusyError:
+            return stt_busy_response(session_id)
+        except AudioFormatError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/process/{session_id}/stream")
+async def process_with_session_stream(session_id: str, request: Request):
+    """Igual que /process/{session_id}, pero devuelve el audio frase a frase"""
+    bind_session(session_id)
+    update_device_last_seen(session_id)
+
+    audio = await request.body()
+    # La traza sigue abierta mientras se genera el audio en streaming
+    trace = tracer.begin("POST /process/{session_id}/stream", trace_id_from_headers(request.headers),
+                         session_id=session_id, request_id=request_id_var.get())
+    try:
+        with tracer.activate(trace):
+            texto = await run_stage("stt", transcribe_audio(audio, session_id, AudioFormat.from_headers(request.headers)),
+                                    deadlines.stt)
+    except STTBusyError:
+        tracer.finish(trace)
+        return stt_busy_response(session_id)
+    except AudioFormatError as e:
+        tracer.finish(trace, e)
+        raise HTTPException(status_code=400, detail=str(e))
+    except NoSpeechError:
+        tracer.finish(trace)
+        return Response(content=await _no_speech_response(session_id), media_type=tts_engine.media_type)
+    except asyncio.TimeoutError as e:
+        tracer.finish(trace, e)
+        return Response(content=await _timeout_response(session_id, e), media_type=tts_engine.media_type)
+    except Exception as e:
+        tracer.finish(trace, e)
+        raise
+
+    return StreamingResponse(_traced_stream(trace, stream_reply(texto, session_id)),
+                             media_type=tts_engine.media_type)
 
 @app.post("/process")
 async def process_legacy(request: Request):
     """Endpoint legacy para compatibilidad"""
     audio = await request.body()
-    return Response(content=await process_audio(audio, "default_session"), media_type="audio/mp3")
+    with _trace_request("POST /process", request, "default_session"):
+        try:
+            content = await process_audio_once(audio, "default_session", request.headers.get("Idempotency-Key"),
+                                               AudioFormat.from_headers(request.headers))
+            return Response(content=content, media_type=tts_engine.media_type)
+        except STTBusyError:
+            return stt_busy_response("default_session")
+        except AudioFormatError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.websocket("/ws/process/{session_id}")
+async def process_stream(websocket: WebSocket, session_id: str):
+    """Recibir audio PCM en tramas y responder en cuanto termina la voz"""
+    await websocket.accept()
+    bind_session(session_id)
+    update_device_last_seen(session_id)
+    transcriber = create_transcriber_from_env(stt_batcher.transcribe, vad, deadlines.stt)
+
+    try:
+        while True:
+            try:
+                texto = await receive_utterance(websocket, transcriber)
+            except STTBusyError:
+                log.warning("STT ocupado (streaming)")
+                await websocket.send_json({"type": "error", "error": "busy"})
+                continue
+            except asyncio.TimeoutError as e:
+                log.warning("Timeout (streaming): %s", e, extra={"stage": getattr(e, "stage", None)})
+                await websocket.send_json({"type": "error", "error": "timeout"})
+                continue
+
+            if texto is None:
+                break
+            if not texto.strip():
+                await websocket.send_json({"type": "error", "error": "no_speech"})
+                continue
+
+            log.info("STT streaming", extra={"transcript": texto})
+            with tracer.trace("WS /ws/process/{session_id}", trace_id_from_headers(websocket.headers),
+                              session_id=session_id, request_id=request_id_var.get()):
+                async for audio_chunk in stream_reply(texto, session_id):
+                    await websocket.send_bytes(audio_chunk)
+            await websocket.send_json({"type": "done"})
+    except WebSocketDisconnect:
+        pass
+
+    log.info("Streaming desconectado")
+
+@app.get("/debug/traces")
+async def get_traces(limit: int = 50, slowest: bool = False):
+    """Últimas trazas terminadas, o las más lentas conservadas (?slowest=true)"""
+    return {
+        "stats": tracer.stats(),
+        "traces": tracer.slowest() if slowest else tracer.recent(limit)
+    }
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Una traza concreta (p. ej. el X-Trace-Id que envió el dispositivo)"""
+    trace = tracer.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Traza no encontrada")
+    return trace
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats/stt")
+async def get_stt_stats():
+    """Obtener estado del pool de STT"""
+    return {
+        "model": stt_pool.model_name,
+        "workers": stt_pool.workers,
+        "queue_size": stt_pool.queue_size,
+        "pending": stt_pool.pending,
+        "max_pending": stt_pool.max_pending,
+        "batching": stt_batcher.stats(),
+        "models": model_registry.model_stats()
+    }
+
+@app.get("/stats/llm")
+async def get_llm_stats():
+    """Obtener TTFT y tokens/s del LLM, en total y por sesión"""
+    stats = llm.stats.stats()
+    stats["model"] = llm.model
+    stats["deadlines"] = deadlines.as_dict()
+    return stats
+
+@app.get("/stats/tts-cache")
+async def get_tts_cache_stats():
+    """Obtener estadísticas de la caché de audio TTS"""
+    return tts_cache.stats()
+
+@app.get("/stats/logs")
+async def get_log_stats():
+    """Obtener el estado de la cola de logs (pendientes y descartados)"""
+    return logs.stats()
+
+@app.get("/stats/last-seen")
+async def get_last_seen_stats():
+    """Obtener estadísticas del volcado agrupado de last_seen"""
+    return last_seen.stats()
+
+@app.get("/stats/response-cache")
+async def get_response_cache_stats():
+    """Obtener aciertos exactos y por similitud de la caché de respuestas"""
+    return response_cache.stats()
+
+@app.get("/stats/inflight")
+async def get_inflight_stats():
+    """Obtener peticiones deduplicadas en curso y respuestas idempotentes recordadas"""
+    return inflight.stats()
+
+@app.get("/stats/profile-cache")
+async def get_profile_cache_stats():
+    """Obtener estadísticas de la caché de perfiles de dispositivo"""
+    return profile_cache.stats()
 
 @app.get("/stats/sessions")
 async def get_session_stats():
     """Obtener estadísticas de sesiones activas"""
-    cursor = conn.cursor()
-
     try:
-        # Estadísticas generales
-        cursor.execute("""
-            SELECT
-                COUNT(DISTINCT session_id) as total_sessions,
-                COUNT(*) as total_conversations,
-                AVG(LENGTH(messages)) as avg_conversation_size,
-                MAX(updated_at) as last_activity
-            FROM conversations
-        """)
-
-        stats = cursor.fetchone()
-
-        # Sesiones activas (últimas 24 horas)
-        cursor.execute("""
-            SELECT session_id, updated_at, LENGTH(messages) as conversation_size
-            FROM conversations
-            WHERE updated_at > datetime('now', '-1 day')
-            ORDER BY updated_at DESC
-            LIMIT 10
-        """)
-
-        active_sessions = cursor.fetchall()
-
-        return {
-            "total_sessions": stats[0] or 0,
-            "total_conversations": stats[1] or 0,
-            "avg_conversation_size": float(stats[2]) if stats[2] else 0,
-            "last_activity": stats[3],
-            "active_sessions": [
-                {
-                    "session_id": session[0],
-                    "last_activity": session[1],
-                    "conversation_size": session[2]
-                } for session in active_sessions
-            ]
-        }
-
+        return conversation_log.stats()
     except Exception as e:
         return {"error": f"Error obteniendo estadísticas: {str(e)}"}
 
@@ -689,14 +1062,21 @@ async def delete_session(session_id: str):
     cursor = conn.cursor()
 
     try:
-        # Eliminar conversación
-        cursor.execute("DELETE FROM conversations WHERE session_id = ?", (session_id,))
-        conversations_deleted = cursor.rowcount
-
-        # Eliminar caché de la sesión
-        cache_key_pattern = f"{session_id}:%"
-        cursor.execute("DELETE FROM cache WHERE input LIKE ?", (cache_key_pattern,))
+        # Ámbito actual de la caché de respuestas (usuario o dispositivo + prompt),
+        # calculado antes de borrar nada
+        cache_scope = _cache_scope(session_id)
+
+        # Eliminar conversación (cabecera, mensajes y archivo)
+        conversations_deleted = conversation_log.delete_session(session_id)
+        if history_summaries:
+            history_summaries.forget(session_id)
+
+        # Eliminar caché de la sesión: claves antiguas, de ámbito del
+        # dispositivo y del ámbito actual (user:{user_id}:{prompt} si tiene usuario)
+        cursor.execute("DELETE FROM cache WHERE input LIKE ? OR input LIKE ? OR input LIKE ?",
+                       (f"{session_id}:%", f"device:{session_id}:%", f"{cache_scope}:%"))
         cache_deleted = cursor.rowcount
+        response_cache.forget(cache_scope)
 
         conn.commit()
 
@@ -710,6 +1090,66 @@ async def delete_session(session_id: str):
         conn.rollback()
         return {"error": f"Error eliminando sesión: {str(e)}"}
 
+@app.on_event("startup")
+async def warmup_stt_pool():
+    # Cargar y calentar Whisper antes de aceptar la primera petición
+    await asyncio.to_thread(stt_pool.warmup)
+
+@app.on_event("startup")
+async def render_system_phrases():
+    await system_phrases.render_all(synthesize_audio)
+
+def _compact_conversations() -> int:
+    """Compactar con una conexión propia: se ejecuta en un hilo, fuera del event loop"""
+    compact_conn = sqlite3.connect(SQLITE_PATH)
+    try:
+        # Lotes pequeños: las escrituras del event loop esperan como mucho un lote
+        return ConversationLog(compact_conn).compact(CONVERSATION_KEEP, batch_sessions=CONVERSATION_COMPACT_BATCH)
+    finally:
+        compact_conn.close()
+
+async def compact_conversations_periodically():
+    """Archivar los mensajes fuera de la ventana de cada sesión"""
+    while True:
+        await asyncio.sleep(CONVERSATION_COMPACT_S)
+        try:
+            archived = await asyncio.to_thread(_compact_conversations)
+            if archived:
+                log.info("Historial compactado", extra={"archived": archived})
+        except Exception as e:
+            log.exception("Error compactando historial")
+
+@app.on_event("startup")
+async def start_conversation_compaction():
+    app.state.compaction_task = asyncio.create_task(compact_conversations_periodically())
+
+@app.on_event("shutdown")
+async def stop_conversation_compaction():
+    app.state.compaction_task.cancel()
+
+@app.on_event("startup")
+async def start_last_seen_flusher():
+    app.state.last_seen_task = asyncio.create_task(last_seen.run())
+
+@app.on_event("shutdown")
+async def flush_last_seen():
+    # Volcado final para no perder las marcas pendientes
+    app.state.last_seen_task.cancel()
+    last_seen.flush()
+
+@app.on_event("shutdown")
+async def shutdown_stt_pool():
+    stt_pool.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def close_tracer():
+    tracer.close()
+
+@app.on_event("shutdown")
+async def flush_logs():
+    # Último: vaciar la cola de logs antes de salir
+    logs.stop()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -1,60 +1,71 @@
-from fastapi import FastAPI, Request, Response, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
 from fastapi import Body
 import openai
-import gtts
-import io
 import asyncio
+import hashlib
 import json
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Tuple
 import os
-import whisper
-import numpy as np
-import soundfile as sf
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import urllib.parse
+import sys
+import time
+from psycopg.types.json import Jsonb
+
+# Permitir importar los módulos compartidos de la raíz del proyecto
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stt_worker import STTBusyError, create_pool_from_env
+from stt_batcher import create_batcher_from_env
+from vad import create_vad_from_env
+from audio_ingest import TARGET_RATE, AudioFormat, AudioFormatError, load_audio
+from streaming_stt import create_transcriber_from_env, receive_utterance
+from tts_engines import create_engine_from_env, synthesize_async
+from tts_cache import create_cache_from_env
+from system_phrases import create_phrases_from_env
+from pg_pool import create_db_pool_from_env
+from profile_cache import create_profile_cache_from_env
+from deadlines import create_deadlines_from_env, run_stage
+from llm_stream import create_llm_from_env
+from history_window import create_summaries_from_env, create_window_from_env
+from response_cache import create_response_cache_from_env, normalize_transcript
+from single_flight import SingleFlight, idempotency_ttl_from_env
+from prompt_templates import InvalidTemplateError, render_system_prompt, validate_template
+import model_registry
+import metrics
+import logging
+from structured_log import RequestContextMiddleware, bind_session, request_id_var, setup_logging_from_env
+from tracing import create_tracer_from_env, span, trace_id_from_headers, traced
+
+# Logs JSON por una cola en segundo plano: escribir en stdout no bloquea el event loop
+logs = setup_logging_from_env()
+log = logging.getLogger(__name__)
+# Trazas por turno (STT → caché → LLM → TTS → persistencia) en /debug/traces
+tracer = create_tracer_from_env()
 
 # Configurar OpenAI
 client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 assistant_id = os.getenv("ASSISTANT_ID")
+history_window = create_window_from_env()
+history_summaries = create_summaries_from_env(client)
+deadlines = create_deadlines_from_env()
+llm = create_llm_from_env(client, deadlines.llm_first_token, deadlines.llm)
 
-# Configurar PostgreSQL
+# Configurar PostgreSQL: pool de conexiones compartido (se abre en el startup)
 DATABASE_URL = os.getenv("DATABASE_URL")
+db = create_db_pool_from_env(DATABASE_URL)
+db_initialized = False
 
-def get_db_connection():
-    """Obtener conexión a PostgreSQL"""
-    if not DATABASE_URL:
-        # Fallback para desarrollo local
-        return None
-
-    try:
-        # Parsear URL de conexión
-        parsed = urllib.parse.urlparse(DATABASE_URL)
-        conn = psycopg2.connect(
-            host=parsed.hostname,
-            port=parsed.port,
-            user=parsed.username,
-            password=parsed.password,
-            database=parsed.path.lstrip('/'),
-            cursor_factory=RealDictCursor
-        )
-        return conn
-    except Exception as e:
-        print(f"Error conectando a PostgreSQL: {e}")
-        return None
-
-def init_db():
-    """Inicializar tablas de la base de datos"""
-    conn = get_db_connection()
-    if not conn:
-        print("No se pudo conectar a PostgreSQL, usando memoria temporal")
+async def init_db():
+    """Abrir el pool e inicializar tablas de la base de datos"""
+    if db is None:
+        log.warning("No se pudo conectar a PostgreSQL, usando memoria temporal")
         return False
 
     try:
-        with conn.cursor() as cursor:
+        await db.open()
+        async with db.connection() as conn:
             # Tabla de usuarios
-            cursor.execute("""
+            await conn.execute("""
                 CREATE TABLE IF NOT EXISTS users (
                     id SERIAL PRIMARY KEY,
                     name VARCHAR(255) NOT NULL,
@@ -69,7 +80,7 @@ def init_db():
             """)
 
             # Tabla de dispositivos
-            cursor.execute("""
+            await conn.execute("""
                 CREATE TABLE IF NOT EXISTS devices (
                     device_id VARCHAR(100) PRIMARY KEY,
                     user_id INTEGER REFERENCES users(id),
@@ -84,7 +95,7 @@ def init_db():
             """)
 
             # Tabla de conversaciones
-            cursor.execute("""
+            await conn.execute("""
                 CREATE TABLE IF NOT EXISTS conversations (
                     id SERIAL PRIMARY KEY,
                     session_id VARCHAR(100) NOT NULL,
@@ -96,25 +107,48 @@ def init_db():
             """)
 
             # Tabla de cache de audio
-            cursor.execute("""
+            await conn.execute("""
                 CREATE TABLE IF NOT EXISTS audio_cache (
                     cache_key VARCHAR(255) PRIMARY KEY,
-                    audio_data BYTEA NOT NULL,
+                    audio_data BYTEA,
+                    reply_text TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
 
-        conn.commit()
-        print("✅ Base de datos PostgreSQL inicializada correctamente")
+            # El audio se guarda ahora en la caché TTS en disco; aquí solo el texto
+            await conn.execute("ALTER TABLE audio_cache ADD COLUMN IF NOT EXISTS reply_text TEXT")
+            await conn.execute("ALTER TABLE audio_cache ALTER COLUMN audio_data DROP NOT NULL")
+
+            # Índice para leer y recortar la ventana de cada sesión
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_session_created
+                ON conversations(session_id, created_at DESC, id DESC)
+            """)
+
+        log.info("Base de datos PostgreSQL inicializada correctamente")
         return True
     except Exception as e:
-        print(f"❌ Error inicializando base de datos: {e}")
+        log.exception("Error inicializando base de datos")
+        await db.close()
         return False
-    finally:
-        conn.close()
 
-# Inicializar base de datos al startup
-db_initialized = init_db()
+# Whisper se carga una vez por proceso (tamaño según WHISPER_MODEL) y corre
+# en un pool de workers con micro-lotes, fuera del event loop
+stt_pool = create_pool_from_env()
+stt_batcher = create_batcher_from_env(stt_pool, language="es")
+vad = create_vad_from_env()
+
+# TTS: Piper local si está disponible (TTS_ENGINE), gTTS como respaldo
+tts_engine = create_engine_from_env()
+tts_cache = create_cache_from_env()
+system_phrases = create_phrases_from_env(tts_engine.format)
+profile_cache = create_profile_cache_from_env()
+response_cache = create_response_cache_from_env()
+inflight = SingleFlight()
+IDEMPOTENCY_TTL_S = idempotency_ttl_from_env()
+metrics.register_pipeline_collectors(stt_pool, stt_batcher, inflight, response_cache,
+                                     tts_cache, profile_cache)
 
 # Modelos Pydantic para requests
 class UserCreate(BaseModel):
@@ -158,333 +192,394 @@ class AIAliasUpdate(BaseModel):
     ai_alias: str
 
 # Funciones helper para usuarios y dispositivos con PostgreSQL
-def create_user(name: str, email: Optional[str] = None, phone: Optional[str] = None,
-                preferences: Optional[Dict[str, Any]] = None, custom_prompt: Optional[str] = None,
-                ai_alias: Optional[str] = None):
+async def create_user(name: str, email: Optional[str] = None, phone: Optional[str] = None,
+                      preferences: Optional[Dict[str, Any]] = None, custom_prompt: Optional[str] = None,
+                      ai_alias: Optional[str] = None):
     """Crear un nuevo usuario"""
     if not db_initialized:
         # Fallback a memoria si no hay DB
         return len([]) + 1
 
-    conn = get_db_connection()
-    if not conn:
-        return None
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO users (name, email, phone, preferences, custom_prompt, ai_alias)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                RETURNING id
-            """, (name, email, phone, json.dumps(preferences) if preferences else None,
-                  custom_prompt, ai_alias))
-
-            user_id = cursor.fetchone()['id']
-            conn.commit()
-            return user_id
+        row = await db.fetchone("""
+            INSERT INTO users (name, email, phone, preferences, custom_prompt, ai_alias)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            RETURNING id
+        """, (name, email, phone, Jsonb(preferences) if preferences else None,
+              custom_prompt, ai_alias))
+        return row['id']
     except Exception as e:
-        print(f"Error creando usuario: {e}")
+        log.warning("Error creando usuario: %s", e)
         return None
-    finally:
-        conn.close()
 
-def get_user(user_id: int):
+async def get_user(user_id: int):
     """Obtener información de un usuario"""
     if not db_initialized:
         return None
 
-    conn = get_db_connection()
-    if not conn:
-        return None
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT * FROM users WHERE id = %s", (user_id,))
-            user = cursor.fetchone()
-            if user:
-                # Convertir a dict y parsear JSON
-                user_dict = dict(user)
-                if user_dict.get('preferences'):
-                    user_dict['preferences'] = json.loads(user_dict['preferences'])
-                return user_dict
-            return None
+        user = await db.fetchone("SELECT * FROM users WHERE id = %s", (user_id,))
+        if user:
+            # psycopg 3 ya devuelve JSONB como dict
+            if isinstance(user.get('preferences'), str):
+                user['preferences'] = json.loads(user['preferences'])
+            return user
+        return None
     except Exception as e:
-        print(f"Error obteniendo usuario: {e}")
+        log.warning("Error obteniendo usuario: %s", e)
         return None
-    finally:
-        conn.close()
 
-def register_device(device_id: str, device_name: str, device_type: str = "ESP32",
-                   location: Optional[str] = None, mac_address: Optional[str] = None,
-                   user_id: Optional[int] = None):
+async def register_device(device_id: str, device_name: str, device_type: str = "ESP32",
+                          location: Optional[str] = None, mac_address: Optional[str] = None,
+                          user_id: Optional[int] = None):
     """Registrar un nuevo dispositivo"""
     if not db_initialized:
         return
 
-    conn = get_db_connection()
-    if not conn:
-        return
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO devices (device_id, user_id, device_name, device_type, location, mac_address)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (device_id) DO UPDATE SET
-                    user_id = EXCLUDED.user_id,
-                    device_name = EXCLUDED.device_name,
-                    device_type = EXCLUDED.device_type,
-                    location = EXCLUDED.location,
-                    mac_address = EXCLUDED.mac_address,
-                    last_seen = CURRENT_TIMESTAMP
-            """, (device_id, user_id, device_name, device_type, location, mac_address))
-            conn.commit()
+        await db.execute("""
+            INSERT INTO devices (device_id, user_id, device_name, device_type, location, mac_address)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            ON CONFLICT (device_id) DO UPDATE SET
+                user_id = EXCLUDED.user_id,
+                device_name = EXCLUDED.device_name,
+                device_type = EXCLUDED.device_type,
+                location = EXCLUDED.location,
+                mac_address = EXCLUDED.mac_address,
+                last_seen = CURRENT_TIMESTAMP
+        """, (device_id, user_id, device_name, device_type, location, mac_address))
+        profile_cache.invalidate_device(device_id)
     except Exception as e:
-        print(f"Error registrando dispositivo: {e}")
-    finally:
-        conn.close()
+        log.warning("Error registrando dispositivo: %s", e)
 
-def get_device_info(device_id: str):
-    """Obtener información de un dispositivo y su usuario"""
+async def set_user_ai_alias(user_id: int, ai_alias: str):
+    """Guardar el alias de la IA de un usuario"""
     if not db_initialized:
-        return None
+        return
 
-    conn = get_db_connection()
-    if not conn:
+    await db.execute("""
+        UPDATE users SET ai_alias = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    """, (ai_alias, user_id))
+    profile_cache.invalidate_user(user_id)
+
+async def get_device_info(device_id: str):
+    """Obtener información de un dispositivo y su usuario (vía caché de perfiles)"""
+    if not db_initialized:
         return None
 
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT d.*, u.name as user_name, u.email as user_email,
-                       u.phone as user_phone, u.preferences as user_preferences,
-                       u.custom_prompt as user_custom_prompt, u.ai_alias as user_ai_alias
-                FROM devices d
-                LEFT JOIN users u ON d.user_id = u.id
-                WHERE d.device_id = %s
-            """, (device_id,))
-
-            result = cursor.fetchone()
-            if result:
-                device_dict = dict(result)
-                if device_dict.get('user_preferences'):
-                    device_dict['user_preferences'] = json.loads(device_dict['user_preferences'])
-                return device_dict
-            return None
+        return await profile_cache.get_or_load_async(device_id, _load_device_info)
     except Exception as e:
-        print(f"Error obteniendo dispositivo: {e}")
+        # Los errores de la base de datos no se cachean
+        log.warning("Error obteniendo dispositivo: %s", e)
         return None
-    finally:
-        conn.close()
 
-def get_conversation_history(session_id: str):
+@traced("db.load_device_info")
+async def _load_device_info(device_id: str):
+    """Consultar en la base de datos el dispositivo y su usuario"""
+    device = await db.fetchone("""
+        SELECT d.*, u.name as user_name, u.email as user_email,
+               u.phone as user_phone, u.preferences as user_preferences,
+               u.custom_prompt as user_custom_prompt, u.ai_alias as user_ai_alias
+        FROM devices d
+        LEFT JOIN users u ON d.user_id = u.id
+        WHERE d.device_id = %s
+    """, (device_id,))
+
+    if device and isinstance(device.get('user_preferences'), str):
+        device['user_preferences'] = json.loads(device['user_preferences'])
+    return device
+
+@traced("db.get_conversation_history")
+async def get_conversation_history(session_id: str):
     """Obtener historial de conversación"""
     if not db_initialized:
         return [{"role": "system", "content": "Eres un asistente virtual útil."}]
 
-    conn = get_db_connection()
-    if not conn:
-        return [{"role": "system", "content": "Eres un asistente virtual útil."}]
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT role, content FROM conversations
-                WHERE session_id = %s
-                ORDER BY created_at ASC
-            """, (session_id,))
+        rows = await db.fetchall("""
+            SELECT role, content FROM conversations
+            WHERE session_id = %s
+            ORDER BY created_at ASC, id ASC
+        """, (session_id,))
 
-            messages = [{"role": row['role'], "content": row['content']} for row in cursor.fetchall()]
+        messages = [{"role": row['role'], "content": row['content']} for row in rows]
 
-            # Si no hay mensajes, crear system message por defecto
-            if not messages:
-                messages = [{"role": "system", "content": "Eres un asistente virtual útil."}]
+        # Si no hay mensajes, crear system message por defecto
+        if not messages:
+            messages = [{"role": "system", "content": "Eres un asistente virtual útil."}]
 
-            return messages
+        return messages
     except Exception as e:
-        print(f"Error obteniendo conversación: {e}")
+        log.warning("Error obteniendo conversación: %s", e)
         return [{"role": "system", "content": "Eres un asistente virtual útil."}]
-    finally:
-        conn.close()
 
-def save_conversation_message(session_id: str, role: str, content: str):
-    """Guardar mensaje en la conversación"""
+@traced("db.save_conversation_turn")
+async def save_conversation_turn(session_id: str, user_text: str, assistant_text: str):
+    """Guardar el turno (usuario + asistente) y recortar la ventana en una sola sentencia"""
     if not db_initialized:
         return
 
-    conn = get_db_connection()
-    if not conn:
-        return
-
+    # El DELETE no ve las filas que inserta el propio CTE: conservar 19
+    # antiguas + las 2 nuevas = los últimos 20 mensajes + system
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
+        await db.execute("""
+            WITH inserted AS (
                 INSERT INTO conversations (session_id, role, content)
-                VALUES (%s, %s, %s)
-            """, (session_id, role, content))
-
-            # Mantener solo los últimos 20 mensajes + system
-            cursor.execute("""
-                DELETE FROM conversations
-                WHERE session_id = %s AND id NOT IN (
-                    SELECT id FROM conversations
-                    WHERE session_id = %s
-                    ORDER BY created_at DESC
-                    LIMIT 21
-                )
-            """, (session_id, session_id))
-
-            conn.commit()
+                VALUES (%(session_id)s, 'user', %(user_text)s),
+                       (%(session_id)s, 'assistant', %(assistant_text)s)
+                RETURNING id
+            )
+            DELETE FROM conversations
+            WHERE id IN (
+                SELECT id FROM conversations
+                WHERE session_id = %(session_id)s
+                ORDER BY created_at DESC, id DESC
+                OFFSET 19
+            )
+        """, {"session_id": session_id, "user_text": user_text, "assistant_text": assistant_text})
     except Exception as e:
-        print(f"Error guardando mensaje: {e}")
-    finally:
-        conn.close()
+        log.warning("Error guardando mensaje: %s", e)
 
-def get_cached_audio(cache_key: str):
-    """Obtener audio del cache"""
+@traced("db.get_cached_response")
+async def get_cached_response(cache_key: str):
+    """Obtener la respuesta cacheada: texto (nuevo) o audio (filas antiguas)"""
     if not db_initialized:
         return None
 
-    conn = get_db_connection()
-    if not conn:
-        return None
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                SELECT audio_data FROM audio_cache
-                WHERE cache_key = %s
-            """, (cache_key,))
-
-            result = cursor.fetchone()
-            return result['audio_data'] if result else None
+        result = await db.fetchone("""
+            SELECT reply_text, audio_data FROM audio_cache
+            WHERE cache_key = %s
+        """, (cache_key,))
+
+        if not result:
+            return None
+        return result['reply_text'] or (bytes(result['audio_data']) if result['audio_data'] else None)
     except Exception as e:
-        print(f"Error obteniendo cache: {e}")
+        log.warning("Error obteniendo cache: %s", e)
         return None
-    finally:
-        conn.close()
 
-def save_cached_audio(cache_key: str, audio_data: bytes):
-    """Guardar audio en el cache"""
+@traced("db.save_cached_reply")
+async def save_cached_reply(cache_key: str, reply_text: str):
+    """Guardar el texto de la respuesta en el cache"""
     if not db_initialized:
         return
 
-    conn = get_db_connection()
-    if not conn:
-        return
-
     try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO audio_cache (cache_key, audio_data)
-                VALUES (%s, %s)
-                ON CONFLICT (cache_key) DO UPDATE SET
-                    audio_data = EXCLUDED.audio_data,
-                    created_at = CURRENT_TIMESTAMP
-            """, (cache_key, audio_data))
-            conn.commit()
+        await db.execute("""
+            INSERT INTO audio_cache (cache_key, reply_text)
+            VALUES (%s, %s)
+            ON CONFLICT (cache_key) DO UPDATE SET
+                reply_text = EXCLUDED.reply_text,
+                audio_data = NULL,
+                created_at = CURRENT_TIMESTAMP
+        """, (cache_key, reply_text))
     except Exception as e:
-        print(f"Error guardando cache: {e}")
-    finally:
-        conn.close()
-
-async def process_audio(audio_data: bytes, session_id: str = "default_session"):
-    """Procesar audio con Whisper y OpenAI"""
+        log.warning("Error guardando cache: %s", e)
+
+@traced("tts")
+async def synthesize_audio(text: str) -> bytes:
+    """TTS fuera del event loop, reutilizando la caché de audio de toda la flota"""
+    return await tts_cache.get_or_synthesize(
+        text, tts_engine.voice, tts_engine.language, tts_engine.format,
+        lambda t: synthesize_async(tts_engine, t)
+    )
+
+async def process_audio(audio_data: bytes, session_id: str = "default_session",
+                        audio_format: Optional[AudioFormat] = None) -> Tuple[bytes, bool]:
+    """Procesar audio con Whisper y OpenAI: audio de respuesta y si el turno se completó"""
+    start_time = time.perf_counter()
+    bind_session(session_id)
+    device_type = metrics.device_type_of(await get_device_info(session_id))
     try:
-        # STT con Whisper
-        audio_io = io.BytesIO(audio_data)
-        audio, sr = sf.read(audio_io)
-        audio = np.array(audio, dtype=np.float32)
-
-        # Cargar modelo Whisper (se cachea automáticamente)
-        model = whisper.load_model("tiny")
-        result = model.transcribe(audio, language="es")
-        texto = result["text"]
-
-        # Obtener información del dispositivo y usuario
-        device_info = get_device_info(session_id)
-
-        # Crear system prompt personalizado
-        user_name = device_info.get("user_name", "usuario") if device_info else "usuario"
-        location = device_info.get("location", "esta ubicación") if device_info else "esta ubicación"
-        device_name = device_info.get("device_name", session_id) if device_info else session_id
-        ai_alias = device_info.get("user_ai_alias", "Asistente") if device_info else "Asistente"
-
-        # Usar custom_prompt del usuario si existe
-        if device_info and device_info.get("user_custom_prompt"):
-            custom_prompt = device_info["user_custom_prompt"]
-            custom_prompt = custom_prompt.replace("{user_name}", user_name)
-            custom_prompt = custom_prompt.replace("{location}", location)
-            custom_prompt = custom_prompt.replace("{device_name}", device_name)
-            custom_prompt = custom_prompt.replace("{ai_alias}", ai_alias)
-            system_prompt = custom_prompt
-        else:
-            system_prompt = f"""Eres {ai_alias}, un asistente virtual personal para {user_name}.
-            Estás ubicado en {location} y eres el dispositivo llamado {device_name}.
-            Responde de manera clara, directa y útil en español."""
-
-        # Verificar cache de audio
-        cache_key = f"{session_id}:{texto[:100]}"  # Usar primeros 100 caracteres como key
-        cached_audio = get_cached_audio(cache_key)
-        if cached_audio:
-            return cached_audio
-
-        # Obtener historial de conversación
-        conversation_history = get_conversation_history(session_id)
-
-        # Actualizar system prompt si es necesario
-        if conversation_history and conversation_history[0]["role"] == "system":
-            conversation_history[0] = {"role": "system", "content": system_prompt}
-
-        # Agregar mensaje del usuario
-        conversation_history.append({"role": "user", "content": texto})
-
-        # Mantener solo los últimos mensajes
-        if len(conversation_history) > 21:
-            conversation_history = [conversation_history[0]] + conversation_history[-20:]
-
-        # Llamar a OpenAI
-        response = await client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=conversation_history,
-            max_tokens=100,
-            temperature=0.3
-        )
-
-        respuesta = response.choices[0].message.content
-
-        # Guardar mensajes en la base de datos
-        save_conversation_message(session_id, "user", texto)
-        save_conversation_message(session_id, "assistant", respuesta)
-
-        # TTS con gTTS
-        tts = gtts.gTTS(text=respuesta, lang='es')
-        audio_io = io.BytesIO()
-        tts.write_to_fp(audio_io)
-        audio_out = audio_io.getvalue()
-
-        # Guardar en cache
-        save_cached_audio(cache_key, audio_out)
-
+        with metrics.track_stage("stt", device_type, expected=(STTBusyError, AudioFormatError)):
+            # STT con Whisper: float32 mono a 16 kHz (ver audio_ingest.py)
+            with span("audio.decode", bytes=len(audio_data)):
+                ingested = load_audio(audio_data, audio_format)
+
+            # Sin voz no se llama a Whisper ni al LLM
+            with span("vad"):
+                speech = vad.trim(ingested.audio, TARGET_RATE)
+            if speech.has_speech:
+                with span("stt.whisper", audio_s=round(speech.trimmed_duration, 3)):
+                    result = await run_stage("stt", stt_batcher.transcribe(speech.audio), deadlines.stt)
+                texto = result["text"]
+            else:
+                texto = ""
+        if not texto.strip():
+            metrics.REQUESTS.inc(device_type=device_type, outcome="no_speech")
+            return await system_phrases.audio("no_speech", synthesize_audio), False
+    except STTBusyError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="busy")
+        raise
+    except AudioFormatError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="bad_audio")
+        raise
+    except asyncio.TimeoutError:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="timeout")
+        return await timeout_audio(), False
+    except Exception:
+        metrics.REQUESTS.inc(device_type=device_type, outcome="error")
+        log.exception("Error en STT")
+        return await error_audio(), False
+
+    audio_out, outcome = await _reply_or_apology(texto, session_id)
+    metrics.observe_stage("total", time.perf_counter() - start_time, device_type)
+    metrics.REQUESTS.inc(device_type=device_type, outcome=outcome)
+    return audio_out, outcome == "ok"
+
+async def process_audio_once(audio_data: bytes, session_id: str, idempotency_key: Optional[str] = None,
+                             audio_format: Optional[AudioFormat] = None):
+    """process_audio deduplicando audios idénticos en curso y reintentos con Idempotency-Key"""
+    audio_hash = hashlib.sha256(audio_data).hexdigest()
+
+    def run():
+        return inflight.do(("audio", session_id, audio_hash, audio_format),
+                           lambda: process_audio(audio_data, session_id, audio_format))
+
+    # Solo se recuerdan turnos completos: tras una disculpa el reintento vuelve a ejecutarse
+    if idempotency_key:
+        audio_out, _ = await inflight.do(("idempotency", session_id, idempotency_key), run,
+                                         remember_seconds=IDEMPOTENCY_TTL_S,
+                                         remember_if=lambda result: result[1])
         return audio_out
+    audio_out, _ = await run()
+    return audio_out
 
-    except Exception as e:
-        # Respuesta de error
-        error_response = "Lo siento, ha ocurrido un error. Inténtalo de nuevo."
-        tts = gtts.gTTS(text=error_response, lang='es')
-        audio_io = io.BytesIO()
-        tts.write_to_fp(audio_io)
-        return audio_io.getvalue()
+async def process_transcript(texto: str, session_id: str = "default_session"):
+    """Generar la respuesta de audio para un texto ya transcrito"""
+    audio_out, _ = await _reply_or_apology(texto, session_id)
+    return audio_out
+
+async def _reply_or_apology(texto: str, session_id: str) -> Tuple[bytes, str]:
+    """Respuesta (una vez por transcripción en curso) o la frase de disculpa, con el resultado"""
+    try:
+        return await inflight.do(("text", session_id, normalize_transcript(texto)),
+                                 lambda: _generate_reply(texto, session_id)), "ok"
+    except asyncio.TimeoutError as e:
+        log.warning("Timeout: %s", e, extra={"stage": getattr(e, "stage", None)})
+        return await timeout_audio(), "timeout"
+    except Exception:
+        log.exception("Error generando la respuesta")
+        return await error_audio(), "error"
+
+async def _generate_reply(texto: str, session_id: str):
+    """Generar la respuesta de audio para un texto ya transcrito"""
+    # Obtener información del dispositivo y usuario
+    device_info = await get_device_info(session_id)
+    device_type = metrics.device_type_of(device_info)
+
+    # System prompt personalizado (memorizado por perfil)
+    system_prompt = render_system_prompt(device_info, session_id)
+
+    # Verificar cache por transcripción normalizada en el ámbito del usuario
+    cache_scope = response_cache.scope(device_info, session_id, system_prompt.text)
+    with metrics.track_stage("cache", device_type), span("cache.lookup"):
+        cached = await response_cache.lookup_async(cache_scope, texto, get_cached_response)
+    if isinstance(cached, str):
+        with metrics.track_stage("tts", device_type):
+            return await run_stage("tts", synthesize_audio(cached), deadlines.tts)
+    if cached:
+        return cached
+
+    # Obtener historial de conversación
+    with metrics.track_stage("history", device_type):
+        conversation_history = await get_conversation_history(session_id)
+
+    # El historial guardado no incluye el system prompt: anteponerlo siempre
+    # y enviar los mensajes recientes que caben en el presupuesto de tokens
+    history = [message for message in conversation_history if message["role"] != "system"]
+    summary = history_summaries.get(session_id) if history_summaries else None
+    window = history_window.fit(
+        system_prompt,
+        history,
+        {"role": "user", "content": texto},
+        summary
+    )
+    if history_summaries and window.dropped:
+        history_summaries.maybe_refresh(session_id, window.dropped)
+    conversation_history = window.messages
+
+    # Llamar a OpenAI en streaming (plazos de primer token y respuesta completa)
+    with metrics.track_stage("llm", device_type), span("llm", model=llm.model):
+        respuesta = await llm.complete(conversation_history, session_id)
+
+    # Guardar mensajes en la base de datos
+    with metrics.track_stage("persist", device_type):
+        await save_conversation_turn(session_id, texto, respuesta)
+
+    # TTS
+    with metrics.track_stage("tts", device_type):
+        audio_out = await run_stage("tts", synthesize_audio(respuesta), deadlines.tts)
+
+    # Guardar en cache
+    with metrics.track_stage("cache_save", device_type):
+        await save_cached_reply(response_cache.key(cache_scope, texto), respuesta)
+        response_cache.remember(cache_scope, texto)
+
+    return audio_out
+
+async def timeout_audio():
+    """Respuesta de audio de timeout, precalculada al arrancar"""
+    return await system_phrases.audio("timeout", synthesize_audio)
+
+async def error_audio():
+    """Respuesta de audio genérica de error, precalculada al arrancar"""
+    return await system_phrases.audio("error", synthesize_audio)
 
 # Crear aplicación FastAPI
 app = FastAPI(title="AI Assistant API", version="1.0.0")
+# request_id por petición (cabecera X-Request-ID) para los logs
+app.add_middleware(RequestContextMiddleware)
+
+@app.on_event("startup")
+async def open_db_pool():
+    """Abrir el pool de PostgreSQL y crear las tablas"""
+    global db_initialized
+    db_initialized = await init_db()
+
+@app.on_event("startup")
+async def warmup_stt_pool():
+    """Cargar y calentar Whisper antes de aceptar la primera petición"""
+    await asyncio.to_thread(stt_pool.warmup)
+
+@app.on_event("startup")
+async def render_system_phrases():
+    """Renderizar las frases fijas del sistema una sola vez"""
+    await system_phrases.render_all(synthesize_audio)
+
+@app.on_event("shutdown")
+async def shutdown_stt_pool():
+    stt_pool.shutdown(wait=False)
+
+@app.on_event("shutdown")
+async def close_db_pool():
+    if db_initialized:
+        await db.close()
+
+@app.on_event("shutdown")
+async def close_tracer():
+    tracer.close()
+
+@app.on_event("shutdown")
+async def flush_logs():
+    # Último: vaciar la cola de logs antes de salir
+    logs.stop()
 
 # Endpoints de registro de usuarios y dispositivos
 @app.post("/users", response_model=UserResponse)
 async def create_user_endpoint(user: UserCreate):
     """Crear un nuevo usuario"""
+    if user.custom_prompt:
+        try:
+            validate_template(user.custom_prompt)
+        except InvalidTemplateError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
     try:
-        user_id = create_user(
+        user_id = await create_user(
             name=user.name,
             email=user.email,
             phone=user.phone,
@@ -493,7 +588,7 @@ async def create_user_endpoint(user: UserCreate):
             ai_alias=user.ai_alias
         )
 
-        user_data = get_user(user_id)
+        user_data = await get_user(user_id)
         if not user_data:
             raise HTTPException(status_code=500, detail="Error al crear usuario")
 
@@ -506,10 +601,10 @@ async def create_user_endpoint(user: UserCreate):
 async def register_device_endpoint(device: DeviceRegister):
     """Registrar un nuevo dispositivo"""
     try:
-        if device.user_id and not get_user(device.user_id):
+        if device.user_id and not await get_user(device.user_id):
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
-        register_device(
+        await register_device(
             device_id=device.device_id,
             device_name=device.device_name,
             device_type=device.device_type,
@@ -518,7 +613,7 @@ async def register_device_endpoint(device: DeviceRegister):
             user_id=device.user_id
         )
 
-        device_info = get_device_info(device.device_id)
+        device_info = await get_device_info(device.device_id)
         if not device_info:
             raise HTTPException(status_code=500, detail="Error al registrar dispositivo")
 
@@ -533,7 +628,7 @@ async def register_device_endpoint(device: DeviceRegister):
 async def get_device_endpoint(device_id: str):
     """Obtener información de un dispositivo"""
     try:
-        device_info = get_device_info(device_id)
+        device_info = await get_device_info(device_id)
         if not device_info:
             raise HTTPException(status_code=404, detail="Dispositivo no encontrado")
 
@@ -548,7 +643,7 @@ async def get_device_endpoint(device_id: str):
 async def update_user_ai_alias(user_id: int, request: Request):
     """Actualizar el alias de la IA para un usuario"""
     try:
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
@@ -558,8 +653,7 @@ async def update_user_ai_alias(user_id: int, request: Request):
         if not ai_alias:
             raise HTTPException(status_code=400, detail="ai_alias es requerido")
 
-        user["ai_alias"] = ai_alias
-        user["updated_at"] = "2025-09-18T06:28:00Z"
+        await set_user_ai_alias(user_id, ai_alias)
 
         return {
             "message": f"Alias de IA actualizado para usuario {user_id}",
@@ -575,7 +669,7 @@ async def update_user_ai_alias(user_id: int, request: Request):
 async def get_user_endpoint(user_id: int):
     """Obtener información de un usuario"""
     try:
-        user = get_user(user_id)
+        user = await get_user(user_id)
         if not user:
             raise HTTPException(status_code=404, detail="Usuario no encontrado")
 
@@ -586,17 +680,158 @@ async def get_user_endpoint(user_id: int):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al obtener usuario: {str(e)}")
 
+def stt_busy_response():
+    """Respuesta rápida cuando el pool de STT está saturado"""
+    # Si la frase "busy" ya está renderizada, el dispositivo puede reproducirla
+    busy_audio = system_phrases.get("busy")
+    if busy_audio:
+        return Response(content=busy_audio, status_code=503, media_type=tts_engine.media_type,
+                        headers={"Retry-After": "1"})
+
+    return Response(
+        content=json.dumps({"error": "Servidor ocupado, inténtalo de nuevo"}),
+        status_code=503,
+        media_type="application/json",
+        headers={"Retry-After": "1"}
+    )
+
+def _trace_request(name: str, request: Request, session_id: str):
+    """Traza de la petición con el X-Trace-Id del dispositivo, si lo envía"""
+    return tracer.trace(name, trace_id_from_headers(request.headers),
+                        session_id=session_id, request_id=request_id_var.get())
+
 @app.post("/process/{session_id}")
 async def process_with_session(session_id: str, request: Request):
     """Endpoint con soporte de sesiones independientes"""
     audio = await request.body()
-    return Response(content=await process_audio(audio, session_id), media_type="audio/mp3")
+    with _trace_request("POST /process/{session_id}", request, session_id):
+        try:
+            content = await process_audio_once(audio, session_id, request.headers.get("Idempotency-Key"),
+                                               AudioFormat.from_headers(request.headers))
+            return Response(content=content, media_type=tts_engine.media_type)
+        except STTBusyError:
+            return stt_busy_response()
+        except AudioFormatError as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
 @app.post("/process")
 async def process_legacy(request: Request):
     """Endpoint legacy para compatibilidad"""
     audio = await request.body()
-    return Response(content=await process_audio(audio, "default_session"), media_type="audio/mp3")
+    with _trace_request("POST /process", request, "default_session"):
+        try:
+            content = await process_audio_once(audio, "default_session", request.headers.get("Idempotency-Key"),
+                                               AudioFormat.from_headers(request.headers))
+            return Response(content=content, media_type=tts_engine.media_type)
+        except STTBusyError:
+            return stt_busy_response()
+        except AudioFormatError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.websocket("/ws/process/{session_id}")
+async def process_stream(websocket: WebSocket, session_id: str):
+    """Recibir audio PCM en tramas y responder en cuanto termina la voz"""
+    await websocket.accept()
+    bind_session(session_id)
+    transcriber = create_transcriber_from_env(stt_batcher.transcribe, vad, deadlines.stt)
+
+    try:
+        while True:
+            try:
+                texto = await receive_utterance(websocket, transcriber)
+            except STTBusyError:
+                await websocket.send_json({"type": "error", "error": "busy"})
+                continue
+            except asyncio.TimeoutError:
+                await websocket.send_json({"type": "error", "error": "timeout"})
+                continue
+
+            if texto is None:
+                break
+            if not texto.strip():
+                await websocket.send_json({"type": "error", "error": "no_speech"})
+                continue
+
+            with tracer.trace("WS /ws/process/{session_id}", trace_id_from_headers(websocket.headers),
+                              session_id=session_id, request_id=request_id_var.get()):
+                await websocket.send_bytes(await process_transcript(texto, session_id))
+            await websocket.send_json({"type": "done"})
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/stats/llm")
+async def get_llm_stats():
+    """Obtener TTFT y tokens/s del LLM, en total y por sesión"""
+    stats = llm.stats.stats()
+    stats["model"] = llm.model
+    stats["deadlines"] = deadlines.as_dict()
+    return stats
+
+@app.get("/stats/logs")
+async def get_log_stats():
+    """Obtener el estado de la cola de logs (pendientes y descartados)"""
+    return logs.stats()
+
+@app.get("/stats/tts-cache")
+async def get_tts_cache_stats():
+    """Obtener estadísticas de la caché de audio TTS"""
+    return tts_cache.stats()
+
+@app.get("/stats/response-cache")
+async def get_response_cache_stats():
+    """Obtener aciertos exactos y por similitud de la caché de respuestas"""
+    return response_cache.stats()
+
+@app.get("/stats/inflight")
+async def get_inflight_stats():
+    """Obtener peticiones deduplicadas en curso y respuestas idempotentes recordadas"""
+    return inflight.stats()
+
+@app.get("/stats/profile-cache")
+async def get_profile_cache_stats():
+    """Obtener estadísticas de la caché de perfiles de dispositivo"""
+    return profile_cache.stats()
+
+@app.get("/stats/db")
+async def get_db_stats():
+    """Obtener métricas del pool de conexiones de PostgreSQL"""
+    if not db_initialized:
+        return {"database": "Memory (fallback)"}
+    return db.stats()
+
+@app.get("/debug/traces")
+async def get_traces(limit: int = 50, slowest: bool = False):
+    """Últimas trazas terminadas, o las más lentas conservadas (?slowest=true)"""
+    return {
+        "stats": tracer.stats(),
+        "traces": tracer.slowest() if slowest else tracer.recent(limit)
+    }
+
+@app.get("/debug/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Una traza concreta (p. ej. el X-Trace-Id que envió el dispositivo)"""
+    trace = tracer.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Traza no encontrada")
+    return trace
+
+@app.get("/metrics")
+async def get_metrics():
+    """Métricas en formato de texto de Prometheus"""
+    return Response(content=metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+@app.get("/stats/stt")
+async def get_stt_stats():
+    """Obtener estado del pool de STT y de los modelos cargados"""
+    return {
+        "model": stt_pool.model_name,
+        "workers": stt_pool.workers,
+        "queue_size": stt_pool.queue_size,
+        "pending": stt_pool.pending,
+        "max_pending": stt_pool.max_pending,
+        "batching": stt_batcher.stats(),
+        "models": model_registry.model_stats()
+    }
 
 @app.get("/")
 async def root():
@@ -605,8 +840,10 @@ async def root():
         "message": "AI Assistant API - Render Deployment",
         "version": "1.0.0",
         "database": "PostgreSQL" if db_initialized else "Memory (fallback)",
+        "whisper_model": stt_pool.model_name,
         "features": [
             "Whisper STT",
+            f"TTS {tts_engine.name}",
             "OpenAI ChatGPT",
             "AI Aliases personalizados",
             "PostgreSQL persistence",
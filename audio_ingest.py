@@ -0,0 +1,245 @@
+"""
+Decodificación y normalización del audio de entrada para Whisper.
+
+Whisper espera float32 mono a 16 kHz. El cuerpo de /process puede ser:
+
+  - WAV PCM de 16 bits: se localiza el bloque `data` y se lee con
+    np.frombuffer sin copiar; la única copia es la conversión a float32,
+    escrita directamente en el búfer de salida.
+  - PCM int16 crudo (lo que produce el micrófono I2S del ESP32), declarado con
+    Content-Type `audio/L16;rate=16000;channels=1` o `audio/pcm`, o con la
+    cabecera X-Sample-Rate; también el `application/octet-stream` sin
+    cabecera de contenedor que envía esp32_http_example.ino. A 16 kHz mono
+    es el camino rápido: vista sin copia del cuerpo y una sola multiplicación.
+  - Cualquier otro formato que entienda soundfile (WAV float, FLAC, OGG,
+    MP3...). Un `application/octet-stream` que empieza por ID3 o por una
+    cabecera de trama MPEG (p. ej. el MP3 de test_generate_audio.py) va aquí,
+    no al camino de PCM crudo.
+
+Después se mezcla a mono (media de canales) y, si hace falta, se remuestrea a
+16 kHz con un filtro polifásico (sinc con ventana de Kaiser) en NumPy.
+"""
+
+import io
+import struct
+from functools import lru_cache
+from math import gcd
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import soundfile as sf
+
+TARGET_RATE = 16000
+
+# Tipos que declaran PCM crudo; octet-stream solo si no parece un contenedor
+_RAW_TYPES = ("audio/l16", "audio/pcm", "audio/x-raw")
+_OCTET_STREAM = "application/octet-stream"
+# Cabeceras de contenedor: aunque llegue como octet-stream no es PCM crudo
+_CONTAINER_MAGIC = (b"RIFF", b"RIFX", b"fLaC", b"OggS", b"FORM")
+_INT16_SCALE = 1.0 / 32768.0
+# Muestras de salida por bloque al remuestrear, para acotar la memoria
+_RESAMPLE_BLOCK = 16384
+
+
+class AudioFormatError(ValueError):
+    """El cuerpo no es audio que sepamos decodificar"""
+
+
+class IngestedAudio(NamedTuple):
+    audio: np.ndarray
+    source_rate: int
+    channels: int
+    path: str
+
+    @property
+    def duration(self) -> float:
+        return len(self.audio) / TARGET_RATE
+
+
+def _parse_content_type(content_type: Optional[str]) -> Tuple[str, dict]:
+    if not content_type:
+        return "", {}
+    parts = [part.strip() for part in content_type.split(";")]
+    params = {}
+    for part in parts[1:]:
+        name, _, value = part.partition("=")
+        params[name.strip().lower()] = value.strip().strip('"')
+    return parts[0].lower(), params
+
+
+def _declared_int(params: dict, name: str, declared: Optional[int]) -> Optional[int]:
+    """Entero positivo declarado por cabecera o por parámetro del Content-Type"""
+    if declared is None and name in params:
+        try:
+            declared = int(params[name])
+        except ValueError:
+            raise AudioFormatError(f"Parámetro {name} no válido: {params[name]!r}") from None
+    if declared is not None and declared <= 0:
+        raise AudioFormatError(f"Parámetro {name} no válido: {declared}")
+    return declared
+
+
+def _looks_like_mp3(data: bytes) -> bool:
+    """Etiqueta ID3 o cabecera de trama MPEG válida al principio del cuerpo"""
+    if data[:3] == b"ID3":
+        return True
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return False
+    version = (data[1] >> 3) & 0x03
+    layer = (data[1] >> 1) & 0x03
+    bitrate = data[2] >> 4
+    sample_rate = (data[2] >> 2) & 0x03
+    # Versión y capa reservadas o bitrate/frecuencia inválidos: no es MP3
+    # (p. ej. PCM que empieza con muestras -1, 0xFFFF)
+    return version != 1 and layer != 0 and bitrate not in (0, 15) and sample_rate != 3
+
+
+def _wav_pcm16(data: bytes) -> Optional[Tuple[int, int, int, int]]:
+    """(sample_rate, canales, offset, longitud) del bloque data de un WAV PCM16, o None"""
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        size = struct.unpack_from("<I", data, pos + 4)[0]
+        body = pos + 8
+        if chunk_id == b"fmt " and size >= 16:
+            fmt = struct.unpack_from("<HHIIHH", data, body)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            audio_format, channels, rate, _, _, bits = fmt
+            # 0xFFFE = WAVE_FORMAT_EXTENSIBLE; se deja a soundfile
+            if audio_format != 1 or bits != 16 or channels < 1:
+                return None
+            # Algunos firmwares escriben 0 o 0xFFFFFFFF al grabar en streaming
+            length = min(size, len(data) - body)
+            return rate, channels, body, length - length % (2 * channels)
+        pos = body + size + (size & 1)
+    return None
+
+
+def pcm16_to_float32(pcm, channels: int = 1, offset: int = 0, length: Optional[int] = None) -> np.ndarray:
+    """PCM int16 little-endian a float32 mono en un único búfer nuevo"""
+    if length is None:
+        length = len(pcm) - offset
+    length -= length % (2 * channels)
+    samples = np.frombuffer(pcm, dtype="<i2", count=length // 2, offset=offset)
+    if channels == 1:
+        out = np.empty(len(samples), dtype=np.float32)
+        np.multiply(samples, _INT16_SCALE, out=out, casting="unsafe")
+        return out
+
+    frames = samples.reshape(-1, channels)
+    out = np.empty(len(frames), dtype=np.float32)
+    # Sumar canal a canal sobre el búfer de salida evita el intermedio float64 de mean()
+    np.multiply(frames[:, 0], _INT16_SCALE / channels, out=out, casting="unsafe")
+    for channel in range(1, channels):
+        out += frames[:, channel] * np.float32(_INT16_SCALE / channels)
+    return out
+
+
+def downmix(audio: np.ndarray) -> np.ndarray:
+    """Mezclar a mono float32"""
+    if audio.ndim == 1:
+        return np.asarray(audio, dtype=np.float32)
+    return audio.mean(axis=1, dtype=np.float32)
+
+
+@lru_cache(maxsize=16)
+def _polyphase_filter(up: int, down: int) -> np.ndarray:
+    """Filtro paso bajo repartido en `up` fases: matriz (up, taps por fase)"""
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    n = np.arange(-half_len, half_len + 1, dtype=np.float64)
+    cutoff = 1.0 / max_rate
+    taps = cutoff * np.sinc(cutoff * n) * np.kaiser(len(n), 5.0)
+    taps *= up / taps.sum()
+
+    per_phase = -(-len(taps) // up)
+    padded = np.zeros(per_phase * up, dtype=np.float64)
+    padded[:len(taps)] = taps
+    # phases[p, j] = taps[p + j*up]
+    return padded.reshape(per_phase, up).T.astype(np.float32)
+
+
+def resample(audio: np.ndarray, source_rate: int, target_rate: int = TARGET_RATE) -> np.ndarray:
+    """Remuestreo polifásico (equivalente a upfirdn con filtro de Kaiser, sin SciPy)"""
+    if source_rate == target_rate or len(audio) == 0:
+        return audio
+    divisor = gcd(source_rate, target_rate)
+    up, down = target_rate // divisor, source_rate // divisor
+    phases = _polyphase_filter(up, down)
+    per_phase = phases.shape[1]
+    half_len = 10 * max(up, down)
+
+    n_out = -(-len(audio) * up // down)
+    # Ceros a ambos lados para que los índices fuera del clip valgan 0
+    padded = np.zeros(per_phase + len(audio) + per_phase + 2, dtype=np.float32)
+    padded[per_phase:per_phase + len(audio)] = audio
+    lags = np.arange(per_phase)
+
+    out = np.empty(n_out, dtype=np.float32)
+    for start in range(0, n_out, _RESAMPLE_BLOCK):
+        m = np.arange(start, min(start + _RESAMPLE_BLOCK, n_out))
+        t = m * down + half_len
+        newest, phase = np.divmod(t, up)
+        window = padded[(newest + per_phase)[:, None] - lags[None, :]]
+        out[start:start + len(m)] = np.einsum("ij,ij->i", window, phases[phase])
+    return out
+
+
+class AudioFormat(NamedTuple):
+    """Formato declarado por el cliente (cabeceras); todo opcional"""
+    content_type: Optional[str] = None
+    sample_rate: Optional[int] = None
+    channels: Optional[int] = None
+
+    @classmethod
+    def from_headers(cls, headers) -> "AudioFormat":
+        """Leer Content-Type, X-Sample-Rate y X-Channels de la petición"""
+        sample_rate = headers.get("X-Sample-Rate")
+        channels = headers.get("X-Channels")
+        return cls(
+            content_type=headers.get("Content-Type"),
+            sample_rate=int(sample_rate) if sample_rate and sample_rate.isdigit() else None,
+            channels=int(channels) if channels and channels.isdigit() else None
+        )
+
+
+def _raw_pcm16(data: bytes, sample_rate: Optional[int], channels: Optional[int]) -> IngestedAudio:
+    sample_rate = sample_rate or TARGET_RATE
+    channels = channels or 1
+    audio = pcm16_to_float32(data, channels)
+    path = "pcm16" if sample_rate == TARGET_RATE and channels == 1 else "pcm16_resampled"
+    return IngestedAudio(resample(audio, sample_rate), sample_rate, channels, path)
+
+
+def load_audio(data: bytes, audio_format: Optional[AudioFormat] = None) -> IngestedAudio:
+    """Decodificar el cuerpo de la petición a float32 mono a 16 kHz"""
+    audio_format = audio_format or AudioFormat()
+    mime, params = _parse_content_type(audio_format.content_type)
+    sample_rate = _declared_int(params, "rate", audio_format.sample_rate)
+    channels = _declared_int(params, "channels", audio_format.channels)
+
+    wav = _wav_pcm16(data)
+    if wav is not None:
+        rate, wav_channels, offset, length = wav
+        audio = pcm16_to_float32(data, wav_channels, offset, length)
+        return IngestedAudio(resample(audio, rate), rate, wav_channels, "wav16")
+
+    declared_raw = mime in _RAW_TYPES or sample_rate is not None
+    undeclared_raw = mime == _OCTET_STREAM and not _looks_like_mp3(data)
+    if data[:4] not in _CONTAINER_MAGIC and (declared_raw or undeclared_raw):
+        return _raw_pcm16(data, sample_rate, channels)
+
+    try:
+        audio, rate = sf.read(io.BytesIO(data), dtype="float32")
+    except Exception as e:
+        if mime == _OCTET_STREAM and data[:4] not in _CONTAINER_MAGIC and data[:3] != b"ID3":
+            # Parecía una trama MP3 pero no lo era: PCM crudo del ESP32
+            return _raw_pcm16(data, sample_rate, channels)
+        raise AudioFormatError(f"Formato de audio no soportado: {e}") from e
+    file_channels = 1 if audio.ndim == 1 else audio.shape[1]
+    return IngestedAudio(resample(downmix(audio), rate), rate, file_channels, "soundfile")
@@ -0,0 +1,331 @@
+"""
+Prueba de carga de extremo a extremo: N peluches hablando con un nodo.
+
+Carga la app FastAPI en el mismo proceso (api.py con SQLite o api/ con
+Postgres), sustituye OpenAI, gTTS y Whisper por los stubs deterministas de
+benchmarks/stubs.py y simula N dispositivos que graban clips de duración
+realista, los envían a POST /process/{device_id} como PCM int16 a 16 kHz
+(lo que produce el micrófono del ESP32) y esperan un tiempo de reflexión
+antes de volver a hablar.
+
+Las peticiones se hacen por ASGI directamente, sin red, así que se mide el
+servidor y no la pila TCP. Se informa del throughput, de los percentiles de
+latencia total y por etapa (a partir de las trazas de tracing.py) y de la
+memoria, y el resultado se guarda en JSON para compararlo entre versiones:
+
+    python -m benchmarks.load_test --devices 20 --duration 60
+    python -m benchmarks.load_test --devices 50 --compare benchmarks/results/anterior.json
+
+Con --real-stt se usa Whisper de verdad (WHISPER_MODEL) en lugar del stub.
+"""
+
+import argparse
+import asyncio
+import importlib
+import importlib.util
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from benchmarks.stubs import StubOpenAI, StubTTSEngine, StubWhisperModel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+SAMPLE_RATE = 16000
+
+
+def percentiles(values: List[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    data = np.asarray(values, dtype=np.float64)
+    return {
+        "count": int(len(data)),
+        "mean": round(float(data.mean()), 3),
+        "p50": round(float(np.percentile(data, 50)), 3),
+        "p90": round(float(np.percentile(data, 90)), 3),
+        "p95": round(float(np.percentile(data, 95)), 3),
+        "p99": round(float(np.percentile(data, 99)), 3),
+        "max": round(float(data.max()), 3)
+    }
+
+
+def rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux da KiB, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_version() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def synthetic_utterance(rng: random.Random, seconds: float) -> bytes:
+    """Clip con 'voz' (armónicos modulados a ritmo silábico) y silencio en los extremos"""
+    n = int(seconds * SAMPLE_RATE)
+    t = np.arange(n, dtype=np.float32) / SAMPLE_RATE
+    pitch = rng.uniform(180.0, 320.0)
+    voice = sum(np.sin(2 * np.pi * pitch * k * t, dtype=np.float32) / k for k in (1, 2, 3))
+    envelope = 0.5 + 0.5 * np.sin(2 * np.pi * rng.uniform(3.0, 5.0) * t, dtype=np.float32)
+    audio = 0.2 * voice * envelope
+    pad = int(0.4 * SAMPLE_RATE)
+    audio[:pad] = 0.0
+    audio[-pad:] = 0.0
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0.0, 0.002, n).astype(np.float32)
+    return (np.clip(audio + noise, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+async def asgi_request(app, method: str, path: str, headers: Optional[Dict[str, str]] = None,
+                       body: bytes = b"") -> tuple:
+    """Petición HTTP en proceso contra una app ASGI: (status, cabeceras, cuerpo)"""
+    raw_headers = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in (headers or {}).items()]
+    raw_headers.append((b"content-length", str(len(body)).encode()))
+    path_only, _, query = path.partition("?")
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": method, "scheme": "http", "path": path_only, "raw_path": path_only.encode(),
+        "query_string": query.encode(), "headers": raw_headers,
+        "client": ("127.0.0.1", 12345), "server": ("bench", 80)
+    }
+    sent = False
+    response = {"status": 0, "headers": [], "body": []}
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = message.get("headers", [])
+        elif message["type"] == "http.response.body":
+            response["body"].append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], b"".join(response["body"])
+
+
+def prepare_environment(args, workdir: str):
+    """Variables de entorno que se leen al importar la app"""
+    os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["TTS_CACHE_DIR"] = os.path.join(workdir, "tts_cache")
+    os.environ["TTS_ENGINE"] = "gtts"
+    os.environ["HISTORY_SUMMARY"] = "0"
+    os.environ["TRACE_RING_SIZE"] = str(max(10000, args.devices * 1000))
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if not args.real_stt:
+        # El stub sustituye al modelo; el micro-lote necesita Whisper real
+        os.environ["STT_BATCH_SIZE"] = "1"
+
+
+def load_backend(name: str):
+    if name == "postgres":
+        return importlib.import_module("api")
+    # api.py y el paquete api/ comparten nombre: cargar el fichero explícitamente
+    spec = importlib.util.spec_from_file_location("api_sqlite", os.path.join(ROOT, "api.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["api_sqlite"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def install_stubs(backend, args) -> dict:
+    openai_stub = StubOpenAI(args.llm_first_token, args.llm_per_token)
+    tts_stub = StubTTSEngine(args.tts_latency)
+    backend.llm.client = openai_stub
+    backend.tts_engine = tts_stub
+    if not args.real_stt:
+        whisper_stub = StubWhisperModel(args.stt_latency, args.stt_per_second)
+        backend.stt_pool._model_loader = lambda name, replica: whisper_stub
+        backend.stt_pool._model_warmup = lambda name, replica: None
+    return {"openai": openai_stub, "tts": tts_stub}
+
+
+async def run_device(app, device_id: str, rng: random.Random, clips: List[bytes], args,
+                     deadline: float, results: list):
+    # Los dispositivos no arrancan a la vez
+    await asyncio.sleep(rng.uniform(0.0, args.think_time))
+    turn = 0
+    while time.perf_counter() < deadline and (args.turns == 0 or turn < args.turns):
+        clip = clips[rng.randrange(len(clips))]
+        start = time.perf_counter()
+        try:
+            status, _, body = await asgi_request(app, "POST", f"/process/{device_id}", {
+                "Content-Type": f"audio/L16;rate={SAMPLE_RATE};channels=1",
+                "X-Trace-Id": f"{device_id}-{turn}"
+            }, clip)
+        except Exception as e:
+            status, body = 599, repr(e).encode()
+        results.append((time.perf_counter() - start, status, len(body)))
+        turn += 1
+        await asyncio.sleep(rng.expovariate(1.0 / args.think_time) if args.think_time > 0 else 0)
+
+
+def stage_latencies(traces: List[dict]) -> Dict[str, dict]:
+    by_stage: Dict[str, List[float]] = {}
+    for trace in traces:
+        for span in trace["spans"]:
+            if span["duration_ms"] is not None:
+                by_stage.setdefault(span["name"], []).append(span["duration_ms"])
+    return {name: percentiles(values) for name, values in sorted(by_stage.items())}
+
+
+async def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="plushie-bench-")
+    prepare_environment(args, workdir)
+    rss_before_import = rss_mb()
+    backend = load_backend(args.backend)
+    stubs = install_stubs(backend, args)
+    app = backend.app
+
+    rng = random.Random(args.seed)
+    clips = [synthetic_utterance(rng, min(8.0, max(0.8, rng.gauss(args.clip_seconds, args.clip_seconds / 3))))
+             for _ in range(args.distinct_clips)]
+    devices = [f"BENCH-{i:04d}" for i in range(args.devices)]
+
+    await app.router.startup()
+    try:
+        for device_id in devices:
+            await asgi_request(app, "POST", "/devices", {"Content-Type": "application/json"}, json.dumps({
+                "device_id": device_id, "device_name": device_id, "device_type": "ESP32"
+            }).encode())
+
+        rss_start = rss_mb()
+        results: list = []
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[
+            run_device(app, device_id, random.Random(f"{args.seed}:{device_id}"), clips, args, deadline, results)
+            for device_id in devices
+        ])
+        elapsed = time.perf_counter() - started
+        traces = backend.tracer.recent(limit=len(results) + len(devices))
+        server = {
+            "llm": backend.llm.stats.stats(),
+            "response_cache": backend.response_cache.stats(),
+            "tts_cache": backend.tts_cache.stats(),
+            "inflight": backend.inflight.stats()
+        }
+        server["llm"].pop("sessions", None)
+    finally:
+        await app.router.shutdown()
+
+    latencies = [1000 * latency for latency, status, _ in results if status == 200]
+    statuses = Counter(str(status) for _, status, _ in results)
+    return {
+        "version": git_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime()),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "requests": len(results),
+        "status": dict(statuses),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(statuses.get("200", 0) / elapsed, 3) if elapsed else 0.0,
+        "latency_ms": percentiles(latencies),
+        "stages_ms": stage_latencies(traces),
+        "memory_mb": {
+            "rss_before_import": round(rss_before_import, 1),
+            "rss_start": round(rss_start, 1),
+            "rss_end": round(rss_mb(), 1),
+            "peak_rss": round(peak_rss_mb(), 1)
+        },
+        "stub_calls": {"openai": stubs["openai"].calls, "tts": stubs["tts"].calls},
+        "server": server
+    }
+
+
+def compare(current: dict, baseline: dict) -> List[str]:
+    """Diferencias relevantes respecto a una ejecución anterior"""
+    lines = [f"Comparación con {baseline.get('version')} ({baseline.get('started_at')}):"]
+
+    def delta(label: str, new, old, higher_is_better: bool = False):
+        if new is None or old in (None, 0):
+            return
+        change = 100.0 * (new - old) / old
+        worse = change < 0 if higher_is_better else change > 0
+        flag = "  <-- peor" if worse and abs(change) >= 10 else ""
+        lines.append(f"  {label:<28} {old:>10} -> {new:>10} ({change:+.1f}%){flag}")
+
+    delta("throughput_rps", current["throughput_rps"], baseline.get("throughput_rps"), higher_is_better=True)
+    for key in ("p50", "p95", "p99"):
+        delta(f"latency_ms.{key}", current["latency_ms"].get(key), baseline.get("latency_ms", {}).get(key))
+    for stage, stats in current["stages_ms"].items():
+        old = baseline.get("stages_ms", {}).get(stage, {})
+        delta(f"{stage}.p95", stats.get("p95"), old.get("p95"))
+    delta("memory_mb.peak_rss", current["memory_mb"]["peak_rss"], baseline.get("memory_mb", {}).get("peak_rss"))
+    return lines
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Prueba de carga de extremo a extremo con stubs deterministas")
+    parser.add_argument("--backend", choices=("sqlite", "postgres"), default="sqlite")
+    parser.add_argument("--devices", type=int, default=10, help="peluches simultáneos")
+    parser.add_argument("--duration", type=float, default=30.0, help="segundos de carga")
+    parser.add_argument("--turns", type=int, default=0, help="turnos por dispositivo (0 = sin límite)")
+    parser.add_argument("--think-time", type=float, default=3.0, help="media del tiempo entre turnos (s)")
+    parser.add_argument("--clip-seconds", type=float, default=2.5, help="duración media de la grabación")
+    parser.add_argument("--distinct-clips", type=int, default=50, help="clips distintos (más = menos caché)")
+    parser.add_argument("--stt-latency", type=float, default=0.15)
+    parser.add_argument("--stt-per-second", type=float, default=0.05, help="latencia STT por segundo de audio")
+    parser.add_argument("--llm-first-token", type=float, default=0.4)
+    parser.add_argument("--llm-per-token", type=float, default=0.02)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--real-stt", action="store_true", help="usar Whisper real en lugar del stub")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", help="fichero JSON de resultados (por defecto benchmarks/results/)")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior con la que comparar")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run(args))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"load-{args.backend}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"{report['requests']} peticiones en {report['elapsed_s']}s "
+          f"({report['throughput_rps']} rps), estados {report['status']}")
+    print(f"Latencia (ms): {report['latency_ms']}")
+    for stage, stats in report["stages_ms"].items():
+        print(f"  {stage:<28} p50={stats.get('p50')} p95={stats.get('p95')} p99={stats.get('p99')}")
+    print(f"Memoria (MB): {report['memory_mb']}")
+    print(f"Resultados en {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print("\n".join(compare(report, json.load(f))))
+
+
+if __name__ == "__main__":
+    main()
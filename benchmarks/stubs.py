@@ -0,0 +1,154 @@
+"""
+Sustitutos deterministas de OpenAI, gTTS y Whisper para las pruebas de carga.
+
+Cada stub reproduce la interfaz que usa la API y una latencia configurable,
+sin red ni modelos, para que los resultados dependan del servidor y no de
+servicios externos. Las respuestas se derivan de un hash de la entrada, así
+que dos ejecuciones con la misma semilla hacen exactamente el mismo trabajo.
+"""
+
+import asyncio
+import hashlib
+import time
+import zlib
+
+PHRASES = [
+    "hola cómo estás",
+    "cuéntame un cuento",
+    "qué tiempo hace hoy",
+    "cómo te llamas",
+    "cantamos una canción",
+    "qué hora es",
+    "me ayudas con los deberes",
+    "buenas noches",
+    "cuál es tu color favorito",
+    "vamos a jugar",
+]
+
+WORDS = ("hola amigo vamos a jugar un rato juntos y luego contamos una historia muy bonita "
+         "sobre un dragón que vivía en una montaña llena de flores").split()
+
+
+def _seed(text: str) -> int:
+    return int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+
+
+class StubWhisperModel:
+    """Modelo con la interfaz de whisper: transcribe() bloquea el hilo del worker"""
+
+    def __init__(self, base_latency: float = 0.15, per_audio_second: float = 0.05):
+        self.base_latency = base_latency
+        self.per_audio_second = per_audio_second
+
+    def transcribe(self, audio, **kwargs) -> dict:
+        time.sleep(self.base_latency + self.per_audio_second * len(audio) / 16000)
+        phrase = PHRASES[zlib.crc32(audio[:1600].tobytes()) % len(PHRASES)]
+        return {"text": f" {phrase}", "segments": [], "language": kwargs.get("language", "es")}
+
+
+class _Delta:
+    def __init__(self, content):
+        self.content = content
+
+
+class _Message:
+    def __init__(self, content):
+        self.role = "assistant"
+        self.content = content
+
+
+class _Choice:
+    def __init__(self, content, streaming: bool):
+        if streaming:
+            self.delta = _Delta(content)
+        else:
+            self.message = _Message(content)
+
+
+class _Chunk:
+    def __init__(self, content, streaming: bool = True):
+        self.choices = [_Choice(content, streaming)]
+
+
+class _Stream:
+    def __init__(self, tokens, first_token_latency: float, per_token_latency: float):
+        self._tokens = tokens
+        self._first = first_token_latency
+        self._per_token = per_token_latency
+        self._index = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._index >= len(self._tokens):
+            raise StopAsyncIteration
+        await asyncio.sleep(self._first if self._index == 0 else self._per_token)
+        token = self._tokens[self._index]
+        self._index += 1
+        return _Chunk(token)
+
+    async def close(self):
+        self._index = len(self._tokens)
+
+
+class _Completions:
+    def __init__(self, client: "StubOpenAI"):
+        self.client = client
+
+    async def create(self, model: str, messages, stream: bool = False, max_tokens: int = 100, **kwargs):
+        self.client.calls += 1
+        reply = self.client.reply_for(messages[-1]["content"] if messages else "", max_tokens)
+        if stream:
+            tokens = [word + " " for word in reply.split()]
+            tokens[-1] = tokens[-1].rstrip() + "."
+            return _Stream(tokens, self.client.first_token_latency, self.client.per_token_latency)
+        await asyncio.sleep(self.client.first_token_latency)
+        return _Chunk(reply, streaming=False)
+
+
+class _Chat:
+    def __init__(self, client: "StubOpenAI"):
+        self.completions = _Completions(client)
+
+
+class StubOpenAI:
+    """AsyncOpenAI mínimo: chat.completions.create con y sin streaming"""
+
+    def __init__(self, first_token_latency: float = 0.4, per_token_latency: float = 0.02,
+                 reply_words: int = 18):
+        self.first_token_latency = first_token_latency
+        self.per_token_latency = per_token_latency
+        self.reply_words = reply_words
+        self.calls = 0
+        self.chat = _Chat(self)
+
+    def reply_for(self, prompt: str, max_tokens: int) -> str:
+        seed = _seed(prompt)
+        n_words = min(self.reply_words, max_tokens)
+        return " ".join(WORDS[(seed + i * 7) % len(WORDS)] for i in range(n_words)).capitalize()
+
+
+class StubTTSEngine:
+    """Motor TTS con la interfaz de tts_engines.TTSEngine"""
+
+    name = "stub"
+    format = "mp3"
+    voice = "stub"
+    language = "es"
+    media_type = "audio/mp3"
+
+    def __init__(self, latency: float = 0.3, bytes_per_char: int = 180):
+        self.latency = latency
+        self.bytes_per_char = bytes_per_char
+        self.calls = 0
+
+    def synthesize(self, text: str) -> bytes:
+        # Se ejecuta en el pool de hilos de TTS, como gTTS o Piper
+        self.calls += 1
+        time.sleep(self.latency)
+        seed = hashlib.sha256(text.encode("utf-8")).digest()
+        return (seed * (1 + len(text) * self.bytes_per_char // len(seed)))[:len(text) * self.bytes_per_char]
+
+    def synthesize_voiced(self, text: str):
+        return self.synthesize(text), self.voice
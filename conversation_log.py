@@ -0,0 +1,183 @@
+"""
+Historial de conversación en SQLite como registro de mensajes de solo-añadir.
+
+Cada mensaje es una fila de `conversation_messages` con un número de
+secuencia por sesión (clave primaria `(session_id, seq)`), así que guardar
+un turno cuesta siempre dos inserciones pequeñas, sin reescribir el
+historial completo. La tabla `conversations` queda como cabecera de la
+sesión (dispositivo, usuario, último seq, última actividad) y sirve para
+las estadísticas sin recorrer los mensajes.
+
+El system prompt no se guarda: se reconstruye en cada turno con los datos
+actuales del dispositivo. Los mensajes que quedan fuera de la ventana se
+mueven a `conversation_archive` en segundo plano con `compact`.
+"""
+
+import json
+import logging
+import sqlite3
+from typing import Dict, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class ConversationLog:
+    """Registro de mensajes por sesión sobre una conexión SQLite"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def init_schema(self):
+        """Crear las tablas de mensajes y archivo, y la columna last_seq de la cabecera"""
+        for table in ("conversation_messages", "conversation_archive"):
+            self.conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (session_id, seq)
+            ) WITHOUT ROWID
+            """)
+
+        columns = [col[1] for col in self.conn.execute("PRAGMA table_info(conversations)")]
+        if "last_seq" not in columns:
+            self.conn.execute("ALTER TABLE conversations ADD COLUMN last_seq INTEGER DEFAULT 0")
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations(updated_at)"
+        )
+        self.conn.commit()
+
+    def migrate_json_history(self) -> int:
+        """Pasar los historiales JSON antiguos de `conversations.messages` al registro"""
+        rows = self.conn.execute(
+            "SELECT session_id, messages FROM conversations WHERE messages IS NOT NULL"
+        ).fetchall()
+        if not rows:
+            return 0
+
+        log.info("Migrando %d historiales de conversación al registro de mensajes...", len(rows))
+        with self.conn:
+            for session_id, messages in rows:
+                try:
+                    history = [m for m in json.loads(messages) if m.get("role") != "system"]
+                except (TypeError, ValueError):
+                    history = []
+
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO conversation_messages (session_id, seq, role, content) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(session_id, seq, m["role"], m["content"])
+                     for seq, m in enumerate(history, start=1)]
+                )
+                self.conn.execute(
+                    "UPDATE conversations SET messages = NULL, last_seq = ? WHERE session_id = ?",
+                    (len(history), session_id)
+                )
+        return len(rows)
+
+    def recent(self, session_id: str, limit: int) -> List[Dict[str, str]]:
+        """Últimos `limit` mensajes de la sesión, del más antiguo al más reciente"""
+        rows = self.conn.execute("""
+            SELECT role, content FROM (
+                SELECT seq, role, content FROM conversation_messages
+                WHERE session_id = ?
+                ORDER BY seq DESC
+                LIMIT ?
+            ) ORDER BY seq ASC
+        """, (session_id, limit)).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append(self, session_id: str, messages: Sequence[Tuple[str, str]],
+               device_id: Optional[str] = None, user_id: Optional[int] = None):
+        """Añadir mensajes (rol, contenido) a la sesión en una sola transacción"""
+        with self.conn:
+            self.conn.execute("""
+                INSERT INTO conversations (session_id, device_id, user_id, last_seq, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    device_id = excluded.device_id,
+                    user_id = excluded.user_id,
+                    last_seq = COALESCE(conversations.last_seq, 0) + ?,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (session_id, device_id, user_id, len(messages), len(messages)))
+            last_seq = self.conn.execute(
+                "SELECT last_seq FROM conversations WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+
+            first_seq = last_seq - len(messages) + 1
+            self.conn.executemany(
+                "INSERT INTO conversation_messages (session_id, seq, role, content) VALUES (?, ?, ?, ?)",
+                [(session_id, first_seq + i, role, content) for i, (role, content) in enumerate(messages)]
+            )
+
+    def compact(self, keep: int, archive: bool = True, batch_sessions: int = 100) -> int:
+        """Mover (o borrar) los mensajes anteriores a los últimos `keep` de cada sesión
+
+        Solo visita las sesiones con más de `keep` mensajes (según la cabecera)
+        y borra por rango de clave primaria; confirma cada `batch_sessions`
+        sesiones para no retener el bloqueo de escritura.
+        """
+        sessions = self.conn.execute(
+            "SELECT session_id, last_seq FROM conversations WHERE last_seq > ?", (keep,)
+        ).fetchall()
+        moved = 0
+        for start in range(0, len(sessions), batch_sessions):
+            with self.conn:
+                for session_id, last_seq in sessions[start:start + batch_sessions]:
+                    cutoff = (session_id, last_seq - keep)
+                    if archive:
+                        self.conn.execute(
+                            "INSERT OR IGNORE INTO conversation_archive (session_id, seq, role, content, created_at) "
+                            "SELECT session_id, seq, role, content, created_at FROM conversation_messages "
+                            "WHERE session_id = ? AND seq <= ?",
+                            cutoff
+                        )
+                    moved += self.conn.execute(
+                        "DELETE FROM conversation_messages WHERE session_id = ? AND seq <= ?", cutoff
+                    ).rowcount
+        return moved
+
+    def delete_session(self, session_id: str) -> int:
+        """Eliminar la sesión con sus mensajes y su archivo; devuelve 1 si existía"""
+        with self.conn:
+            self.conn.execute("DELETE FROM conversation_messages WHERE session_id = ?", (session_id,))
+            self.conn.execute("DELETE FROM conversation_archive WHERE session_id = ?", (session_id,))
+            return self.conn.execute(
+                "DELETE FROM conversations WHERE session_id = ?", (session_id,)
+            ).rowcount
+
+    def stats(self, active_limit: int = 10) -> dict:
+        """Estadísticas leídas de las cabeceras de sesión"""
+        total_sessions, total_messages, last_activity = self.conn.execute("""
+            SELECT COUNT(*), SUM(last_seq), MAX(updated_at) FROM conversations
+        """).fetchone()
+
+        active_sessions = self.conn.execute("""
+            SELECT session_id, updated_at, last_seq
+            FROM conversations
+            WHERE updated_at > datetime('now', '-1 day')
+            ORDER BY updated_at DESC
+            LIMIT ?
+        """, (active_limit,)).fetchall()
+
+        avg_messages = (total_messages or 0) / total_sessions if total_sessions else 0
+        # total_conversations, avg_conversation_size y conversation_size se
+        # mantienen por compatibilidad; el tamaño se mide ahora en mensajes
+        return {
+            "total_sessions": total_sessions or 0,
+            "total_conversations": total_sessions or 0,
+            "total_messages": total_messages or 0,
+            "avg_messages_per_session": avg_messages,
+            "avg_conversation_size": avg_messages,
+            "last_activity": last_activity,
+            "active_sessions": [
+                {
+                    "session_id": session_id,
+                    "last_activity": updated_at,
+                    "messages": last_seq or 0,
+                    "conversation_size": last_seq or 0
+                } for session_id, updated_at, last_seq in active_sessions
+            ]
+        }
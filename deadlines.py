@@ -0,0 +1,63 @@
+"""
+Plazos por etapa del pipeline de voz (STT, LLM, TTS).
+
+En lugar de un único timeout de 15 s para todo el turno, cada etapa tiene
+su propio plazo, de modo que un timeout dice qué etapa se atascó y una etapa
+lenta no consume el margen de las siguientes sin que se note.
+
+  - STT_DEADLINE_S: transcripción
+  - LLM_FIRST_TOKEN_DEADLINE_S: hasta el primer token del LLM
+  - LLM_DEADLINE_S: respuesta completa del LLM
+  - TTS_DEADLINE_S: síntesis (por frase en streaming)
+"""
+
+import asyncio
+import os
+from typing import Awaitable, TypeVar
+
+T = TypeVar("T")
+
+
+class StageTimeout(asyncio.TimeoutError):
+    """Timeout de una etapa concreta; es un asyncio.TimeoutError"""
+
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"La etapa '{stage}' superó su plazo de {seconds:.1f}s")
+        self.stage = stage
+        self.seconds = seconds
+
+
+class StageDeadlines:
+    def __init__(self, stt: float = 5.0, llm_first_token: float = 4.0,
+                 llm: float = 10.0, tts: float = 5.0):
+        self.stt = stt
+        self.llm_first_token = llm_first_token
+        self.llm = llm
+        self.tts = tts
+
+    def as_dict(self) -> dict:
+        return {
+            "stt": self.stt,
+            "llm_first_token": self.llm_first_token,
+            "llm": self.llm,
+            "tts": self.tts
+        }
+
+
+async def run_stage(stage: str, awaitable: Awaitable[T], seconds: float) -> T:
+    """Esperar una etapa con su plazo y convertir el timeout en StageTimeout"""
+    try:
+        return await asyncio.wait_for(awaitable, timeout=seconds)
+    except asyncio.TimeoutError as e:
+        if isinstance(e, StageTimeout):
+            raise
+        raise StageTimeout(stage, seconds) from None
+
+
+def create_deadlines_from_env() -> StageDeadlines:
+    return StageDeadlines(
+        stt=float(os.getenv("STT_DEADLINE_S", "5")),
+        llm_first_token=float(os.getenv("LLM_FIRST_TOKEN_DEADLINE_S", "4")),
+        llm=float(os.getenv("LLM_DEADLINE_S", "10")),
+        tts=float(os.getenv("TTS_DEADLINE_S", "5"))
+    )
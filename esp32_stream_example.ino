@@ -0,0 +1,138 @@
+// ESP32 - Cliente con envío de audio en streaming por WebSocket
+// El audio se envía mientras se graba; el servidor detecta el fin de la voz
+// y responde sin esperar a que se suba el archivo completo
+
+#include <WiFi.h>
+#include <WebSocketsClient.h>   // Librería "WebSockets" de Markus Sattler
+#include <driver/i2s.h>
+
+// Configuración WiFi
+const char* ssid = "TU_WIFI_SSID";
+const char* password = "TU_WIFI_PASSWORD";
+
+// Servidor
+const char* serverHost = "192.168.1.100";
+const uint16_t serverPort = 8000;
+
+// Micrófono I2S (INMP441 o similar) a 16 kHz, 16 bits, mono
+#define I2S_PORT I2S_NUM_0
+#define SAMPLE_RATE 16000
+#define FRAME_SAMPLES 480   // 30 ms por trama
+
+WebSocketsClient webSocket;
+String deviceId = "";
+bool recording = false;
+int16_t frame[FRAME_SAMPLES];
+
+String getDeviceId() {
+    if (deviceId == "") {
+        uint8_t mac[6];
+        WiFi.macAddress(mac);
+        char macStr[18];
+        sprintf(macStr, "%02X-%02X-%02X-%02X-%02X-%02X",
+                mac[0], mac[1], mac[2], mac[3], mac[4], mac[5]);
+        deviceId = String("ESP32-") + String(macStr);
+    }
+    return deviceId;
+}
+
+void onWebSocketEvent(WStype_t type, uint8_t* payload, size_t length) {
+    switch (type) {
+        case WStype_CONNECTED:
+            Serial.println("WebSocket conectado");
+            break;
+        case WStype_TEXT:
+            // {"type": "partial" | "final" | "done" | "error", ...}
+            Serial.printf("Servidor: %.*s\n", length, payload);
+            if (strstr((const char*)payload, "\"final\"") != NULL) {
+                // El servidor ya cerró el enunciado: dejar de enviar audio
+                recording = false;
+            }
+            break;
+        case WStype_BIN:
+            // Audio de respuesta (MP3)
+            Serial.printf("Respuesta de audio: %u bytes\n", length);
+            // Aquí reproducir el audio MP3
+            break;
+        case WStype_DISCONNECTED:
+            Serial.println("WebSocket desconectado");
+            break;
+        default:
+            break;
+    }
+}
+
+void setupMicrophone() {
+    Serial.println("Configurando micrófono...");
+
+    i2s_config_t i2s_config = {
+        .mode = (i2s_mode_t)(I2S_MODE_MASTER | I2S_MODE_RX),
+        .sample_rate = SAMPLE_RATE,
+        .bits_per_sample = I2S_BITS_PER_SAMPLE_16BIT,
+        .channel_format = I2S_CHANNEL_FMT_ONLY_LEFT,
+        .communication_format = I2S_COMM_FORMAT_STAND_I2S,
+        .intr_alloc_flags = ESP_INTR_FLAG_LEVEL1,
+        .dma_buf_count = 8,
+        .dma_buf_len = FRAME_SAMPLES,
+        .use_apll = false
+    };
+    i2s_pin_config_t pin_config = {
+        .bck_io_num = 26,
+        .ws_io_num = 25,
+        .data_out_num = I2S_PIN_NO_CHANGE,
+        .data_in_num = 33
+    };
+    i2s_driver_install(I2S_PORT, &i2s_config, 0, NULL);
+    i2s_set_pin(I2S_PORT, &pin_config);
+}
+
+void setup() {
+    Serial.begin(115200);
+
+    WiFi.begin(ssid, password);
+    while (WiFi.status() != WL_CONNECTED) {
+        delay(1000);
+        Serial.println("Conectando a WiFi...");
+    }
+    Serial.println("WiFi conectado");
+
+    deviceId = getDeviceId();
+    Serial.print("ID del dispositivo: ");
+    Serial.println(deviceId);
+
+    setupMicrophone();
+
+    String path = "/ws/process/" + deviceId;
+    webSocket.begin(serverHost, serverPort, path);
+    webSocket.onEvent(onWebSocketEvent);
+    webSocket.setReconnectInterval(2000);
+
+    Serial.println("ESP32 listo para streaming de audio");
+}
+
+void loop() {
+    webSocket.loop();
+
+    // Empezar a grabar cuando se pulsa el botón (aquí: cada 10 segundos)
+    static unsigned long lastStart = 0;
+    if (!recording && millis() - lastStart > 10000) {
+        Serial.println("=== NUEVA CONVERSACIÓN (streaming) ===");
+        recording = true;
+        lastStart = millis();
+    }
+
+    if (recording) {
+        size_t bytesRead = 0;
+        i2s_read(I2S_PORT, frame, sizeof(frame), &bytesRead, portMAX_DELAY);
+        if (bytesRead > 0) {
+            // Enviar la trama tal cual: PCM int16 little-endian a 16 kHz
+            webSocket.sendBIN((uint8_t*)frame, bytesRead);
+        }
+
+        // Límite de seguridad: el servidor corta a los 30 s de audio
+        if (millis() - lastStart > 30000) {
+            webSocket.sendTXT("end");
+            recording = false;
+        }
+    }
+}
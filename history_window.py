@@ -0,0 +1,183 @@
+"""
+Ventana de historial para el LLM con presupuesto de tokens.
+
+En lugar de cortar siempre en "system + 20 mensajes", `HistoryWindow.fit`
+mete los mensajes más recientes que caben en HISTORY_TOKEN_BUDGET (contando
+el system prompt y el mensaje nuevo), con un máximo de HISTORY_MAX_MESSAGES.
+El system prompt se conserva siempre; sus tokens vienen ya contados en
+`SystemPrompt.tokens` (memorizado por perfil en prompt_templates).
+
+Opcionalmente (HISTORY_SUMMARY=1) los turnos que quedan fuera se sustituyen
+por un resumen acumulado por sesión. El resumen se actualiza en segundo
+plano cuando se han caído suficientes mensajes nuevos, así que el turno
+actual nunca espera a una llamada extra al LLM: usa el último resumen
+disponible.
+"""
+
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from prompt_templates import SystemPrompt
+from token_count import MESSAGE_OVERHEAD_TOKENS, count_message_tokens
+
+log = logging.getLogger(__name__)
+
+SUMMARY_PREFIX = "Resumen de la conversación anterior: "
+
+
+class Window(NamedTuple):
+    messages: List[Dict[str, str]]
+    dropped: List[Dict[str, str]]
+    tokens: int
+
+
+class HistoryWindow:
+    """Selecciona el historial reciente que cabe en el presupuesto de tokens"""
+
+    def __init__(self, budget_tokens: int = 1200, max_messages: int = 40):
+        self.budget_tokens = budget_tokens
+        self.max_messages = max_messages
+
+    def fit(self, system_prompt: SystemPrompt, history: List[Dict[str, str]],
+            new_message: Dict[str, str], summary: Optional[str] = None) -> Window:
+        """Mensajes para el LLM: system (+ resumen) + historial que cabe + mensaje nuevo"""
+        summary_message = {"role": "system", "content": SUMMARY_PREFIX + summary} if summary else None
+        summary_tokens = count_message_tokens(summary_message) if summary_message else 0
+        used = (system_prompt.tokens + MESSAGE_OVERHEAD_TOKENS + count_message_tokens(new_message)
+                + summary_tokens)
+
+        kept = []
+        for message in reversed(history[-self.max_messages:]):
+            cost = count_message_tokens(message)
+            if used + cost > self.budget_tokens:
+                break
+            used += cost
+            kept.append(message)
+        kept.reverse()
+
+        # Empezar la ventana en un mensaje del usuario, no a mitad de turno
+        while kept and kept[0]["role"] == "assistant":
+            used -= count_message_tokens(kept.pop(0))
+
+        dropped = history[:len(history) - len(kept)]
+        messages = [{"role": "system", "content": system_prompt.text}]
+        if summary_message and dropped:
+            messages.append(summary_message)
+        else:
+            used -= summary_tokens
+        messages.extend(kept)
+        messages.append(new_message)
+        return Window(messages, dropped, used)
+
+
+Summarizer = Callable[[Optional[str], List[Dict[str, str]]], Awaitable[str]]
+
+
+class RollingSummaries:
+    """Resumen acumulado de los turnos que han salido de la ventana, por sesión"""
+
+    def __init__(self, summarize: Summarizer, min_new_messages: int = 4, max_sessions: int = 10000):
+        self.summarize = summarize
+        self.min_new_messages = min_new_messages
+        self.max_sessions = max_sessions
+        # session_id -> (resumen, último mensaje incluido en el resumen)
+        self._summaries: "OrderedDict[str, Tuple[str, Tuple[str, str]]]" = OrderedDict()
+        self._refreshing: Dict[str, asyncio.Task] = {}
+        self.refreshes = 0
+        self.errors = 0
+
+    def get(self, session_id: str) -> Optional[str]:
+        entry = self._summaries.get(session_id)
+        return entry[0] if entry else None
+
+    def _new_messages(self, session_id: str, dropped: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        entry = self._summaries.get(session_id)
+        if entry is None:
+            return dropped
+        last = entry[1]
+        for i in range(len(dropped) - 1, -1, -1):
+            if (dropped[i]["role"], dropped[i]["content"]) == last:
+                return dropped[i + 1:]
+        return dropped
+
+    def maybe_refresh(self, session_id: str, dropped: List[Dict[str, str]]):
+        """Programar la actualización del resumen si han caído bastantes mensajes nuevos"""
+        if session_id in self._refreshing:
+            return
+        new_messages = self._new_messages(session_id, dropped)
+        if len(new_messages) < self.min_new_messages:
+            return
+
+        task = asyncio.create_task(self._refresh(session_id, new_messages))
+        self._refreshing[session_id] = task
+        task.add_done_callback(lambda _: self._refreshing.pop(session_id, None))
+
+    async def _refresh(self, session_id: str, new_messages: List[Dict[str, str]]):
+        try:
+            summary = await self.summarize(self.get(session_id), new_messages)
+        except Exception as e:
+            self.errors += 1
+            log.warning("No se pudo resumir el historial: %s", e, extra={"session_id": session_id})
+            return
+
+        last = (new_messages[-1]["role"], new_messages[-1]["content"])
+        self._summaries[session_id] = (summary, last)
+        self._summaries.move_to_end(session_id)
+        while len(self._summaries) > self.max_sessions:
+            self._summaries.popitem(last=False)
+        self.refreshes += 1
+
+    def forget(self, session_id: str):
+        self._summaries.pop(session_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self._summaries),
+            "refreshing": len(self._refreshing),
+            "refreshes": self.refreshes,
+            "errors": self.errors
+        }
+
+
+def make_openai_summarizer(client, model: str = "gpt-3.5-turbo", max_tokens: int = 120) -> Summarizer:
+    """Resumidor que usa el mismo cliente de Chat Completions que las respuestas"""
+
+    async def summarize(previous: Optional[str], messages: List[Dict[str, str]]) -> str:
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        if previous:
+            transcript = f"Resumen previo: {previous}\n{transcript}"
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[
+                {"role": "system", "content": "Resume en pocas frases, en español, los datos y "
+                                              "temas importantes de esta conversación."},
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=max_tokens,
+            temperature=0.0,
+            timeout=10.0
+        )
+        return response.choices[0].message.content.strip()
+
+    return summarize
+
+
+def create_window_from_env() -> HistoryWindow:
+    """Crear la ventana leyendo HISTORY_TOKEN_BUDGET y HISTORY_MAX_MESSAGES"""
+    return HistoryWindow(
+        budget_tokens=int(os.getenv("HISTORY_TOKEN_BUDGET", "1200")),
+        max_messages=int(os.getenv("HISTORY_MAX_MESSAGES", "40"))
+    )
+
+
+def create_summaries_from_env(client) -> Optional[RollingSummaries]:
+    """Resúmenes acumulados si HISTORY_SUMMARY=1; None si están desactivados"""
+    if os.getenv("HISTORY_SUMMARY", "0") != "1":
+        return None
+    return RollingSummaries(
+        make_openai_summarizer(client),
+        min_new_messages=int(os.getenv("HISTORY_SUMMARY_MIN_NEW", "4"))
+    )
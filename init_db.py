@@ -84,15 +84,22 @@ def init_database():
             cursor.execute("""
                 CREATE TABLE IF NOT EXISTS audio_cache (
                     cache_key VARCHAR(255) PRIMARY KEY,
-                    audio_data BYTEA NOT NULL,
+                    audio_data BYTEA,
+                    reply_text TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            cursor.execute("ALTER TABLE audio_cache ADD COLUMN IF NOT EXISTS reply_text TEXT")
+            cursor.execute("ALTER TABLE audio_cache ALTER COLUMN audio_data DROP NOT NULL")
 
             # Crear índices para mejor rendimiento
             print("📝 Creando índices...")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_devices_user_id ON devices(user_id)")
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_session_id ON conversations(session_id)")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_conversations_session_created
+                ON conversations(session_id, created_at DESC, id DESC)
+            """)
             cursor.execute("CREATE INDEX IF NOT EXISTS idx_audio_cache_key ON audio_cache(cache_key)")
 
         conn.commit()
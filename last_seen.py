@@ -0,0 +1,86 @@
+"""
+Registro agrupado del último contacto (last_seen) de cada dispositivo.
+
+`touch` solo anota la hora en memoria; varias peticiones del mismo
+dispositivo entre dos volcados se funden en una sola actualización. Un
+bucle en segundo plano vuelca lo pendiente cada LAST_SEEN_FLUSH_S segundos
+en una única transacción (`executemany`) y `flush` se llama una última vez
+al apagar. Así la ruta de la petición no paga un commit (fsync) por
+registrar una marca de tiempo.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+log = logging.getLogger(__name__)
+
+# Mismo formato que CURRENT_TIMESTAMP de SQLite (UTC)
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class LastSeenTracker:
+    """Acumula marcas last_seen por dispositivo y las vuelca por lotes"""
+
+    def __init__(self, write_batch: Callable[[List[Tuple[str, str]]], None],
+                 interval_seconds: float = 5.0):
+        self.write_batch = write_batch
+        self.interval_seconds = interval_seconds
+        self._pending: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.touches = 0
+        self.flushes = 0
+        self.rows_written = 0
+
+    def touch(self, device_id: str):
+        self._pending[device_id] = time.time()
+        self.touches += 1
+
+    def flush(self) -> int:
+        """Escribir las marcas pendientes en una transacción; devuelve las filas"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        rows = [(time.strftime(TIMESTAMP_FORMAT, time.gmtime(ts)), device_id)
+                for device_id, ts in pending.items()]
+        try:
+            self.write_batch(rows)
+        except Exception:
+            # Devolver al buffer sin pisar marcas más recientes
+            with self._lock:
+                for device_id, ts in pending.items():
+                    if self._pending.get(device_id, 0) < ts:
+                        self._pending[device_id] = ts
+            raise
+
+        self.flushes += 1
+        self.rows_written += len(rows)
+        return len(rows)
+
+    async def run(self):
+        """Bucle de volcado periódico (se cancela al apagar)"""
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Error guardando last_seen")
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "touches": self.touches,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "interval_seconds": self.interval_seconds
+        }
+
+
+def create_tracker_from_env(write_batch: Callable[[List[Tuple[str, str]]], None]) -> LastSeenTracker:
+    """Crear el registro leyendo LAST_SEEN_FLUSH_S"""
+    return LastSeenTracker(write_batch, interval_seconds=float(os.getenv("LAST_SEEN_FLUSH_S", "5")))
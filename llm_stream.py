@@ -0,0 +1,161 @@
+"""
+Etapa LLM en streaming con métricas de latencia.
+
+`LLMStream.deltas` consume la API de Chat Completions con stream=True y
+devuelve un iterador asíncrono de fragmentos de texto, para que las etapas
+siguientes (corte en frases, TTS) empiecen con el primer token. Mide por
+sesión el tiempo hasta el primer token (TTFT) y los tokens por segundo, y
+aplica dos plazos: hasta el primer token y para la respuesta completa. Los
+plazos y las métricas solo cuentan el tiempo esperando a OpenAI, no el que
+el consumidor pasa suspendido entre fragmentos (TTS, envío al cliente).
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Dict, List, Optional
+
+from deadlines import StageTimeout
+from token_count import count_tokens
+
+
+class LLMStats:
+    """TTFT y tokens/s agregados y por sesión"""
+
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions
+        self.requests = 0
+        self.errors = 0
+        self._ttft_total = 0.0
+        self._tps_total = 0.0
+        self._sessions: "OrderedDict[str, dict]" = OrderedDict()
+
+    def record(self, session_id: str, ttft: float, tokens: int, total: float):
+        generation = total - ttft
+        tps = tokens / generation if generation > 0 else 0.0
+        self.requests += 1
+        self._ttft_total += ttft
+        self._tps_total += tps
+
+        session = self._sessions.pop(session_id, None) or {
+            "requests": 0, "ttft_total": 0.0, "tps_total": 0.0
+        }
+        session["requests"] += 1
+        session["ttft_total"] += ttft
+        session["tps_total"] += tps
+        session["last_ttft_ms"] = 1000 * ttft
+        session["last_tokens_per_s"] = tps
+        self._sessions[session_id] = session
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _summary(self, requests: int, ttft_total: float, tps_total: float) -> dict:
+        return {
+            "requests": requests,
+            "avg_ttft_ms": 1000 * ttft_total / requests if requests else 0.0,
+            "avg_tokens_per_s": tps_total / requests if requests else 0.0
+        }
+
+    def session(self, session_id: str) -> Optional[dict]:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        summary = self._summary(session["requests"], session["ttft_total"], session["tps_total"])
+        summary["last_ttft_ms"] = session["last_ttft_ms"]
+        summary["last_tokens_per_s"] = session["last_tokens_per_s"]
+        return summary
+
+    def stats(self) -> dict:
+        stats = self._summary(self.requests, self._ttft_total, self._tps_total)
+        stats["errors"] = self.errors
+        stats["sessions"] = {session_id: self.session(session_id) for session_id in self._sessions}
+        return stats
+
+
+class LLMStream:
+    """Cliente de Chat Completions en streaming con plazos y métricas"""
+
+    def __init__(self, client, model: str = "gpt-3.5-turbo", max_tokens: int = 100,
+                 temperature: float = 0.3, first_token_timeout: float = 4.0,
+                 total_timeout: float = 10.0):
+        self.client = client
+        self.model = model
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.first_token_timeout = first_token_timeout
+        self.total_timeout = total_timeout
+        self.stats = LLMStats()
+
+    async def deltas(self, messages: List[Dict[str, str]], session_id: str) -> AsyncIterator[str]:
+        """Fragmentos de texto de la respuesta según van llegando"""
+        waited = 0.0
+        ttft = None
+        parts = []
+        stream = None
+
+        def remaining() -> float:
+            limit = self.total_timeout if ttft is not None else min(self.total_timeout, self.first_token_timeout)
+            return max(0.0, limit - waited)
+
+        async def wait(awaitable):
+            # Solo cuenta contra el plazo el tiempo esperando al LLM
+            nonlocal waited
+            started = time.perf_counter()
+            try:
+                return await asyncio.wait_for(awaitable, timeout=remaining())
+            finally:
+                waited += time.perf_counter() - started
+
+        def timeout_error() -> StageTimeout:
+            if ttft is None:
+                return StageTimeout("llm_first_token", self.first_token_timeout)
+            return StageTimeout("llm", self.total_timeout)
+
+        try:
+            try:
+                stream = await wait(self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    stream=True
+                ))
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await wait(chunks.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        if ttft is None:
+                            ttft = waited
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            except asyncio.TimeoutError:
+                raise timeout_error() from None
+        except Exception:
+            self.stats.errors += 1
+            raise
+        finally:
+            if stream is not None:
+                await stream.close()
+
+        if ttft is not None:
+            self.stats.record(session_id, ttft, count_tokens("".join(parts)), waited)
+
+    async def complete(self, messages: List[Dict[str, str]], session_id: str) -> str:
+        """Respuesta completa (consumiendo igualmente el streaming)"""
+        return "".join([delta async for delta in self.deltas(messages, session_id)])
+
+
+def create_llm_from_env(client, first_token_timeout: float, total_timeout: float) -> LLMStream:
+    """Crear la etapa LLM leyendo LLM_MODEL, LLM_MAX_TOKENS y LLM_TEMPERATURE"""
+    return LLMStream(
+        client,
+        model=os.getenv("LLM_MODEL", "gpt-3.5-turbo"),
+        max_tokens=int(os.getenv("LLM_MAX_TOKENS", "100")),
+        temperature=float(os.getenv("LLM_TEMPERATURE", "0.3")),
+        first_token_timeout=first_token_timeout,
+        total_timeout=total_timeout
+    )
@@ -0,0 +1,258 @@
+"""
+Métricas del pipeline de voz en formato de texto de Prometheus.
+
+Las dos variantes de la API (api.py con SQLite y api/__init__.py con
+Postgres) comparten este módulo: histogramas de latencia por etapa
+(stt, cache, llm, tts, cache_save, total) y tipo de dispositivo, contadores
+de timeouts y errores, y métricas que se leen en el momento del scrape a
+partir de los `.stats()` que ya existen (colas de STT, cachés, peticiones en
+curso), expuestas en GET /metrics.
+
+Coste bajo: observar es un bisect sobre ~12 cubetas y unas sumas en un
+diccionario, sin locks; todas las observaciones se hacen desde el event loop.
+Los valores de las etiquetas se limitan a `max_series` combinaciones por
+métrica (el resto va a "other"), porque device_type lo envía el cliente.
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[str, ...]
+CollectResult = Union[float, Dict[Labels, float]]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 max_series: int = 200):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+
+    def _labels(self, labels: dict) -> Labels:
+        return tuple(str(labels.get(name) or "unknown") for name in self.labelnames)
+
+    def _series_key(self, series: dict, labels: dict) -> Labels:
+        key = self._labels(labels)
+        if key not in series and len(series) >= self.max_series:
+            key = ("other",) * len(self.labelnames)
+        return key
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._series_key(self._values, labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._labels(labels), 0.0)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS, max_series: int = 200):
+        super().__init__(name, documentation, labelnames, max_series)
+        self.buckets = tuple(sorted(buckets))
+        # Por serie: [cuentas por cubeta (no acumuladas) + desbordamiento, suma]
+        self._series: Dict[Labels, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._series_key(self._series, labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total) in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Collected(_Metric):
+    """Métrica leída en cada scrape con una función (p. ej. de un `.stats()`)"""
+
+    def __init__(self, name: str, documentation: str, kind: str,
+                 collect: Callable[[], CollectResult], labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        try:
+            result = self.collect()
+        except Exception:
+            return []
+        values = result if isinstance(result, dict) else {(): result}
+        lines = self.header()
+        for key, value in values.items():
+            if value is None:
+                continue
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        # Registrar dos veces el mismo nombre (p. ej. al recargar) sustituye la anterior
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def gauge_func(self, name: str, documentation: str, collect: Callable[[], CollectResult],
+                   labelnames: Sequence[str] = ()) -> Collected:
+        return self._register(Collected(name, documentation, "gauge", collect, labelnames))
+
+    def counter_func(self, name: str, documentation: str, collect: Callable[[], CollectResult],
+                     labelnames: Sequence[str] = ()) -> Collected:
+        return self._register(Collected(name, documentation, "counter", collect, labelnames))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "plushie_stage_seconds", "Latencia de cada etapa del pipeline de voz",
+    ("stage", "device_type")
+)
+REQUESTS = REGISTRY.counter(
+    "plushie_requests_total", "Turnos de voz procesados por resultado",
+    ("device_type", "outcome")
+)
+TIMEOUTS = REGISTRY.counter(
+    "plushie_timeouts_total", "Etapas que superaron su plazo", ("stage",)
+)
+ERRORS = REGISTRY.counter(
+    "plushie_errors_total", "Errores por etapa", ("stage",)
+)
+
+
+def device_type_of(device_info: Optional[dict]) -> str:
+    """Etiqueta device_type normalizada a partir del perfil del dispositivo"""
+    device_type = device_info.get("device_type") if device_info else None
+    return str(device_type).strip().lower()[:32] if device_type else "unknown"
+
+
+def observe_stage(stage: str, seconds: float, device_type: str = "unknown"):
+    STAGE_SECONDS.observe(seconds, stage=stage, device_type=device_type)
+
+
+def record_timeout(error: BaseException):
+    TIMEOUTS.inc(stage=getattr(error, "stage", "unknown"))
+
+
+def record_error(stage: str):
+    ERRORS.inc(stage=stage)
+
+
+@contextmanager
+def track_stage(stage: str, device_type: str = "unknown", expected: Iterable[type] = ()):
+    """Medir una etapa y contar su timeout o error; `expected` no cuenta como error"""
+    expected = tuple(expected)
+    start = time.perf_counter()
+    try:
+        yield
+    except asyncio.TimeoutError as e:
+        TIMEOUTS.inc(stage=getattr(e, "stage", stage))
+        raise
+    except Exception as e:
+        if not isinstance(e, expected):
+            record_error(stage)
+        raise
+    finally:
+        observe_stage(stage, time.perf_counter() - start, device_type)
+
+
+def _lookups(stats: dict) -> Dict[Labels, float]:
+    return {("hit",): stats["hits"], ("miss",): stats["misses"]}
+
+
+def register_pipeline_collectors(stt_pool, stt_batcher, inflight, response_cache,
+                                 tts_cache, profile_cache):
+    """Exponer colas y aciertos de caché de los componentes de cada backend"""
+    REGISTRY.gauge_func("plushie_stt_pending", "Transcripciones en curso o en cola en el pool de STT",
+                        lambda: stt_pool.pending)
+    REGISTRY.gauge_func("plushie_stt_batch_queued", "Clips esperando a formar lote de STT",
+                        lambda: stt_batcher.stats()["queued"])
+    REGISTRY.gauge_func("plushie_inflight_requests", "Peticiones deduplicadas en curso",
+                        lambda: inflight.stats()["in_flight"])
+
+    def response_cache_lookups():
+        stats = response_cache.stats()
+        return {("exact_hit",): stats["exact_hits"], ("similar_hit",): stats["similar_hits"],
+                ("miss",): stats["misses"]}
+
+    REGISTRY.counter_func("plushie_response_cache_lookups_total", "Búsquedas en la caché de respuestas",
+                          response_cache_lookups, ("result",))
+    REGISTRY.counter_func("plushie_tts_cache_lookups_total", "Búsquedas en la caché de audio TTS",
+                          lambda: _lookups(tts_cache.stats()), ("result",))
+    REGISTRY.counter_func("plushie_profile_cache_lookups_total", "Búsquedas en la caché de perfiles",
+                          lambda: _lookups(profile_cache.stats()), ("result",))
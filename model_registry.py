@@ -0,0 +1,106 @@
+"""
+Registro de modelos Whisper compartido por todo el proceso.
+
+Cada tamaño de modelo (y cada réplica, una por worker de STT) se carga una
+sola vez y se reutiliza en todas las peticiones. El tamaño por defecto se
+elige por despliegue con la variable de entorno WHISPER_MODEL.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+_models: Dict[Tuple[str, int], Any] = {}
+_stats: Dict[Tuple[str, int], Dict[str, Any]] = {}
+_lock = threading.Lock()
+
+
+def default_model_size() -> str:
+    """Tamaño configurado para este despliegue (se lee al usarlo, tras load_dotenv)"""
+    return os.getenv("WHISPER_MODEL", "tiny")
+
+
+def _rss_bytes() -> int:
+    """Memoria residente actual del proceso"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # Fallback (macOS/otros): pico de memoria, no el valor actual
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _param_bytes(model) -> int:
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+    except Exception:
+        return 0
+
+
+def get_model(size: Optional[str] = None, replica: int = 0):
+    """Obtener el modelo Whisper de un tamaño, cargándolo solo la primera vez"""
+    size = size or default_model_size()
+    key = (size, replica)
+
+    model = _models.get(key)
+    if model is not None:
+        return model
+
+    # Las cargas se serializan para no duplicar picos de memoria
+    with _lock:
+        model = _models.get(key)
+        if model is not None:
+            return model
+
+        import whisper
+
+        rss_before = _rss_bytes()
+        load_start = time.time()
+        model = whisper.load_model(size)
+        load_time = time.time() - load_start
+        rss_after = _rss_bytes()
+
+        _models[key] = model
+        _stats[key] = {
+            "size": size,
+            "replica": replica,
+            "device": str(getattr(model, "device", "cpu")),
+            "load_seconds": round(load_time, 3),
+            "param_bytes": _param_bytes(model),
+            "rss_delta_bytes": max(0, rss_after - rss_before),
+            "warmup_seconds": None
+        }
+        log.info("Modelo Whisper '%s' (réplica %d) cargado en %.2fs, RSS +%.0f MB",
+                 size, replica, load_time, (rss_after - rss_before) / 1e6)
+        return model
+
+
+def warmup(size: Optional[str] = None, replica: int = 0) -> float:
+    """Cargar el modelo y ejecutar una inferencia de prueba con 1 s de silencio"""
+    import numpy as np
+
+    size = size or default_model_size()
+    model = get_model(size, replica)
+
+    warm_start = time.time()
+    model.transcribe(np.zeros(16000, dtype=np.float32), language="es",
+                     fp16=model.device.type == "cuda")
+    warm_time = time.time() - warm_start
+
+    _stats[(size, replica)]["warmup_seconds"] = round(warm_time, 3)
+    log.info("Modelo Whisper '%s' (réplica %d) calentado en %.2fs", size, replica, warm_time)
+    return warm_time
+
+
+def model_stats() -> list:
+    """Tiempos de carga y memoria de los modelos cargados"""
+    return [dict(stats) for stats in _stats.values()]
@@ -0,0 +1,110 @@
+"""
+Pool de conexiones asíncrono para PostgreSQL (psycopg 3 + psycopg_pool).
+
+Las conexiones se abren una vez y se reutilizan entre peticiones, así un
+turno de conversación no paga varios handshakes TCP+auth. Cada conexión se
+comprueba al sacarla del pool, y psycopg prepara en el servidor las
+consultas que se repiten (DB_PREPARE_THRESHOLD; "none" lo desactiva, p. ej.
+detrás de PgBouncer en modo transacción).
+
+Configuración:
+  - DB_POOL_MIN / DB_POOL_MAX: tamaño del pool
+  - DB_POOL_TIMEOUT: segundos máximos esperando una conexión libre
+  - DB_POOL_MAX_IDLE: segundos antes de cerrar conexiones ociosas sobrantes
+"""
+
+import os
+import time
+from typing import Any, Optional, Sequence
+
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+
+class PostgresPool:
+    """Pool compartido con helpers de consulta y métricas"""
+
+    def __init__(self, conninfo: str, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_idle: float = 300.0,
+                 prepare_threshold: Optional[int] = 1):
+        self.pool = AsyncConnectionPool(
+            conninfo,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=timeout,
+            max_idle=max_idle,
+            open=False,
+            name="plushie-pg",
+            check=AsyncConnectionPool.check_connection,
+            kwargs={"row_factory": dict_row, "prepare_threshold": prepare_threshold}
+        )
+        self.queries = 0
+        self.errors = 0
+        self.query_seconds = 0.0
+
+    async def open(self, wait_seconds: float = 10.0):
+        """Abrir el pool y esperar a tener min_size conexiones"""
+        await self.pool.open(wait=True, timeout=wait_seconds)
+
+    async def close(self):
+        await self.pool.close()
+
+    def connection(self):
+        """Conexión del pool; hace commit al salir del bloque sin errores"""
+        return self.pool.connection()
+
+    async def _run(self, query: str, params: Optional[Sequence[Any]], fetch: Optional[str]):
+        start = time.perf_counter()
+        try:
+            async with self.pool.connection() as conn:
+                cursor = await conn.execute(query, params)
+                if fetch == "one":
+                    return await cursor.fetchone()
+                if fetch == "all":
+                    return await cursor.fetchall()
+                return cursor.rowcount
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.queries += 1
+            self.query_seconds += time.perf_counter() - start
+
+    async def fetchone(self, query: str, params: Optional[Sequence[Any]] = None):
+        return await self._run(query, params, "one")
+
+    async def fetchall(self, query: str, params: Optional[Sequence[Any]] = None):
+        return await self._run(query, params, "all")
+
+    async def execute(self, query: str, params: Optional[Sequence[Any]] = None) -> int:
+        return await self._run(query, params, None)
+
+    def stats(self) -> dict:
+        stats = self.pool.get_stats()
+        stats.update({
+            "queries": self.queries,
+            "query_errors": self.errors,
+            "avg_query_ms": 1000 * self.query_seconds / self.queries if self.queries else 0.0
+        })
+        return stats
+
+
+def _prepare_threshold_from_env() -> Optional[int]:
+    value = os.getenv("DB_PREPARE_THRESHOLD", "1")
+    return None if value.lower() == "none" else int(value)
+
+
+def create_db_pool_from_env(conninfo: Optional[str] = None) -> Optional[PostgresPool]:
+    """Crear el pool (sin abrir) desde DATABASE_URL; None si no hay base de datos"""
+    conninfo = conninfo or os.getenv("DATABASE_URL")
+    if not conninfo:
+        return None
+
+    return PostgresPool(
+        conninfo,
+        min_size=int(os.getenv("DB_POOL_MIN", "1")),
+        max_size=int(os.getenv("DB_POOL_MAX", "10")),
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", "5")),
+        max_idle=float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+        prepare_threshold=_prepare_threshold_from_env()
+    )
@@ -0,0 +1,160 @@
+"""
+Caché en memoria de perfiles de dispositivo (dispositivo + usuario).
+
+Cada enunciado necesita el perfil del dispositivo para construir el system
+prompt, y los perfiles casi nunca cambian: se guardan por device_id con un
+TTL y los endpoints de escritura los invalidan explícitamente. También se
+cachean los dispositivos no registrados (perfil None) para no consultar la
+base de datos en cada turno.
+
+Una invalidación que llega mientras se está cargando el perfil (p. ej. un
+cambio de alias durante la consulta a Postgres) hace que el resultado de esa
+carga no se guarde: cada invalidación anota una generación por dispositivo o
+usuario, y la carga solo se cachea si no hubo ninguna posterior a su inicio.
+
+La caché es por proceso: con varios workers, los demás ven el cambio como
+mucho PROFILE_CACHE_TTL_S segundos después.
+"""
+
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Set, Tuple
+
+_MISSING = object()
+
+
+class ProfileCache:
+    """Perfiles por device_id con TTL e índice usuario -> dispositivos"""
+
+    def __init__(self, ttl_seconds: float = 300.0, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: Dict[str, Tuple[float, Optional[dict]]] = {}
+        self._user_devices: Dict[int, Set[str]] = {}
+        self._lock = threading.Lock()
+        # Generación de la última invalidación por dispositivo/usuario; solo
+        # hace falta mientras hay cargas en curso
+        self._generation = 0
+        self._device_generations: Dict[str, int] = {}
+        self._user_generations: Dict[int, int] = {}
+        self._loading = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, device_id: str):
+        """Perfil cacheado (puede ser None) o _MISSING si no está o caducó"""
+        entry = self._entries.get(device_id)
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self.hits += 1
+        return entry[1]
+
+    def put(self, device_id: str, profile: Optional[dict]):
+        with self._lock:
+            self._forget(device_id)
+            if len(self._entries) >= self.max_entries:
+                self._purge_expired()
+            if len(self._entries) >= self.max_entries:
+                return
+
+            self._entries[device_id] = (time.monotonic() + self.ttl_seconds, profile)
+            user_id = profile.get("user_id") if profile else None
+            if user_id is not None:
+                self._user_devices.setdefault(user_id, set()).add(device_id)
+
+    def _forget(self, device_id: str):
+        entry = self._entries.pop(device_id, None)
+        user_id = entry[1].get("user_id") if entry and entry[1] else None
+        if user_id is not None:
+            devices = self._user_devices.get(user_id)
+            if devices:
+                devices.discard(device_id)
+                if not devices:
+                    del self._user_devices[user_id]
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for device_id in [d for d, (expires, _) in self._entries.items() if expires < now]:
+            self._forget(device_id)
+
+    def invalidate_device(self, device_id: str):
+        with self._lock:
+            self._forget(device_id)
+            self.invalidations += 1
+            if self._loading:
+                self._generation += 1
+                self._device_generations[device_id] = self._generation
+
+    def invalidate_user(self, user_id: int):
+        """Invalidar todos los dispositivos de un usuario (p. ej. al cambiar su alias)"""
+        with self._lock:
+            for device_id in list(self._user_devices.get(user_id, ())):
+                self._forget(device_id)
+            self.invalidations += 1
+            if self._loading:
+                self._generation += 1
+                self._user_generations[user_id] = self._generation
+
+    def _begin_load(self) -> int:
+        with self._lock:
+            self._loading += 1
+            return self._generation
+
+    def _end_load(self, started: int, device_id: str, profile) -> bool:
+        """True si el dispositivo o su usuario se invalidaron durante la carga"""
+        with self._lock:
+            self._loading -= 1
+            user_id = profile.get("user_id") if isinstance(profile, dict) else None
+            invalidated = (self._device_generations.get(device_id, -1) > started
+                           or self._user_generations.get(user_id, -1) > started)
+            if not self._loading:
+                self._device_generations.clear()
+                self._user_generations.clear()
+            return invalidated
+
+    def get_or_load(self, device_id: str, loader: Callable[[str], Optional[dict]]) -> Optional[dict]:
+        profile = self.get(device_id)
+        if profile is _MISSING:
+            started = self._begin_load()
+            try:
+                profile = loader(device_id)
+            finally:
+                invalidated = self._end_load(started, device_id, profile)
+            if not invalidated:
+                self.put(device_id, profile)
+        return profile
+
+    async def get_or_load_async(self, device_id: str,
+                                loader: Callable[[str], Awaitable[Optional[dict]]]) -> Optional[dict]:
+        profile = self.get(device_id)
+        if profile is _MISSING:
+            started = self._begin_load()
+            try:
+                profile = await loader(device_id)
+            finally:
+                invalidated = self._end_load(started, device_id, profile)
+            if not invalidated:
+                self.put(device_id, profile)
+        return profile
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations
+        }
+
+
+def create_profile_cache_from_env() -> ProfileCache:
+    """Crear la caché leyendo PROFILE_CACHE_TTL_S y PROFILE_CACHE_MAX_ENTRIES"""
+    return ProfileCache(
+        ttl_seconds=float(os.getenv("PROFILE_CACHE_TTL_S", "300")),
+        max_entries=int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "10000"))
+    )
@@ -0,0 +1,123 @@
+"""
+Plantillas del system prompt, compartidas por los backends SQLite y PostgreSQL.
+
+Los prompts personalizados admiten los marcadores {user_name}, {location},
+{device_name} y {ai_alias}. Cada plantilla se analiza una sola vez y el
+prompt ya renderizado se memoriza por (dispositivo, versión del perfil),
+donde la versión son los propios valores que entran en el prompt: cualquier
+cambio en el perfil produce una clave nueva. El resultado incluye su número
+de tokens para presupuestar el historial.
+"""
+
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Tuple
+
+from token_count import count_tokens
+
+PLACEHOLDERS = ("user_name", "location", "device_name", "ai_alias")
+
+DEFAULT_TEMPLATE = (
+    "Eres {ai_alias}, un asistente virtual personal para {user_name}.\n"
+    "Estás ubicado en {location} y eres el dispositivo llamado {device_name}.\n"
+    "Responde de manera clara, directa y útil en español.\n"
+    "Dirígete a {user_name} de manera personal y natural.\n"
+    "Evita explicaciones largas y ve al grano.\n"
+    "Si conoces información personal de {user_name}, úsala para hacer respuestas más relevantes."
+)
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class InvalidTemplateError(ValueError):
+    pass
+
+
+class PromptTemplate:
+    """Plantilla analizada en trozos literales y marcadores"""
+
+    def __init__(self, text: str):
+        self.text = text
+        # Lista de (literal, marcador o None)
+        self.parts: List[Tuple[str, Optional[str]]] = []
+        self.unknown: List[str] = []
+
+        position = 0
+        for match in _PLACEHOLDER.finditer(text):
+            name = match.group(1)
+            if name not in PLACEHOLDERS:
+                # Marcadores desconocidos se dejan tal cual, como antes
+                self.unknown.append(name)
+                continue
+            self.parts.append((text[position:match.start()], name))
+            position = match.end()
+        self.parts.append((text[position:], None))
+
+    def render(self, **values: str) -> str:
+        return "".join(literal + (values[name] if name else "") for literal, name in self.parts)
+
+
+@lru_cache(maxsize=256)
+def compile_template(text: str) -> PromptTemplate:
+    return PromptTemplate(text)
+
+
+def validate_template(text: str):
+    """Rechazar prompts personalizados con marcadores desconocidos"""
+    unknown = compile_template(text).unknown
+    if unknown:
+        raise InvalidTemplateError(
+            f"Marcadores desconocidos: {', '.join('{' + name + '}' for name in unknown)}. "
+            f"Disponibles: {', '.join('{' + name + '}' for name in PLACEHOLDERS)}"
+        )
+
+
+class SystemPrompt(NamedTuple):
+    text: str
+    tokens: int
+
+
+class PromptRenderer:
+    """Renderiza y memoriza el system prompt de cada dispositivo"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._rendered: "OrderedDict[tuple, SystemPrompt]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def render(self, device_info: Optional[dict], session_id: str) -> SystemPrompt:
+        """System prompt del dispositivo con los datos actuales de su perfil"""
+        info = device_info or {}
+        values = {
+            "user_name": info.get("user_name") or "usuario",
+            "location": info.get("location") or "esta ubicación",
+            "device_name": info.get("device_name") or session_id,
+            "ai_alias": info.get("user_ai_alias") or "Asistente",
+        }
+        template_text = info.get("user_custom_prompt") or DEFAULT_TEMPLATE
+        key = (session_id, template_text, *values.values())
+
+        with self._lock:
+            prompt = self._rendered.get(key)
+            if prompt is not None:
+                self._rendered.move_to_end(key)
+                return prompt
+
+        text = compile_template(template_text).render(**values)
+        prompt = SystemPrompt(text, count_tokens(text))
+
+        with self._lock:
+            self._rendered[key] = prompt
+            while len(self._rendered) > self.max_entries:
+                self._rendered.popitem(last=False)
+        return prompt
+
+
+# Instancia compartida por proceso
+prompt_renderer = PromptRenderer()
+
+
+def render_system_prompt(device_info: Optional[dict], session_id: str) -> SystemPrompt:
+    return prompt_renderer.render(device_info, session_id)
@@ -0,0 +1,189 @@
+"""
+Caché de respuestas por transcripción normalizada y ámbito de usuario.
+
+Whisper devuelve la misma pregunta con distinta puntuación, mayúsculas o
+espacios ("¿Cómo te llamas?" / " como te llamas"), así que la clave se
+calcula sobre el texto normalizado: sin acentos, sin puntuación, en
+minúsculas y con los espacios colapsados.
+
+Opcionalmente (RESPONSE_CACHE_SIMILARITY > 0) también se aceptan casi
+duplicados: cada transcripción se representa con un vector de n-gramas de
+caracteres (hashing trick, sin modelos ni red) y se busca la más parecida
+del mismo ámbito por similitud coseno.
+
+El ámbito es el usuario del dispositivo (o el propio dispositivo si no tiene
+usuario) más un hash del system prompt, para que las respuestas
+personalizadas no se compartan entre usuarios y caduquen al cambiar el
+perfil. Las respuestas se guardan en la tabla de caché de cada backend; aquí
+solo se calculan claves y se mantiene el índice de similitud en memoria.
+"""
+
+import hashlib
+import os
+import re
+import unicodedata
+import zlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import numpy as np
+
+_NON_WORD = re.compile(r"[^\w\s]+")
+_WHITESPACE = re.compile(r"\s+")
+
+EMBEDDING_DIM = 512
+NGRAM = 3
+
+
+def normalize_transcript(text: str) -> str:
+    """Quitar acentos, puntuación, mayúsculas y espacios sobrantes"""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    text = _NON_WORD.sub(" ", text.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def embed(normalized: str) -> np.ndarray:
+    """Vector normalizado de n-gramas de caracteres"""
+    vector = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+    padded = f" {normalized} "
+    for i in range(max(1, len(padded) - NGRAM + 1)):
+        vector[zlib.crc32(padded[i:i + NGRAM].encode("utf-8")) % EMBEDDING_DIM] += 1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class _ScopeIndex:
+    """Transcripciones normalizadas de un ámbito y sus vectores"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.texts: List[str] = []
+        self.vectors = np.zeros((capacity, EMBEDDING_DIM), dtype=np.float32)
+        self._next = 0
+
+    def add(self, normalized: str):
+        if normalized in self.texts:
+            return
+        # Búfer circular: se sustituye la entrada más antigua
+        if len(self.texts) < self.capacity:
+            self.texts.append(normalized)
+            slot = len(self.texts) - 1
+        else:
+            slot = self._next
+            self.texts[slot] = normalized
+            self._next = (self._next + 1) % self.capacity
+        self.vectors[slot] = embed(normalized)
+
+    def nearest(self, normalized: str) -> Tuple[Optional[str], float]:
+        if not self.texts:
+            return None, 0.0
+        scores = self.vectors[:len(self.texts)] @ embed(normalized)
+        best = int(np.argmax(scores))
+        return self.texts[best], float(scores[best])
+
+
+class ResponseCache:
+    """Claves de caché normalizadas por ámbito con búsqueda de casi duplicados"""
+
+    def __init__(self, similarity_threshold: float = 0.0, entries_per_scope: int = 256,
+                 max_scopes: int = 1000):
+        self.similarity_threshold = similarity_threshold
+        self.entries_per_scope = entries_per_scope
+        self.max_scopes = max_scopes
+        self._indexes: "OrderedDict[str, _ScopeIndex]" = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def scope(device_info: Optional[dict], session_id: str, system_prompt: str) -> str:
+        """Ámbito: usuario (o dispositivo) + versión del system prompt"""
+        user_id = device_info.get("user_id") if device_info else None
+        owner = f"user:{user_id}" if user_id is not None else f"device:{session_id}"
+        prompt_hash = hashlib.sha256(system_prompt.encode("utf-8")).hexdigest()[:12]
+        return f"{owner}:{prompt_hash}"
+
+    @staticmethod
+    def _key(scope: str, normalized: str) -> str:
+        return f"{scope}:{hashlib.sha256(normalized.encode('utf-8')).hexdigest()[:32]}"
+
+    def key(self, scope: str, text: str) -> str:
+        """Clave exacta con la que guardar la respuesta a `text`"""
+        return self._key(scope, normalize_transcript(text))
+
+    def _similar(self, scope: str, normalized: str) -> Optional[str]:
+        if self.similarity_threshold <= 0 or scope not in self._indexes:
+            return None
+        match, score = self._indexes[scope].nearest(normalized)
+        if match is None or match == normalized or score < self.similarity_threshold:
+            return None
+        return match
+
+    def lookup(self, scope: str, text: str, get: Callable[[str], object]):
+        """Respuesta cacheada exacta o, si no hay, la del casi duplicado más cercano"""
+        normalized = normalize_transcript(text)
+        cached = get(self._key(scope, normalized))
+        if cached:
+            self.exact_hits += 1
+            return cached
+
+        similar = self._similar(scope, normalized)
+        if similar is not None:
+            cached = get(self._key(scope, similar))
+            if cached:
+                self.similar_hits += 1
+                return cached
+
+        self.misses += 1
+        return None
+
+    async def lookup_async(self, scope: str, text: str, get: Callable[[str], Awaitable[object]]):
+        normalized = normalize_transcript(text)
+        cached = await get(self._key(scope, normalized))
+        if cached:
+            self.exact_hits += 1
+            return cached
+
+        similar = self._similar(scope, normalized)
+        if similar is not None:
+            cached = await get(self._key(scope, similar))
+            if cached:
+                self.similar_hits += 1
+                return cached
+
+        self.misses += 1
+        return None
+
+    def remember(self, scope: str, text: str):
+        """Añadir la transcripción al índice de similitud tras guardar su respuesta"""
+        if self.similarity_threshold <= 0:
+            return
+        index = self._indexes.pop(scope, None) or _ScopeIndex(self.entries_per_scope)
+        index.add(normalize_transcript(text))
+        self._indexes[scope] = index
+        while len(self._indexes) > self.max_scopes:
+            self._indexes.popitem(last=False)
+
+    def forget(self, scope: str):
+        """Olvidar el índice de similitud de un ámbito (p. ej. al borrar la sesión)"""
+        self._indexes.pop(scope, None)
+
+    def stats(self) -> dict:
+        lookups = self.exact_hits + self.similar_hits + self.misses
+        return {
+            "exact_hits": self.exact_hits,
+            "similar_hits": self.similar_hits,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.similar_hits) / lookups if lookups else 0.0,
+            "similarity_threshold": self.similarity_threshold,
+            "indexed_scopes": len(self._indexes)
+        }
+
+
+def create_response_cache_from_env() -> ResponseCache:
+    """Crear la caché leyendo RESPONSE_CACHE_SIMILARITY (0 desactiva los casi duplicados)"""
+    return ResponseCache(
+        similarity_threshold=float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0")),
+        entries_per_scope=int(os.getenv("RESPONSE_CACHE_ENTRIES_PER_SCOPE", "256"))
+    )
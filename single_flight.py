@@ -0,0 +1,89 @@
+"""
+Deduplicación de peticiones en curso (single-flight) y reintentos idempotentes.
+
+`SingleFlight.do(key, fn)` ejecuta `fn` una sola vez por clave: las llamadas
+concurrentes con la misma clave esperan el mismo futuro en lugar de repetir
+STT, LLM y TTS (p. ej. un ESP32 que reintenta tras un timeout de Wi‑Fi).
+Con `remember_seconds` el resultado se conserva además durante ese tiempo,
+de modo que un reintento con la misma cabecera Idempotency-Key recibe la
+misma respuesta sin volver a pagarla. Los errores no se recuerdan, ni los
+resultados que `remember_if` rechaza (p. ej. un audio de disculpa tras un
+timeout: el reintento debe volver a ejecutar el turno).
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Coalesce llamadas concurrentes por clave y recuerda resultados recientes"""
+
+    def __init__(self, max_remembered: int = 1000):
+        self.max_remembered = max_remembered
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self._done: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self.calls = 0
+        self.coalesced = 0
+        self.replayed = 0
+
+    def _recall(self, key: Hashable):
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._done[key]
+            return None
+        return entry
+
+    def _remember(self, key: Hashable, result, seconds: float):
+        self._done[key] = (time.monotonic() + seconds, result)
+        self._done.move_to_end(key)
+        while len(self._done) > self.max_remembered:
+            self._done.popitem(last=False)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]],
+                 remember_seconds: float = 0.0,
+                 remember_if: Optional[Callable[[T], bool]] = None) -> T:
+        self.calls += 1
+        entry = self._recall(key)
+        if entry is not None:
+            self.replayed += 1
+            return entry[1]
+
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+
+            def done(finished: asyncio.Future):
+                self._inflight.pop(key, None)
+                if remember_seconds <= 0 or finished.cancelled() or finished.exception() is not None:
+                    return
+                if remember_if is None or remember_if(finished.result()):
+                    self._remember(key, finished.result(), remember_seconds)
+
+            future.add_done_callback(done)
+
+        # shield: si un cliente se desconecta no se cancela el trabajo de los demás
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "replayed": self.replayed,
+            "in_flight": len(self._inflight),
+            "remembered": len(self._done)
+        }
+
+
+def idempotency_ttl_from_env() -> float:
+    """Segundos que se recuerda una respuesta por Idempotency-Key"""
+    return float(os.getenv("IDEMPOTENCY_TTL_S", "120"))
@@ -0,0 +1,199 @@
+"""
+Transcripción incremental para audio que llega por WebSocket.
+
+El dispositivo envía tramas PCM int16 mono a 16 kHz mientras graba. Las
+tramas se copian a un buffer float32 preasignado (máximo 30 s, la ventana de
+Whisper), se emiten transcripciones parciales periódicas y la transcripción
+final se lanza en cuanto se detecta el fin de la voz, sin esperar a que el
+dispositivo termine de subir un archivo completo. El fin de la voz usa el
+mismo umbral adaptativo que vad.py: la voz empieza cuando la trama más
+fuerte supera en el factor de ruido a la más silenciosa vista hasta ahora, y
+termina tras `silence_ms` por debajo del umbral relativo al pico.
+
+Protocolo (ws://host/ws/process/{session_id}):
+  cliente -> servidor: bytes  = PCM int16 little-endian, mono, 16 kHz
+                       texto  = "end" para forzar el cierre del enunciado
+  servidor -> cliente: {"type": "partial", "text": ...}
+                       {"type": "final", "text": ...}
+                       bytes  = audio de respuesta
+                       {"type": "done"} / {"type": "error", "error": ...}
+"""
+
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional
+
+import numpy as np
+
+from deadlines import run_stage
+from stt_worker import STTBusyError
+from vad import FRAME_MS, EnergyVAD, frame_rms
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = SAMPLE_RATE * FRAME_MS // 1000
+MAX_SECONDS = 30
+
+
+class StreamingTranscriber:
+    """Buffer de audio con detección de fin de voz y transcripción parcial"""
+
+    def __init__(self, transcribe: Callable[[np.ndarray], Awaitable[dict]],
+                 silence_ms: int = 700, energy_threshold: float = 0.001,
+                 partial_interval_s: float = 1.0, vad: Optional[EnergyVAD] = None,
+                 final_deadline: Optional[float] = None):
+        self._transcribe = transcribe
+        self.final_deadline = final_deadline
+        self.vad = vad or EnergyVAD(energy_threshold=energy_threshold)
+        self.silence_frames = max(1, silence_ms // FRAME_MS)
+        self.energy_threshold = energy_threshold
+        self.partial_interval = int(partial_interval_s * SAMPLE_RATE)
+        self._buffer = np.zeros(MAX_SECONDS * SAMPLE_RATE, dtype=np.float32)
+        self._pending_byte = b""
+        self.reset()
+
+    def reset(self):
+        self._length = 0
+        self._vad_pos = 0
+        self._speech_started = False
+        self._silent_frames = 0
+        self._noise_floor = float("inf")
+        self._peak = 0.0
+        self._last_partial_at = 0
+        self._pending_byte = b""
+
+    @property
+    def duration(self) -> float:
+        return self._length / SAMPLE_RATE
+
+    @property
+    def is_full(self) -> bool:
+        return self._length >= len(self._buffer)
+
+    def feed(self, pcm: bytes) -> bool:
+        """Añadir PCM int16; devuelve True si se detectó el fin de la voz"""
+        # Las tramas pueden partir una muestra de 2 bytes
+        if self._pending_byte:
+            pcm = self._pending_byte + pcm
+            self._pending_byte = b""
+        if len(pcm) % 2:
+            self._pending_byte = pcm[-1:]
+            pcm = pcm[:-1]
+
+        samples = np.frombuffer(pcm, dtype="<i2")
+        n = min(len(samples), len(self._buffer) - self._length)
+        np.multiply(samples[:n], 1.0 / 32768.0,
+                    out=self._buffer[self._length:self._length + n], casting="unsafe")
+        self._length += n
+
+        return self._update_vad() or self.is_full
+
+    def _update_vad(self) -> bool:
+        n_frames = (self._length - self._vad_pos) // FRAME_SAMPLES
+        if n_frames == 0:
+            return False
+
+        end = self._vad_pos + n_frames * FRAME_SAMPLES
+        rms = frame_rms(self._buffer[self._vad_pos:end], FRAME_SAMPLES)
+        self._vad_pos = end
+
+        noise_factor = self.vad.noise_factor
+        for frame in rms.tolist():
+            self._noise_floor = min(self._noise_floor, frame)
+            self._peak = max(self._peak, frame)
+            if not self._speech_started:
+                # La voz puede llegar desde la primera trama: se confirma en cuanto
+                # aparece una trama más silenciosa que la deja por encima del ruido
+                if self._peak < max(self.energy_threshold, noise_factor * self._noise_floor):
+                    continue
+                self._speech_started = True
+            if frame >= self.vad.threshold(self._noise_floor, self._peak):
+                self._silent_frames = 0
+            else:
+                self._silent_frames += 1
+
+        return self._speech_started and self._silent_frames >= self.silence_frames
+
+    def wants_partial(self) -> bool:
+        return self._speech_started and self._length - self._last_partial_at >= self.partial_interval
+
+    async def partial(self) -> Optional[str]:
+        """Transcripción provisional del audio recibido hasta ahora"""
+        self._last_partial_at = self._length
+        try:
+            result = await self._transcribe(self._buffer[:self._length].copy())
+        except STTBusyError:
+            # Las parciales son opcionales: si el pool está lleno se omiten
+            return None
+        return result["text"]
+
+    async def finalize(self) -> str:
+        """Transcripción final del enunciado; deja el buffer listo para el siguiente
+
+        Con `final_deadline` la transcripción tiene el mismo plazo que la etapa
+        STT del pipeline HTTP y lanza StageTimeout("stt") si lo supera.
+        """
+        audio = self._buffer[:self._length].copy()
+        self.reset()
+
+        # Recortar silencios; un enunciado sin voz no llega a Whisper. Con "end"
+        # la voz puede no haberse confirmado aún (sin trama silenciosa de referencia)
+        vad = self.vad.trim(audio, SAMPLE_RATE)
+        if not vad.has_speech:
+            return ""
+        if self.final_deadline is None:
+            result = await self._transcribe(vad.audio)
+        else:
+            result = await run_stage("stt", self._transcribe(vad.audio), self.final_deadline)
+        return result["text"]
+
+
+def create_transcriber_from_env(transcribe: Callable[[np.ndarray], Awaitable[dict]],
+                                vad: Optional[EnergyVAD] = None,
+                                final_deadline: Optional[float] = None) -> StreamingTranscriber:
+    """Crear el transcriptor leyendo STREAM_SILENCE_MS, STREAM_ENERGY_THRESHOLD y STREAM_PARTIAL_S"""
+    return StreamingTranscriber(
+        transcribe,
+        silence_ms=int(os.getenv("STREAM_SILENCE_MS", "700")),
+        energy_threshold=float(os.getenv("STREAM_ENERGY_THRESHOLD", "0.001")),
+        partial_interval_s=float(os.getenv("STREAM_PARTIAL_S", "1.0")),
+        vad=vad,
+        final_deadline=final_deadline
+    )
+
+
+async def receive_utterance(websocket, transcriber: StreamingTranscriber) -> Optional[str]:
+    """Recibir tramas hasta el fin de la voz y devolver el texto final
+
+    Devuelve None si el cliente se desconecta antes de terminar el enunciado.
+    """
+    partial_task: Optional[asyncio.Task] = None
+
+    async def _send_partial():
+        text = await transcriber.partial()
+        if text:
+            await websocket.send_json({"type": "partial", "text": text})
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return None
+
+            if message.get("bytes"):
+                end_of_speech = transcriber.feed(message["bytes"])
+            else:
+                end_of_speech = (message.get("text") or "").strip().lower() == "end"
+
+            if end_of_speech:
+                break
+
+            # Como mucho una parcial en vuelo; el audio sigue entrando mientras tanto
+            if transcriber.wants_partial() and (partial_task is None or partial_task.done()):
+                partial_task = asyncio.create_task(_send_partial())
+    finally:
+        if partial_task is not None and not partial_task.done():
+            partial_task.cancel()
+
+    texto = await transcriber.finalize()
+    await websocket.send_json({"type": "final", "text": texto})
+    return texto
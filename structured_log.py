@@ -0,0 +1,219 @@
+"""
+Logging estructurado y no bloqueante para el camino de cada petición.
+
+Los `print` escriben en stdout de forma síncrona desde el event loop: si la
+tubería de logs de Render se llena, cada turno espera a que se vacíe. Aquí
+los registros se encolan (put_nowait, sin esperar) en un QueueHandler y un
+QueueListener los formatea y escribe en su propio hilo. Si la cola está llena
+el registro se descarta y se cuenta, en lugar de frenar la petición.
+
+Cada línea es un objeto JSON con hora, nivel, logger, mensaje, session_id,
+request_id y trace_id (tomados de contextvars, así que no hay que pasarlos a
+mano) y los campos extra del registro (`log.info("...", extra={"stt_s": 0.4})`).
+El trace_id es el de la traza activa (ver tracing.py), de modo que los logs
+de un turno lento se encuentran a partir de /debug/traces y viceversa.
+
+  - LOG_LEVEL: nivel mínimo (INFO por defecto)
+  - LOG_FORMAT: json (por defecto) o text para desarrollo local
+  - LOG_SAMPLE_RATE: fracción de peticiones cuyos registros DEBUG/INFO se
+    escriben (1.0 = todas). Se decide por request_id, así que una petición
+    se registra entera o no se registra; WARNING y superiores siempre pasan.
+  - LOG_QUEUE_SIZE: registros pendientes como máximo antes de descartar
+"""
+
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+import zlib
+from typing import Optional
+
+from tracing import current_trace_id
+
+session_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("session_id", default=None)
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# Atributos estándar de LogRecord; el resto son campos extra del registro
+_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def bind_request(session_id: Optional[str] = None, request_id: Optional[str] = None) -> str:
+    """Asociar session_id y request_id a los registros de la tarea actual"""
+    request_id = request_id or uuid.uuid4().hex[:16]
+    request_id_var.set(request_id)
+    if session_id is not None:
+        session_id_var.set(session_id)
+    return request_id
+
+
+def bind_session(session_id: str):
+    session_id_var.set(session_id)
+
+
+class ContextFilter(logging.Filter):
+    """Añadir session_id/request_id/trace_id al registro y aplicar el muestreo por petición"""
+
+    def __init__(self, sample_rate: float = 1.0):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Un `extra` explícito tiene prioridad sobre el contexto
+        if getattr(record, "session_id", None) is None:
+            record.session_id = session_id_var.get()
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        if getattr(record, "trace_id", None) is None:
+            record.trace_id = current_trace_id()
+        if self.sample_rate >= 1.0 or record.levelno >= logging.WARNING:
+            return True
+        if record.request_id is None:
+            return True
+        bucket = zlib.crc32(record.request_id.encode("ascii", "replace")) % 10000
+        return bucket < self.sample_rate * 10000
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                  + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and value is not None:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Formato legible parecido al de los antiguos print"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        prefix = time.strftime("%H:%M:%S", time.localtime(record.created))
+        session = f" Sesión: {record.session_id} -" if getattr(record, "session_id", None) else ""
+        extras = {key: value for key, value in record.__dict__.items()
+                  if key not in _RECORD_ATTRS and key not in ("session_id", "request_id", "trace_id") and value is not None}
+        line = f"[{prefix}]{session} {record.getMessage()}"
+        if extras:
+            line += " " + " ".join(f"{key}={value}" for key, value in extras.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (y cuenta) en vez de bloquear si la cola está llena"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # El formateo (JSON) se hace en el hilo del listener; aquí solo se
+        # fijan el mensaje y la traza para que el registro sea seguro de pasar
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RequestContextMiddleware:
+    """Middleware ASGI: request_id desde X-Request-ID (o uno nuevo), devuelto en la respuesta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        incoming = dict(scope.get("headers") or []).get(b"x-request-id")
+        request_id = bind_request(request_id=incoming.decode("latin-1")[:64] if incoming else None)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers") or [])
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        await self.app(scope, receive, send_with_request_id)
+
+
+class StructuredLogging:
+    """Cola + listener en segundo plano; `start()` al arrancar y `stop()` al parar"""
+
+    def __init__(self, level: int = logging.INFO, fmt: str = "json", sample_rate: float = 1.0,
+                 queue_size: int = 10000, stream=None):
+        self.level = level
+        self.queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.handler = NonBlockingQueueHandler(self.queue)
+        self.handler.addFilter(ContextFilter(sample_rate))
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JSONFormatter() if fmt == "json" else TextFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, output, respect_handler_level=False)
+        self._started = False
+
+    def install(self):
+        """Sustituir los handlers del logger raíz por la cola"""
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+
+    def start(self):
+        if not self._started:
+            self.listener.start()
+            self._started = True
+
+    def stop(self):
+        """Vaciar la cola y parar el hilo del listener"""
+        if self._started:
+            self.listener.stop()
+            self._started = False
+
+    def stats(self) -> dict:
+        return {
+            "level": logging.getLevelName(self.level),
+            "queued": self.queue.qsize(),
+            "dropped": self.handler.dropped
+        }
+
+
+def setup_logging_from_env() -> StructuredLogging:
+    """Instalar el logging estructurado leyendo LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_RATE y LOG_QUEUE_SIZE"""
+    logs = StructuredLogging(
+        level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+        fmt=os.getenv("LOG_FORMAT", "json").lower(),
+        sample_rate=float(os.getenv("LOG_SAMPLE_RATE", "1.0")),
+        queue_size=int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    )
+    logs.install()
+    # Se arranca ya para no perder los registros de la importación; el
+    # shutdown de la app llama a stop() para vaciar la cola
+    logs.start()
+    return logs
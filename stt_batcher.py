@@ -0,0 +1,146 @@
+"""
+Planificador de micro-lotes para Whisper.
+
+Agrupa las transcripciones que llegan casi a la vez (varios peluches hablando
+al mismo tiempo), las rellena a la ventana de 30 s de Whisper, apila sus
+log-mel en un único tensor y las decodifica en una sola pasada del encoder.
+Cada resultado vuelve al future de su llamador.
+"""
+
+import asyncio
+import os
+from typing import List, Optional, Set, Tuple
+
+from stt_worker import STTBusyError, STTWorkerPool
+
+# Whisper trabaja en ventanas de 30 s a 16 kHz (whisper.audio.N_SAMPLES)
+WHISPER_SAMPLE_RATE = 16000
+WHISPER_WINDOW_SAMPLES = 30 * WHISPER_SAMPLE_RATE
+
+# Umbrales que usa whisper.transcribe para descartar segmentos sin voz
+NO_SPEECH_THRESHOLD = 0.6
+LOGPROB_THRESHOLD = -1.0
+
+
+def _decode_batch(model, audios: list, language: str):
+    """Decodificar un lote de audios con una sola pasada del encoder"""
+    import torch
+    import whisper
+
+    n_mels = model.dims.n_mels
+    mel = torch.stack([
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), n_mels=n_mels)
+        for audio in audios
+    ]).to(model.device)
+
+    options = whisper.DecodingOptions(
+        language=language,
+        without_timestamps=True,
+        fp16=model.device.type == "cuda"
+    )
+    results = whisper.decode(model, mel, options)
+
+    outputs = []
+    for result in results:
+        text = result.text
+        if result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD:
+            text = ""
+        outputs.append({"text": text, "language": result.language})
+    return outputs
+
+
+class STTBatcher:
+    """Agrupa transcripciones concurrentes en lotes para el pool de STT"""
+
+    def __init__(self, pool: STTWorkerPool, batch_size: int = 4, max_wait_ms: float = 15.0,
+                 language: str = "es"):
+        self.pool = pool
+        self.batch_size = max(1, batch_size)
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.language = language
+        self._queue: List[Tuple[object, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # El loop solo guarda referencias débiles a las tareas
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches_dispatched = 0
+        self.items_dispatched = 0
+
+    @property
+    def max_queued(self) -> int:
+        return self.pool.max_pending * self.batch_size
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    async def transcribe(self, audio) -> dict:
+        """Transcribir audio (np.float32 a 16 kHz), agrupándolo si es posible"""
+        # Los clips de más de 30 s necesitan la transcripción por ventanas
+        if self.batch_size == 1 or len(audio) > WHISPER_WINDOW_SAMPLES:
+            return await self.pool.transcribe(audio, language=self.language)
+
+        if len(self._queue) >= self.max_queued:
+            raise STTBusyError(f"Cola de lotes STT llena ({len(self._queue)}/{self.max_queued})")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queue.append((audio, future))
+
+        if len(self._queue) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Los llamadores que ya abandonaron la espera (timeout, cancelación) no se decodifican
+        self._queue = [item for item in self._queue if not item[1].done()]
+        while self._queue:
+            batch = self._queue[:self.batch_size]
+            self._queue = self._queue[self.batch_size:]
+            task = asyncio.ensure_future(self._dispatch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch(self, batch: List[Tuple[object, asyncio.Future]]):
+        audios = [audio for audio, _ in batch]
+        self.batches_dispatched += 1
+        self.items_dispatched += len(batch)
+
+        try:
+            results = await self.pool.run(_decode_batch, audios, self.language)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            # El llamador puede haber abandonado la espera por timeout
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "batch_size": self.batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+            "queued": len(self._queue),
+            "batches_dispatched": self.batches_dispatched,
+            "avg_batch_size": (self.items_dispatched / self.batches_dispatched
+                               if self.batches_dispatched else 0.0)
+        }
+
+
+def create_batcher_from_env(pool: STTWorkerPool, language: str = "es") -> STTBatcher:
+    """Crear el batcher leyendo STT_BATCH_SIZE y STT_BATCH_WAIT_MS del entorno"""
+    return STTBatcher(
+        pool,
+        batch_size=int(os.getenv("STT_BATCH_SIZE", "4")),
+        max_wait_ms=float(os.getenv("STT_BATCH_WAIT_MS", "15")),
+        language=language
+    )
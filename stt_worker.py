@@ -0,0 +1,134 @@
+"""
+Pool de workers para transcripción con Whisper fuera del event loop.
+
+Cada worker es un hilo con su propio modelo cargado. El pool acepta como
+máximo `workers + queue_size` trabajos pendientes; si se supera ese límite
+`transcribe` lanza `STTBusyError` inmediatamente para que el endpoint pueda
+responder "ocupado" en lugar de encolar sin límite.
+"""
+
+import asyncio
+import itertools
+import os
+import threading
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait as wait_futures
+from typing import Any, Callable, Optional
+
+import model_registry
+
+
+class STTBusyError(Exception):
+    """El pool de STT no acepta más trabajos en este momento"""
+
+
+class STTWorkerPool:
+    """Ejecutor dedicado de STT con cola acotada y backpressure"""
+
+    def __init__(self, model_name: Optional[str] = None, workers: int = 1, queue_size: int = 4,
+                 model_loader: Optional[Callable[[str, int], Any]] = None,
+                 model_warmup: Optional[Callable[[str, int], Any]] = None,
+                 warmup_timeout: float = 300.0):
+        self.model_name = model_name or model_registry.default_model_size()
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self._model_loader = model_loader or model_registry.get_model
+        self._model_warmup = model_warmup or model_registry.warmup
+        self.warmup_timeout = warmup_timeout
+        self._init_error: Optional[BaseException] = None
+        self._replicas = itertools.count()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="stt-worker",
+            initializer=self._init_worker
+        )
+
+    @property
+    def max_pending(self) -> int:
+        return self.workers + self.queue_size
+
+    @property
+    def pending(self) -> int:
+        """Trabajos en ejecución o en cola"""
+        return self._pending
+
+    def _init_worker(self):
+        # Un modelo por hilo: los workers nunca comparten estado de inferencia
+        self._local.replica = next(self._replicas)
+        try:
+            self._local.model = self._model_loader(self.model_name, self._local.replica)
+        except BaseException as e:
+            self._init_error = e
+            raise
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def _run(self, fn: Callable, args: tuple, kwargs: dict):
+        return fn(self._local.model, *args, **kwargs)
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """Ejecutar fn(model, *args, **kwargs) en un worker"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise STTBusyError(f"Pool STT lleno ({self._pending}/{self.max_pending})")
+            self._pending += 1
+
+        try:
+            future = self._executor.submit(self._run, fn, args, kwargs)
+        except Exception:
+            self._release()
+            raise
+
+        # El contador se libera cuando el hilo termina, no cuando el llamador
+        # deja de esperar (p. ej. por timeout), para reflejar la carga real
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    async def transcribe(self, audio, **kwargs):
+        """Transcribir audio (np.float32 a 16 kHz) en un worker"""
+        return await self.run(_transcribe, audio, **kwargs)
+
+    def warmup(self):
+        """Arrancar todos los workers y calentar sus modelos (bloqueante)
+
+        Lanza el error de carga del modelo si algún worker no arranca, para
+        que el servidor no termine de arrancar con el pool roto.
+        """
+        # La barrera obliga a que cada tarea ocupe un hilo distinto
+        barrier = threading.Barrier(self.workers, timeout=self.warmup_timeout)
+
+        def _warm():
+            barrier.wait()
+            self._model_warmup(self.model_name, self._local.replica)
+
+        futures = [self._executor.submit(_warm) for _ in range(self.workers)]
+        wait_futures(futures, return_when=FIRST_EXCEPTION)
+        if any(future.done() and future.exception() for future in futures):
+            # Liberar los hilos que siguen esperando en la barrera
+            barrier.abort()
+        if self._init_error is not None:
+            # El ejecutor solo informa de BrokenThreadPool: lanzar la causa real
+            raise self._init_error
+        for future in futures:
+            future.result()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def _transcribe(model, audio, **kwargs):
+    return model.transcribe(audio, **kwargs)
+
+
+def create_pool_from_env(model_name: Optional[str] = None) -> STTWorkerPool:
+    """Crear el pool leyendo WHISPER_MODEL, STT_WORKERS, STT_QUEUE_SIZE y STT_WARMUP_TIMEOUT_S del entorno"""
+    return STTWorkerPool(
+        model_name=model_name,
+        workers=int(os.getenv("STT_WORKERS", "1")),
+        queue_size=int(os.getenv("STT_QUEUE_SIZE", "4")),
+        warmup_timeout=float(os.getenv("STT_WARMUP_TIMEOUT_S", "300"))
+    )
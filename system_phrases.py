@@ -0,0 +1,102 @@
+"""
+Registro de frases fijas del sistema (timeout, error, ocupado...).
+
+Las frases se renderizan una sola vez al arrancar, o se cargan de un paquete
+de audio pregenerado, y se sirven desde memoria. Así las respuestas de error
+no cuestan una llamada de TTS justo cuando el sistema está sobrecargado.
+
+Los operadores pueden añadir frases propias:
+  - SYSTEM_PHRASES_FILE: JSON {"nombre": "texto", ...}
+  - SYSTEM_PHRASES_DIR: audios pregenerados `<nombre>.<formato>` (p. ej. timeout.mp3)
+  - register("nombre", "texto") desde código
+"""
+
+import json
+import logging
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PHRASES = {
+    "timeout": "Lo siento, la respuesta está tardando demasiado. Inténtalo de nuevo.",
+    "error": "Lo siento, ha ocurrido un error. Inténtalo de nuevo.",
+    "busy": "Ahora mismo estoy muy ocupado. Inténtalo de nuevo en un momento.",
+    "no_speech": "No te he oído bien. ¿Puedes repetirlo?",
+}
+
+
+class SystemPhrases:
+    """Frases fijas con su audio precalculado en memoria"""
+
+    def __init__(self, phrases: Optional[Dict[str, str]] = None):
+        self._texts: Dict[str, str] = dict(DEFAULT_PHRASES if phrases is None else phrases)
+        self._audio: Dict[str, bytes] = {}
+
+    def register(self, name: str, text: str):
+        """Añadir o reemplazar una frase; su audio se renderiza en el próximo render_all"""
+        if self._texts.get(name) != text:
+            self._audio.pop(name, None)
+        self._texts[name] = text
+
+    def text(self, name: str) -> str:
+        return self._texts[name]
+
+    def names(self):
+        return list(self._texts)
+
+    def load_file(self, path: str):
+        """Cargar frases desde un JSON {"nombre": "texto"}"""
+        with open(path, encoding="utf-8") as f:
+            for name, text in json.load(f).items():
+                self.register(name, text)
+
+    def load_bundle(self, directory: str, audio_format: str):
+        """Cargar audios pregenerados `<nombre>.<formato>` de un directorio"""
+        suffix = f".{audio_format}"
+        for filename in os.listdir(directory):
+            if filename.endswith(suffix):
+                name = filename[:-len(suffix)]
+                with open(os.path.join(directory, filename), "rb") as f:
+                    self._audio[name] = f.read()
+                self._texts.setdefault(name, name)
+
+    async def render_all(self, synthesize: Callable[[str], Awaitable[bytes]]):
+        """Renderizar todas las frases que todavía no tienen audio"""
+        for name, text in self._texts.items():
+            if name in self._audio:
+                continue
+            try:
+                self._audio[name] = await synthesize(text)
+            except Exception as e:
+                # Se reintentará bajo demanda la primera vez que se necesite
+                log.warning("No se pudo renderizar la frase del sistema '%s': %s", name, e)
+
+        log.info("Frases del sistema listas: %d/%d", len(self._audio), len(self._texts))
+
+    def get(self, name: str) -> Optional[bytes]:
+        """Audio en memoria de una frase (None si aún no está renderizada)"""
+        return self._audio.get(name)
+
+    async def audio(self, name: str, synthesize: Callable[[str], Awaitable[bytes]]) -> bytes:
+        """Audio de una frase, renderizándola solo si el arranque no pudo hacerlo"""
+        data = self._audio.get(name)
+        if data is None:
+            data = await synthesize(self._texts[name])
+            self._audio[name] = data
+        return data
+
+
+def create_phrases_from_env(audio_format: str) -> SystemPhrases:
+    """Crear el registro con las frases por defecto y las de SYSTEM_PHRASES_FILE/DIR"""
+    phrases = SystemPhrases()
+
+    phrases_file = os.getenv("SYSTEM_PHRASES_FILE")
+    if phrases_file:
+        phrases.load_file(phrases_file)
+
+    bundle_dir = os.getenv("SYSTEM_PHRASES_DIR")
+    if bundle_dir and os.path.isdir(bundle_dir):
+        phrases.load_bundle(bundle_dir, audio_format)
+
+    return phrases
@@ -0,0 +1,45 @@
+"""
+Conteo de tokens para presupuestar el contexto del LLM.
+
+Usa tiktoken si está instalado (opcional); si no, una estimación de
+~4 caracteres por token, suficiente para decidir cuánto historial cabe.
+"""
+
+import logging
+from functools import lru_cache
+from typing import Dict
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+log = logging.getLogger(__name__)
+
+# Tokens extra por mensaje de chat (rol y separadores)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@lru_cache(maxsize=1)
+def _encoding():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # p. ej. sin red para descargar el vocabulario la primera vez
+        log.warning("tiktoken no disponible (%s), usando estimación de tokens", e)
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(text: str) -> int:
+    encoding = _encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def count_message_tokens(message: Dict[str, str]) -> int:
+    return count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
@@ -0,0 +1,290 @@
+"""
+Trazas ligeras por turno: STT → caché → LLM → TTS → persistencia.
+
+Cada petición abre una traza y cada etapa (y cada helper de base de datos)
+un span con su duración y atributos, para saber si un turno lento fue
+Whisper, OpenAI, el TTS o el commit de SQLite/Postgres. La traza y el span
+activos viajan en contextvars, así que las funciones instrumentadas no
+reciben parámetros nuevos; sin traza activa, `span()` no hace nada.
+
+El identificador de traza llega del dispositivo en la cabecera X-Trace-Id (o
+en `traceparent` de W3C); si no viene se genera uno. Las trazas terminadas se
+guardan en un buffer circular (TRACE_RING_SIZE), las N más lentas se
+conservan aparte (TRACE_SLOWEST) y, con TRACE_EXPORT_PATH, se escriben como
+JSON lines desde un hilo en segundo plano. Se consultan en /debug/traces.
+"""
+
+import contextvars
+import functools
+import heapq
+import inspect
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from typing import List, Optional
+
+_current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("trace", default=None)
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("span", default=None)
+
+MAX_SPANS_PER_TRACE = 200
+
+
+def _new_id(length: int) -> str:
+    return uuid.uuid4().hex[:length]
+
+
+def trace_id_from_headers(headers) -> Optional[str]:
+    """X-Trace-Id del dispositivo o el trace-id de una cabecera traceparent"""
+    if headers is None:
+        return None
+    trace_id = headers.get("X-Trace-Id")
+    if trace_id:
+        return trace_id.strip()[:64]
+    traceparent = headers.get("traceparent")
+    if traceparent:
+        parts = traceparent.split("-")
+        if len(parts) >= 3 and len(parts[1]) == 32:
+            return parts[1]
+    return None
+
+
+class Span:
+    __slots__ = ("name", "span_id", "parent_id", "start", "end", "attrs", "error")
+
+    def __init__(self, name: str, parent_id: Optional[str], attrs: dict):
+        self.name = name
+        self.span_id = _new_id(16)
+        self.parent_id = parent_id
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+class Trace:
+    def __init__(self, name: str, trace_id: Optional[str] = None, attrs: Optional[dict] = None):
+        self.name = name
+        self.trace_id = trace_id or _new_id(32)
+        self.attrs = attrs or {}
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+        self.spans: List[Span] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        def ms(value: Optional[float]) -> Optional[float]:
+            return None if value is None else round(1000 * (value - self.start), 3)
+
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(1000 * self.duration, 3),
+            "error": self.error,
+            "attrs": self.attrs,
+            "spans": [{
+                "name": span.name,
+                "span_id": span.span_id,
+                "parent_id": span.parent_id,
+                "start_ms": ms(span.start),
+                "duration_ms": None if span.end is None else round(1000 * (span.end - span.start), 3),
+                "error": span.error,
+                "attrs": span.attrs
+            } for span in self.spans]
+        }
+
+
+class FileExporter:
+    """Escribe las trazas terminadas como JSON lines desde un hilo propio"""
+
+    def __init__(self, path: str, max_queue: int = 1000):
+        self.path = path
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, trace: Trace):
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                entry = self._queue.get()
+                if entry is None:
+                    return
+                f.write(json.dumps(entry, ensure_ascii=False, default=str) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+class Tracer:
+    def __init__(self, ring_size: int = 200, keep_slowest: int = 20,
+                 exporter: Optional[FileExporter] = None, enabled: bool = True):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.keep_slowest = keep_slowest
+        self._recent: "deque[Trace]" = deque(maxlen=ring_size)
+        # Montículo de (duración, contador, traza): la raíz es la más rápida de las lentas
+        self._slowest: List[tuple] = []
+        self._counter = 0
+        self.finished = 0
+
+    def begin(self, name: str, trace_id: Optional[str] = None, **attrs) -> Optional[Trace]:
+        if not self.enabled:
+            return None
+        return Trace(name, trace_id, attrs)
+
+    def finish(self, trace: Optional[Trace], error: Optional[BaseException] = None):
+        if trace is None or trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        if error is not None:
+            trace.error = f"{type(error).__name__}: {error}"
+        self.finished += 1
+        self._recent.append(trace)
+
+        self._counter += 1
+        entry = (trace.duration, self._counter, trace)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif self._slowest and entry[0] > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+        if self.exporter is not None:
+            self.exporter.export(trace)
+
+    @contextmanager
+    def activate(self, trace: Optional[Trace]):
+        """Hacer `trace` la traza activa (p. ej. dentro de un generador de streaming)"""
+        trace_token = _current_trace.set(trace)
+        span_token = _current_span.set(None)
+        try:
+            yield trace
+        finally:
+            try:
+                _current_span.reset(span_token)
+                _current_trace.reset(trace_token)
+            except ValueError:
+                # Un generador cerrado desde otro contexto (cliente desconectado)
+                pass
+
+    @contextmanager
+    def trace(self, name: str, trace_id: Optional[str] = None, **attrs):
+        """Abrir una traza, activarla y cerrarla al salir"""
+        trace = self.begin(name, trace_id, **attrs)
+        error = None
+        try:
+            with self.activate(trace):
+                yield trace
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self.finish(trace, error)
+
+    def recent(self, limit: int = 50) -> List[dict]:
+        return [trace.to_dict() for trace in list(self._recent)[-limit:][::-1]]
+
+    def slowest(self) -> List[dict]:
+        return [entry[2].to_dict() for entry in sorted(self._slowest, key=lambda e: e[0], reverse=True)]
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        for trace in reversed(self._recent):
+            if trace.trace_id == trace_id:
+                return trace.to_dict()
+        for _, _, trace in self._slowest:
+            if trace.trace_id == trace_id:
+                return trace.to_dict()
+        return None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "finished": self.finished,
+            "recent": len(self._recent),
+            "slowest_kept": len(self._slowest),
+            "export_path": self.exporter.path if self.exporter else None,
+            "export_dropped": self.exporter.dropped if self.exporter else 0
+        }
+
+    def close(self):
+        if self.exporter is not None:
+            self.exporter.close()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace else None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """Span dentro de la traza activa; sin traza activa no mide nada"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    parent = _current_span.get()
+    current = Span(name, parent.span_id if parent else None, attrs)
+    if len(trace.spans) < MAX_SPANS_PER_TRACE:
+        trace.spans.append(current)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        current.end = time.perf_counter()
+        _current_span.reset(token)
+
+
+def traced(name: str):
+    """Decorador: envolver una función (síncrona o async) en un span"""
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def create_tracer_from_env() -> Tracer:
+    """Crear el tracer leyendo TRACING, TRACE_RING_SIZE, TRACE_SLOWEST y TRACE_EXPORT_PATH"""
+    export_path = os.getenv("TRACE_EXPORT_PATH")
+    return Tracer(
+        ring_size=int(os.getenv("TRACE_RING_SIZE", "200")),
+        keep_slowest=int(os.getenv("TRACE_SLOWEST", "20")),
+        exporter=FileExporter(export_path) if export_path else None,
+        enabled=os.getenv("TRACING", "1") != "0"
+    )
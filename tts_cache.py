@@ -0,0 +1,160 @@
+"""
+Caché de audio TTS direccionada por contenido, en disco y con límite de tamaño.
+
+La clave es un hash de (texto normalizado, voz, idioma, formato), de modo que
+la misma frase dicha a dos dispositivos se sintetiza y almacena una sola vez
+para toda la flota. Cada clip es un archivo en TTS_CACHE_DIR y el índice en
+memoria mantiene el orden LRU para desalojar los clips menos usados cuando
+se supera TTS_CACHE_MAX_BYTES. `get_or_synthesize` hace la lectura y la
+escritura en disco con asyncio.to_thread para no bloquear el event loop.
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CACHE_DIR = os.path.join(PROJECT_ROOT, "tts_cache")
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalizar el texto para que variaciones triviales compartan audio"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def make_key(text: str, voice: str, language: str, audio_format: str) -> str:
+    payload = "\0".join([normalize_text(text), voice, language, audio_format])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TTSCache:
+    """Caché LRU de clips de audio en disco con presupuesto de bytes"""
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_bytes: int = 200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._index: "OrderedDict[str, int]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _load_index(self):
+        """Reconstruir el índice desde disco, del acceso más antiguo al más reciente"""
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            # Mantener el mtime como marca de uso para el próximo arranque
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            data = b""
+        if not data:
+            # Archivo borrado por fuera o vacío: tratar como fallo
+            with self._lock:
+                size = self._index.pop(key, 0)
+                self._bytes -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._bytes -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._bytes += len(data)
+            self._evict()
+
+    async def get_or_synthesize(self, text: str, voice: str, language: str, audio_format: str,
+                                synthesize: Callable[[str], Awaitable[Tuple[bytes, str]]]) -> bytes:
+        """Devolver el audio cacheado o sintetizarlo y guardarlo
+
+        `synthesize` devuelve el audio y la voz que lo produjo. Si no es `voice`
+        (p. ej. Piper falló y respondió gTTS) el audio no se guarda: se
+        reproduciría más tarde con la clave de la otra voz.
+        """
+        key = make_key(text, voice, language, audio_format)
+        data = await asyncio.to_thread(self.get, key)
+        if data is not None:
+            return data
+
+        data, produced_by = await synthesize(text)
+        if produced_by == voice:
+            await asyncio.to_thread(self.put, key, data)
+        return data
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._index),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions
+        }
+
+
+def create_cache_from_env() -> TTSCache:
+    """Crear la caché leyendo TTS_CACHE_DIR y TTS_CACHE_MAX_BYTES"""
+    return TTSCache(
+        directory=os.getenv("TTS_CACHE_DIR", DEFAULT_CACHE_DIR),
+        max_bytes=int(os.getenv("TTS_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+    )
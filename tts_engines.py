@@ -0,0 +1,246 @@
+"""
+Motores de síntesis de voz intercambiables.
+
+- GTTSEngine: Google Text-to-Speech (llamada HTTP por respuesta, MP3)
+- PiperEngine: voz Piper local con ONNX Runtime, sin red. Usa la
+  configuración de voz `*.onnx.json` junto al modelo `*.onnx` y codifica a
+  MP3 con lameenc (sin lameenc no se carga y se usa gTTS)
+- FallbackEngine: prueba motores en orden (p. ej. Piper y, si falla, gTTS)
+
+El motor se elige con TTS_ENGINE (auto | piper | gtts). Con "auto" se usa
+Piper si el modelo y sus dependencias están disponibles y la voz habla el
+idioma de TTS_LANG, y gTTS si no.
+Todos los motores producen MP3: las respuestas frase a frase se envían como
+MP3 concatenados (ver tts_stream.py), cosa que no funciona con varios WAV.
+La síntesis es bloqueante; `synthesize_async` la ejecuta en un pool de
+hilos propio para no bloquear el event loop y devuelve también la voz que
+produjo el audio, que con FallbackEngine puede no ser la del primer motor.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PIPER_MODEL = os.path.join(PROJECT_ROOT, "es_ES-davefx-medium.onnx")
+
+MEDIA_TYPES = {
+    "mp3": "audio/mp3",
+    "wav": "audio/wav",
+}
+
+
+class TTSEngine:
+    """Interfaz común de los motores de TTS"""
+
+    name = "base"
+    format = "mp3"
+    voice = ""
+    language = "es"
+
+    @property
+    def media_type(self) -> str:
+        return MEDIA_TYPES.get(self.format, "application/octet-stream")
+
+    def synthesize(self, text: str) -> bytes:
+        raise NotImplementedError
+
+    def synthesize_voiced(self, text: str) -> Tuple[bytes, str]:
+        """Audio y voz que lo produjo"""
+        return self.synthesize(text), self.voice
+
+
+class GTTSEngine(TTSEngine):
+    """TTS con gTTS (Google Text-to-Speech)"""
+
+    name = "gtts"
+    format = "mp3"
+
+    def __init__(self, language: str = "es"):
+        self.language = language
+        self.voice = f"gtts-{language}"
+
+    def synthesize(self, text: str) -> bytes:
+        from gtts import gTTS
+
+        tts = gTTS(text=text, lang=self.language)
+        audio_io = io.BytesIO()
+        tts.write_to_fp(audio_io)
+        return audio_io.getvalue()
+
+
+class PiperEngine(TTSEngine):
+    """Voz Piper local ejecutada con ONNX Runtime"""
+
+    name = "piper"
+
+    format = "mp3"
+
+    def __init__(self, model_path: str, config_path: Optional[str] = None,
+                 speaker_id: Optional[int] = None):
+        import lameenc
+        import numpy as np
+        import onnxruntime
+        from piper_phonemize import phonemize_espeak
+
+        self._lameenc = lameenc
+        self._np = np
+        self._phonemize = phonemize_espeak
+
+        config_path = config_path or f"{model_path}.json"
+        with open(config_path, encoding="utf-8") as f:
+            self.config = json.load(f)
+
+        self.sample_rate = self.config["audio"]["sample_rate"]
+        self.espeak_voice = self.config["espeak"]["voice"]
+        self.phoneme_id_map = self.config["phoneme_id_map"]
+        inference = self.config.get("inference", {})
+        self.scales = np.array([
+            inference.get("noise_scale", 0.667),
+            inference.get("length_scale", 1.0),
+            inference.get("noise_w", 0.8)
+        ], dtype=np.float32)
+        self.speaker_id = speaker_id if self.config.get("num_speakers", 1) > 1 else None
+
+        self.voice = os.path.splitext(os.path.basename(model_path))[0]
+        self.language = self.espeak_voice
+
+        # La sesión se carga una sola vez; run() es seguro entre hilos
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = int(os.getenv("PIPER_THREADS", "1"))
+        self.session = onnxruntime.InferenceSession(
+            model_path, sess_options=options, providers=["CPUExecutionProvider"]
+        )
+
+    def _phoneme_ids(self, phonemes: List[str]) -> List[int]:
+        id_map = self.phoneme_id_map
+        ids = list(id_map["^"])
+        for phoneme in phonemes:
+            if phoneme in id_map:
+                ids.extend(id_map[phoneme])
+                ids.extend(id_map["_"])
+        ids.extend(id_map["$"])
+        return ids
+
+    def synthesize_pcm(self, text: str):
+        """Sintetizar a PCM int16 mono a `sample_rate`"""
+        np = self._np
+        chunks = []
+        silence = np.zeros(int(self.sample_rate * 0.2), dtype=np.float32)
+
+        for sentence in self._phonemize(text, self.espeak_voice):
+            ids = self._phoneme_ids(sentence)
+            inputs = {
+                "input": np.array([ids], dtype=np.int64),
+                "input_lengths": np.array([len(ids)], dtype=np.int64),
+                "scales": self.scales
+            }
+            if self.speaker_id is not None:
+                inputs["sid"] = np.array([self.speaker_id], dtype=np.int64)
+
+            audio = self.session.run(None, inputs)[0].squeeze()
+            chunks.append(audio)
+            chunks.append(silence)
+
+        if not chunks:
+            return np.zeros(0, dtype=np.int16)
+
+        audio = np.concatenate(chunks)
+        peak = max(0.01, float(np.max(np.abs(audio))))
+        return np.clip(audio * (32767.0 / peak), -32768, 32767).astype(np.int16)
+
+    def synthesize(self, text: str) -> bytes:
+        pcm = self.synthesize_pcm(text)
+
+        # MP3, el formato que esperan los ESP32 y el único que se puede concatenar
+        encoder = self._lameenc.Encoder()
+        encoder.set_bit_rate(64)
+        encoder.set_in_sample_rate(self.sample_rate)
+        encoder.set_channels(1)
+        encoder.set_quality(2)
+        return bytes(encoder.encode(pcm.tobytes()) + encoder.flush())
+
+
+class FallbackEngine(TTSEngine):
+    """Usa el primer motor que funcione; todos deben producir el mismo formato"""
+
+    name = "fallback"
+
+    def __init__(self, *engines: TTSEngine):
+        formats = {engine.format for engine in engines}
+        if len(formats) != 1:
+            raise ValueError(f"Los motores de respaldo deben compartir formato: {formats}")
+        self.engines = engines
+        self.format = engines[0].format
+        self.voice = engines[0].voice
+        self.language = engines[0].language
+
+    def synthesize(self, text: str) -> bytes:
+        return self.synthesize_voiced(text)[0]
+
+    def synthesize_voiced(self, text: str) -> Tuple[bytes, str]:
+        last_error = None
+        for engine in self.engines:
+            try:
+                return engine.synthesize_voiced(text)
+            except Exception as e:
+                log.warning("TTS %s falló, probando el siguiente: %s", engine.name, e)
+                last_error = e
+        raise last_error
+
+
+def same_language(voice_language: str, language: str) -> bool:
+    """Comparar idiomas por su código principal ("es-419" ~ "es", "en-us" ~ "en")"""
+    return voice_language.split("-")[0].lower() == language.split("-")[0].lower()
+
+
+def create_engine_from_env() -> TTSEngine:
+    """Crear el motor de TTS según TTS_ENGINE, PIPER_MODEL y TTS_LANG"""
+    engine_name = os.getenv("TTS_ENGINE", "auto")
+    gtts_engine = GTTSEngine(language=os.getenv("TTS_LANG", "es"))
+    if engine_name == "gtts":
+        return gtts_engine
+
+    model_path = os.getenv("PIPER_MODEL", DEFAULT_PIPER_MODEL)
+    if engine_name == "auto" and not os.path.exists(model_path):
+        return gtts_engine
+
+    try:
+        piper = PiperEngine(model_path, config_path=os.getenv("PIPER_CONFIG"))
+    except Exception as e:
+        log.warning("No se pudo cargar Piper (%s), usando gTTS", e)
+        return gtts_engine
+
+    if engine_name == "auto" and not same_language(piper.language, gtts_engine.language):
+        log.warning("La voz Piper %s (%s) no habla %s, usando gTTS",
+                    piper.voice, piper.language, gtts_engine.language)
+        return gtts_engine
+
+    log.info("TTS local Piper cargado: %s (%s, %d Hz)", piper.voice, piper.format, piper.sample_rate)
+    # Mismo formato (MP3): si Piper falla en una frase, responde gTTS
+    return FallbackEngine(piper, gtts_engine)
+
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=int(os.getenv("TTS_WORKERS", "2")),
+            thread_name_prefix="tts-worker"
+        )
+    return _executor
+
+
+async def synthesize_async(engine: TTSEngine, text: str) -> Tuple[bytes, str]:
+    """Sintetizar en el pool de hilos de TTS; devuelve el audio y la voz que lo produjo"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), engine.synthesize_voiced, text)
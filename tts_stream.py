@@ -0,0 +1,106 @@
+"""
+Síntesis de voz frase a frase sobre una respuesta del LLM en streaming.
+
+`split_sentences` corta el texto que va llegando en frases completas y
+`synthesize_sentences` sintetiza cada frase en cuanto está lista, mientras
+el LLM sigue escribiendo la siguiente. Los fragmentos de audio se entregan
+en orden, de modo que el dispositivo puede empezar a reproducir la primera
+frase sin esperar a la última. Los MP3 concatenados siguen siendo un MP3
+válido.
+"""
+
+import asyncio
+import re
+from typing import AsyncIterator, Awaitable, Callable, List, Tuple
+
+# Fin de frase: puntuación final seguida de espacio, o salto de línea
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+# Frases más cortas se unen a la siguiente para no pedir TTS de "Sí."
+MIN_SENTENCE_CHARS = 20
+
+
+def _cut_sentences(buffer: str, min_chars: int) -> Tuple[List[str], str]:
+    """Separar las frases completas del texto pendiente"""
+    sentences = []
+    while True:
+        cut = None
+        for match in SENTENCE_END.finditer(buffer):
+            if len(buffer[:match.start()].strip()) >= min_chars:
+                cut = match
+                break
+        if cut is None:
+            return sentences, buffer
+
+        sentences.append(buffer[:cut.start()].strip())
+        buffer = buffer[cut.end():]
+
+
+def split_text(text: str, min_chars: int = MIN_SENTENCE_CHARS) -> List[str]:
+    """Cortar un texto completo igual que split_sentences corta el streaming"""
+    sentences, rest = _cut_sentences(text, min_chars)
+    if rest.strip():
+        sentences.append(rest.strip())
+    return sentences
+
+
+async def split_sentences(deltas: AsyncIterator[str],
+                          min_chars: int = MIN_SENTENCE_CHARS) -> AsyncIterator[str]:
+    """Agrupar los deltas de texto del LLM en frases completas"""
+    buffer = ""
+    async for delta in deltas:
+        sentences, buffer = _cut_sentences(buffer + delta, min_chars)
+        for sentence in sentences:
+            yield sentence
+
+    if buffer.strip():
+        yield buffer.strip()
+
+
+async def synthesize_sentences(sentences: AsyncIterator[str],
+                               synthesize: Callable[[str], Awaitable[bytes]],
+                               max_ahead: int = 2) -> AsyncIterator[bytes]:
+    """Sintetizar cada frase en cuanto llega y devolver el audio en orden"""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=max_ahead)
+
+    async def produce():
+        try:
+            async for sentence in sentences:
+                task = asyncio.ensure_future(synthesize(sentence))
+                try:
+                    await queue.put(task)
+                except BaseException:
+                    task.cancel()
+                    raise
+        finally:
+            await queue.put(None)
+
+    def drain():
+        while not queue.empty():
+            task = queue.get_nowait()
+            if task is not None:
+                task.cancel()
+
+    producer = asyncio.create_task(produce())
+    pending = []
+    try:
+        while True:
+            task = await queue.get()
+            if task is None:
+                break
+            pending.append(task)
+            yield await task
+            pending.remove(task)
+
+        # Propagar errores del LLM o de la síntesis
+        await producer
+    finally:
+        for task in pending:
+            task.cancel()
+        if not producer.done():
+            # El consumidor se fue (desconexión, plazo): vaciar la cola para que
+            # el put(None) final del productor no se bloquee, y esperar a que acabe
+            producer.cancel()
+            drain()
+            await asyncio.wait([producer])
+        drain()
@@ -0,0 +1,94 @@
+"""
+Detección de voz (VAD) por energía y recorte de silencios antes del STT.
+
+Un clip de pulsar-para-hablar suele ser sobre todo silencio al principio y
+al final, y el tiempo de Whisper crece con la duración del audio. Aquí se
+calcula la energía RMS por tramas de 30 ms de forma vectorizada, se recorta
+el audio a la zona con voz (con un pequeño margen) y se rechazan los clips
+sin voz antes de llamar a Whisper o al LLM.
+
+El umbral es un múltiplo del ruido de fondo del propio clip (con tope en
+una fracción del pico), para no confundir el ruido del micrófono con voz.
+VAD_ENERGY_THRESHOLD es solo un suelo para el silencio digital (0.001, unos
+-60 dBFS): un suelo más alto rechazaría la voz de micrófonos I2S de poca
+ganancia, que puede quedarse en -45/-50 dBFS.
+"""
+
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+FRAME_MS = 30
+
+
+class NoSpeechError(Exception):
+    """El clip no contiene voz; no merece la pena transcribirlo"""
+
+
+class VADResult(NamedTuple):
+    audio: np.ndarray
+    has_speech: bool
+    speech_ratio: float
+    duration: float
+    trimmed_duration: float
+
+
+def frame_rms(audio: np.ndarray, frame_samples: int) -> np.ndarray:
+    """Energía RMS de cada trama completa de `frame_samples` muestras"""
+    n_frames = len(audio) // frame_samples
+    if n_frames == 0:
+        return np.zeros(0, dtype=np.float32)
+    frames = audio[:n_frames * frame_samples].reshape(n_frames, frame_samples)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+
+class EnergyVAD:
+    """Recorta silencios y mide la proporción de voz de un clip"""
+
+    def __init__(self, energy_threshold: float = 0.001, noise_factor: float = 3.0,
+                 padding_ms: int = 150, min_speech_ms: int = 200):
+        self.energy_threshold = energy_threshold
+        self.noise_factor = noise_factor
+        self.padding_ms = padding_ms
+        self.min_speech_ms = min_speech_ms
+
+    def threshold(self, noise_floor: float, peak: float) -> float:
+        """Umbral de voz: múltiplo del ruido de fondo, sin pasar del 25 % del pico"""
+        return max(self.energy_threshold, min(self.noise_factor * noise_floor, 0.25 * peak))
+
+    def trim(self, audio: np.ndarray, sample_rate: int) -> VADResult:
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+        audio = np.asarray(audio, dtype=np.float32)
+        duration = len(audio) / sample_rate if sample_rate else 0.0
+
+        frame_samples = max(1, sample_rate * FRAME_MS // 1000)
+        rms = frame_rms(audio, frame_samples)
+        if len(rms) == 0:
+            return VADResult(audio[:0], False, 0.0, duration, 0.0)
+
+        # Ruido de fondo estimado con las tramas más silenciosas; el tope evita
+        # que un clip de voz continua suba el umbral por encima de la propia voz
+        noise_floor = float(np.percentile(rms, 10))
+        voiced = np.flatnonzero(rms >= self.threshold(noise_floor, float(rms.max())))
+
+        speech_ratio = len(voiced) / len(rms)
+        if len(voiced) * FRAME_MS < self.min_speech_ms:
+            return VADResult(audio[:0], False, speech_ratio, duration, 0.0)
+
+        padding = self.padding_ms * sample_rate // 1000
+        start = max(0, voiced[0] * frame_samples - padding)
+        end = min(len(audio), (voiced[-1] + 1) * frame_samples + padding)
+        trimmed = audio[start:end]
+        return VADResult(trimmed, True, speech_ratio, duration, len(trimmed) / sample_rate)
+
+
+def create_vad_from_env() -> EnergyVAD:
+    """Crear el VAD leyendo VAD_ENERGY_THRESHOLD, VAD_PADDING_MS y VAD_MIN_SPEECH_MS"""
+    return EnergyVAD(
+        energy_threshold=float(os.getenv("VAD_ENERGY_THRESHOLD", "0.001")),
+        noise_factor=float(os.getenv("VAD_NOISE_FACTOR", "3.0")),
+        padding_ms=int(os.getenv("VAD_PADDING_MS", "150")),
+        min_speech_ms=int(os.getenv("VAD_MIN_SPEECH_MS", "200"))
+    )